@@ -1,12 +1,24 @@
-from flask import Flask, render_template_string, request, jsonify
-import pyperclip
-import os
-import pathlib
-import subprocess
+from flask import Flask, request, jsonify
+from assets import page_response
+from body_encoding import DecodeRequestBody
+from clipboard_backend import ClipboardWorker, ClipboardError, backend_from_argv
+from clipboard_state import SharedStore
+from limits import MAX_IMAGE_BYTES, body_limit, configure as configure_limits, spool_body
+from metrics import instrument
+from profiling import install as install_profiling
+from serving import serve
+from werkzeug.exceptions import HTTPException
+import log
 import sys
 import traceback
 
 app = Flask(__name__)
+configure_limits(app)
+app.wsgi_app = DecodeRequestBody(app.wsgi_app)
+install_profiling(app)
+instrument(app)
+clipboard = ClipboardWorker()
+state_store = SharedStore()  # Последний текст, скопированный в буфер (общий для всех воркеров)
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -132,56 +144,44 @@ HTML_TEMPLATE = """
 </html>
 """
 
-last_text = ""  # Сохраняем последний текст, скопированный в буфер
+page_template = app.jinja_env.from_string(HTML_TEMPLATE)     # compiled once
 
 @app.route("/", methods=["GET", "POST"])
+@body_limit(MAX_IMAGE_BYTES)
 def index():
-    global last_text
     try:
         if request.method == "POST":
             if request.form.get("action") == "text":
                 text = request.form.get("text")
                 if text:
-                    pyperclip.copy(text)
-                    last_text = text
+                    if clipboard.set_text(text):    # False: superseded by a newer write
+                        state_store.set("last_text", text)
             else:
-                if request.data:
-                    filepath = '/tmp/uploaded_image.png'
-                    with open(filepath, 'wb') as f:
-                        f.write(request.data)
-
-                    display = os.environ.get('DISPLAY', ':0')
-                    xauth = pathlib.Path.home() / '.Xauthority'
-                    env = os.environ.copy()
-                    env['DISPLAY'] = display
-                    env['XAUTHORITY'] = str(xauth)
-
-                    if subprocess.run(['which', 'xclip'], capture_output=True).returncode != 0:
-                        return "xclip not installed", 500
-
-                    result = subprocess.run(
-                        ['xclip', '-selection', 'clipboard', '-t', 'image/png', '-i', filepath],
-                        env=env,
-                        capture_output=True,
-                        text=True
-                    )
-
-                    if result.returncode != 0:
-                        return f"Failed to copy image to clipboard:\n{result.stderr}", 500
+                data, size = spool_body(request.stream)     # big images wait in a temp file
+                if size:
+                    try:
+                        clipboard.set_image(data)
+                    except ClipboardError as e:
+                        return f"Failed to copy image to clipboard:\n{e}", 500
+                    finally:
+                        if not isinstance(data, bytes):
+                            data.close()
 
                     return "Image uploaded and copied to clipboard!", 200
 
+    except HTTPException:
+        raise
     except Exception as e:
         tb = traceback.format_exc()
-        print(tb)
+        log.error("server_error", exc=e)
         return f"Server error:\n{tb}", 500
 
-    return render_template_string(HTML_TEMPLATE, last_text=last_text)
+    return page_response(page_template.render(last_text=state_store.get("last_text", "")))
 
 @app.route("/get_clipboard", methods=["GET"])
 def get_clipboard():
     try:
-        text = pyperclip.paste()
+        text = clipboard.get_text()
         return jsonify({"text": text})
     except Exception as e:
         return jsonify({"text": f"Error: {str(e)}"})
@@ -190,4 +190,5 @@ if __name__ == "__main__":
     port = 5555
     if '--port' in sys.argv:
         port = int(sys.argv[sys.argv.index('--port') + 1])
-    app.run(host="0.0.0.0", port=port)
+    serve(app, port, sys.argv, store=state_store,
+          on_worker_start=lambda: clipboard.start(backend_from_argv(sys.argv)))
@@ -0,0 +1,104 @@
+"""Static page assets (CSS/JS) served precompressed with long-lived caching.
+
+An Asset is built once at import: its URL carries a content hash
+(/assets/bsend.3f2a9c1e.js), so browsers may keep it forever
+(Cache-Control: immutable) and a new release simply changes the URL. gzip
+and — when the brotli package is installed — br variants are compressed
+once, up front; requests only pick one by Accept-Encoding.
+
+page_response() does the per-request part for the HTML shell: ETag from the
+rendered bytes (304 on revisit when nothing changed) and gzip when the client
+takes it.
+"""
+import gzip
+import hashlib
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None           # pip install brotli for br variants; gzip is always there
+
+ASSET_MAX_AGE     = 365 * 24 * 3600
+PAGE_GZIP_MIN     = 1024    # smaller pages are not worth compressing per request
+PAGE_GZIP_LEVEL   = 6
+
+
+def accepts(accept_encoding, coding):
+    """True if coding is listed in an Accept-Encoding value (q=0 means refused)."""
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip() == coding:
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+class Asset:
+    def __init__(self, name, text, mimetype):
+        stem, _, ext = name.rpartition(".")
+        self.body     = text.encode()
+        self.mimetype = mimetype
+        self.etag     = hashlib.blake2b(self.body, digest_size=8).hexdigest()
+        self.name     = f"{stem}.{self.etag}.{ext}"
+        self.url      = f"/assets/{self.name}"
+
+        # Most preferred first; a variant is kept only if it is actually smaller
+        self.variants = []
+        if brotli is not None:
+            self.variants.append(("br", brotli.compress(self.body, quality=11)))
+        self.variants.append(("gzip", gzip.compress(self.body, 9, mtime=0)))
+        self.variants = [(coding, data) for coding, data in self.variants if len(data) < len(self.body)]
+
+    def pick(self, accept_encoding):
+        """(content coding or None, bytes) for an Accept-Encoding header value."""
+        for coding, data in self.variants:
+            if accepts(accept_encoding, coding):
+                return coding, data
+        return None, self.body
+
+    def headers(self, coding):
+        headers = {"ETag": f'"{self.etag}"', "Vary": "Accept-Encoding",
+                   "Cache-Control": f"public, max-age={ASSET_MAX_AGE}, immutable"}
+        if coding:
+            headers["Content-Encoding"] = coding
+        return headers
+
+
+def register_assets(app, *assets):
+    """Serve assets from GET /assets/<name>."""
+    by_name = {asset.name: asset for asset in assets}
+
+    @app.route("/assets/<name>", methods=["GET"])
+    def asset(name):
+        asset = by_name.get(name)
+        if asset is None:
+            return "Not found", 404
+        if request.if_none_match.contains(asset.etag):
+            return Response(status=304, headers=asset.headers(None))
+        coding, data = asset.pick(request.headers.get("Accept-Encoding", ""))
+        return Response(data, mimetype=asset.mimetype, headers=asset.headers(coding))
+
+
+def page_etag(body):
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
+
+
+def compress_page(body, accept_encoding):
+    """(bytes, content coding or None) for a rendered page."""
+    if len(body) >= PAGE_GZIP_MIN and accepts(accept_encoding, "gzip"):
+        return gzip.compress(body, PAGE_GZIP_LEVEL, mtime=0), "gzip"
+    return body, None
+
+
+def page_response(html):
+    """Flask response for a rendered page: ETag/304 and gzip if accepted."""
+    body = html.encode()
+    etag = page_etag(body)
+    headers = {"ETag": f'"{etag}"', "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    body, coding = compress_page(body, request.headers.get("Accept-Encoding", ""))
+    if coding:
+        headers["Content-Encoding"] = coding
+    return Response(body, mimetype="text/html", headers=headers)
@@ -0,0 +1,413 @@
+"""Load test / benchmark for the clipboard server variants.
+
+    python3 bench.py                                        # bsend.py, default matrix
+    python3 bench.py --variant all --concurrency 1,16,64 --duration 5
+    python3 bench.py --sizes 1k,256k,4m --tree 3x4 --server-args "--workers 4"
+    python3 bench.py --compare bench_results/<earlier run>.json
+
+Every variant is started as a subprocess on a free port with the memory
+clipboard backend (no X display needed) and a throw-away upload directory.
+Load comes from stdlib threads over keep-alive HTTP connections, so the
+harness runs offline on a plain Linux box.
+
+For each variant × scenario × concurrency × payload size it reports
+throughput, p50/p95/p99 latency, errors, the peak RSS of the server's process
+tree and how many processes it ran (gunicorn workers, clipboard tools).
+Results are written as JSON to bench_results/; --compare prints the change
+against an earlier run and exits with 1 if anything got slower than
+--threshold allows.
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+ALL_SCENARIOS = ("index", "get_clipboard", "get_clipboard_304", "text", "image",
+                 "send_to_files", "put_files")
+PAYLOAD_SCENARIOS = {"text", "image", "send_to_files", "put_files"}
+
+# variant -> (script, scenarios it serves)
+VARIANTS = {
+    "bsend":     ("bsend.py", ALL_SCENARIOS),
+    "asgi":      ("bsend_asgi.py", ALL_SCENARIOS),
+    "New":       ("New.py", ("index", "get_clipboard", "text", "image")),
+    "clipboard": ("clipboard.py", ("index", "text", "image")),
+    "text":      ("separately/text.py", ("index", "text")),
+    "image":     ("separately/image.py", ("image",)),
+}
+
+STARTUP_TIMEOUT = 30
+SAMPLE_INTERVAL = 0.05          # seconds between RSS / process samples
+
+
+# ─── Helpers ─────────────────────────────────────────────────────────────────
+
+def parse_size(text):
+    """"64k" / "4m" / "512" -> bytes."""
+    text = text.strip().lower()
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(n):
+    for unit, size in (("m", 1024 ** 2), ("k", 1024)):
+        if n >= size and n % size == 0:
+            return f"{n // size}{unit}"
+    return str(n)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, round(q * (len(sorted_values) - 1)))]
+
+
+def tree_paths(shape, count=1000):
+    """File paths for a "DEPTHxFANOUT" tree, e.g. 2x8 -> d0/d5/f17.bin (cycled over the leaves)."""
+    depth, fanout = (int(x) for x in shape.lower().split("x"))
+    leaves = [""]
+    for _ in range(depth):
+        leaves = [f"{leaf}d{i}/" for leaf in leaves for i in range(fanout)]
+    return [f"{leaves[i % len(leaves)]}f{i}.bin" for i in range(count)]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True,
+                              capture_output=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ─── Process tree sampling (/proc) ───────────────────────────────────────────
+
+def process_tree(root_pid):
+    """PIDs of root_pid and all its descendants."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [root_pid]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, ()))
+    return tree
+
+
+def rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class Sampler(threading.Thread):
+    """Samples the server's process tree: peak total RSS, peak process count, PIDs seen."""
+
+    def __init__(self, root_pid):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self._done    = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.peak_rss_kb   = 0
+        self.max_processes = 0
+        self.seen          = set()
+
+    def run(self):
+        while not self._done.wait(SAMPLE_INTERVAL):
+            pids = process_tree(self.root_pid)
+            self.peak_rss_kb   = max(self.peak_rss_kb, sum(rss_kb(pid) for pid in pids))
+            self.max_processes = max(self.max_processes, len(pids))
+            self.seen.update(pids)
+
+    def stop(self):
+        self._done.set()
+
+
+# ─── Server under test ───────────────────────────────────────────────────────
+
+class Server:
+    def __init__(self, variant, workdir, server_args):
+        self.script = os.path.join(ROOT, VARIANTS[variant][0])
+        self.port   = free_port()
+        self.log    = open(os.path.join(workdir, f"{variant}.log"), "wb")
+        env = dict(os.environ,
+                   CLIPBOARD_BACKEND="memory",
+                   CLIPBOARD_STATE_DIR=os.path.join(workdir, "state"),
+                   CLIPBOARD_STAGING_DIR=os.path.join(workdir, "staging"),
+                   PYTHONUNBUFFERED="1")
+        self.proc = subprocess.Popen(
+            [sys.executable, self.script, "--port", str(self.port), "--backend", "memory", *server_args],
+            cwd=ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def wait_ready(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"{self.script} exited with {self.proc.returncode}, see {self.log.name}")
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.5):
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"{self.script} did not open port {self.port} in {STARTUP_TIMEOUT}s")
+
+    def stop(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+            self.proc.wait(5)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+            self.proc.wait()
+        except ProcessLookupError:
+            pass
+        self.log.close()
+
+
+# ─── Scenarios ───────────────────────────────────────────────────────────────
+# build(ctx, size, n) -> (method, path, body, headers, expected statuses)
+
+def text_form(ctx, size, n):
+    # Different text every time, or the write scheduler would skip it as unchanged;
+    # the bulk is encoded once in prepare_context so the client stays cheap
+    return f"action=text&text={n}%3A".encode() + ctx["text_form"][size]
+
+
+SCENARIOS = {
+    "index": lambda ctx, size, n: ("GET", "/", None, {}, (200,)),
+    "get_clipboard": lambda ctx, size, n: ("GET", "/get_clipboard", None, {}, (200,)),
+    "get_clipboard_304": lambda ctx, size, n: (
+        "GET", "/get_clipboard", None, {"If-None-Match": ctx["etag"]}, (200, 304)),
+    "text": lambda ctx, size, n: (
+        "POST", "/", text_form(ctx, size, n), {"Content-Type": "application/x-www-form-urlencoded"}, (200,)),
+    "image": lambda ctx, size, n: (
+        "POST", "/", ctx["blob"][:size], {"Content-Type": "application/octet-stream"}, (200,)),
+    "send_to_files": lambda ctx, size, n: (
+        "POST", "/send_to_files",
+        json.dumps({"base_path": ctx["base_path"], "rel_path": ctx["paths"][n % len(ctx["paths"])],
+                    "data": ctx["data_uri"][size]}).encode(),
+        {"Content-Type": "application/json"}, (200,)),
+    "put_files": lambda ctx, size, n: (
+        "PUT", "/files/" + urllib.parse.quote(ctx["paths"][n % len(ctx["paths"])])
+               + "?base_path=" + urllib.parse.quote(ctx["base_path"]),
+        ctx["blob"][:size], {"Content-Type": "application/octet-stream"}, (200,)),
+}
+
+
+def prepare_context(port, workdir, sizes, tree):
+    blob = random.randbytes(max(sizes))
+    text = "".join(random.choices("abcdefghij klmnopqrstuvwxyz\n", k=max(sizes)))
+    ctx = {"blob": blob, "paths": tree_paths(tree),
+           "text_form": {size: urllib.parse.quote_plus(text[:size]).encode() for size in sizes},
+           "base_path": os.path.join(workdir, "files") + "/",
+           "data_uri": {size: "data:application/octet-stream;base64," + base64.b64encode(blob[:size]).decode()
+                        for size in sizes}}
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("GET", "/get_clipboard")
+        resp = conn.getresponse()
+        resp.read()
+        ctx["etag"] = resp.getheader("ETag") or '""'
+    except (OSError, http.client.HTTPException):
+        ctx["etag"] = '""'
+    finally:
+        conn.close()
+    return ctx
+
+
+def run_cell(port, scenario, ctx, size, concurrency, duration, sampler):
+    """Drive one scenario with `concurrency` threads for `duration` seconds."""
+    build = SCENARIOS[scenario]
+    latencies, errors, counter = [], [0], iter(range(10 ** 12))
+    lock = threading.Lock()
+    start_at = time.monotonic() + 0.2          # let every thread connect first
+    deadline = start_at + duration
+
+    def worker():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        mine, failed = [], 0
+        while time.monotonic() < start_at:
+            time.sleep(0.01)
+        while time.monotonic() < deadline:
+            with lock:
+                n = next(counter)
+            method, path, body, headers, expected = build(ctx, size, n)
+            t0 = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                ok = resp.status in expected
+            except (OSError, http.client.HTTPException):
+                ok = False
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            mine.append(time.perf_counter() - t0)
+            failed += not ok
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    sampler.reset()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        "scenario": scenario, "concurrency": concurrency,
+        "payload": size if scenario in PAYLOAD_SCENARIOS else None,
+        "requests": len(latencies), "errors": errors[0], "duration": duration,
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": ms(percentile(latencies, 0.50)), "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)), "max_ms": ms(latencies[-1] if latencies else None),
+        "peak_rss_kb": sampler.peak_rss_kb, "max_processes": sampler.max_processes,
+        "processes_seen": len(sampler.seen),
+    }
+
+
+def bench_variant(variant, args, sizes, concurrencies, scenarios):
+    results = []
+    with tempfile.TemporaryDirectory(prefix=f"bench-{variant}-") as workdir:
+        server = Server(variant, workdir, shlex.split(args.server_args))
+        try:
+            server.wait_ready()
+            ctx = prepare_context(server.port, workdir, sizes, args.tree)
+            sampler = Sampler(server.proc.pid)
+            sampler.start()
+            for scenario in scenarios:
+                for size in (sizes if scenario in PAYLOAD_SCENARIOS else [None]):
+                    for concurrency in concurrencies:
+                        row = {"variant": variant,
+                               **run_cell(server.port, scenario, ctx, size, concurrency,
+                                          args.duration, sampler)}
+                        print_row(row)
+                        results.append(row)
+            sampler.stop()
+        finally:
+            server.stop()
+    return results
+
+
+# ─── Reporting ───────────────────────────────────────────────────────────────
+
+def row_key(row):
+    return (row["variant"], row["scenario"], row["concurrency"], row["payload"])
+
+
+def print_row(row):
+    payload = format_size(row["payload"]) if row["payload"] else "-"
+    fmt = lambda v: "-" if v is None else f"{v:.1f}"
+    print(f"{row['variant']:<10} {row['scenario']:<18} c={row['concurrency']:<4} {payload:>6} "
+          f"{row['rps']:>9.1f} req/s  p50 {fmt(row['p50_ms']):>7}  p95 {fmt(row['p95_ms']):>7}  "
+          f"p99 {fmt(row['p99_ms']):>7} ms  err {row['errors']:<4} "
+          f"rss {row['peak_rss_kb'] // 1024} MiB  procs {row['max_processes']}/{row['processes_seen']}",
+          flush=True)
+
+
+def compare(results, baseline_path, threshold):
+    """Print throughput / p95 changes against a previous run; return the number of regressions."""
+    with open(baseline_path) as f:
+        baseline = {row_key(row): row for row in json.load(f)["results"]}
+    regressions = 0
+    print(f"\nCompared with {baseline_path} (threshold {threshold:.0%}):")
+    for row in results:
+        old = baseline.get(row_key(row))
+        if old is None or not old["rps"] or not old["p95_ms"] or row["p95_ms"] is None:
+            continue
+        rps_change = row["rps"] / old["rps"] - 1
+        p95_change = row["p95_ms"] / old["p95_ms"] - 1
+        worse = rps_change < -threshold or p95_change > threshold
+        regressions += worse
+        payload = format_size(row["payload"]) if row["payload"] else "-"
+        print(f"{'REGRESSION' if worse else 'ok':<10} {row['variant']:<10} {row['scenario']:<18} "
+              f"c={row['concurrency']:<4} {payload:>6}  rps {rps_change:+.1%}  p95 {p95_change:+.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the clipboard server variants.")
+    parser.add_argument("--variant", default="bsend",
+                        help=f"comma-separated, or 'all' ({', '.join(VARIANTS)})")
+    parser.add_argument("--scenarios", default=",".join(ALL_SCENARIOS),
+                        help="comma-separated subset of: " + ", ".join(ALL_SCENARIOS))
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated client counts")
+    parser.add_argument("--sizes", default="1k,64k,1m", help="payload sizes for upload scenarios")
+    parser.add_argument("--tree", default="2x8", help="file tree shape DEPTHxFANOUT for uploads")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds per measurement")
+    parser.add_argument("--server-args", default="", help='extra server arguments, e.g. "--workers 4"')
+    parser.add_argument("--out", help="result file (default bench_results/<time>-<variants>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed throughput drop / p95 growth before --compare fails")
+    args = parser.parse_args()
+
+    variants = list(VARIANTS) if args.variant == "all" else args.variant.split(",")
+    unknown = [v for v in variants if v not in VARIANTS]
+    if unknown:
+        parser.error(f"unknown variant(s): {', '.join(unknown)}")
+    wanted = args.scenarios.split(",")
+    sizes = [parse_size(s) for s in args.sizes.split(",")]
+    concurrencies = [int(c) for c in args.concurrency.split(",")]
+
+    results = []
+    for variant in variants:
+        scenarios = [s for s in wanted if s in VARIANTS[variant][1]]
+        results.extend(bench_variant(variant, args, sizes, concurrencies, scenarios))
+
+    out = args.out or os.path.join(ROOT, "bench_results",
+                                   time.strftime("%Y%m%d-%H%M%S") + "-" + "-".join(variants) + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({"meta": {"created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "revision": git_revision(),
+                            "python": platform.python_version(), "platform": platform.platform(),
+                            "cpus": os.cpu_count(), "args": vars(args)},
+                   "results": results}, f, indent=1)
+    print(f"\n[INFO] Results written to {out}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
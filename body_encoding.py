@@ -0,0 +1,129 @@
+"""Compressed request bodies: Content-Encoding gzip, deflate and zstd.
+
+DecodeRequestBody wraps a WSGI app. A request sent with Content-Encoding gets
+a wsgi.input that decompresses while it is being read, so nothing is inflated
+into memory up front. Content-Length (the compressed size) is dropped and
+wsgi.input_terminated is set, so Werkzeug reads to the end of the stream and
+applies max_content_length (limits.py) to the *decoded* bytes. The decoder
+itself also counts them against the route's limit, which limits.py sets
+through environ[DECODER_KEY] once the route is known, so a small gzip or
+zstd bomb gets the same 413 as a big plain upload and is stopped as soon as
+it crosses the limit.
+
+zstd needs the zstandard package (pip install zstandard); without it, as for
+any other unknown coding, the request is answered with 415.
+"""
+import io
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.wsgi import get_input_stream
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+READ_CHUNK  = 64 * 1024     # compressed bytes read per step, and max decoded bytes per piece
+ZSTD_SLICE  = 64            # compressed bytes per zstd call: at most ~2 MiB of output each
+DECODER_KEY = "body_encoding.decoder"
+
+
+class Decoder:
+    """Incremental decompressor; decode() yields pieces of at most READ_CHUNK bytes.
+
+    limit (None: no cap) is checked against the running decoded size, and
+    RequestEntityTooLarge raised as soon as a piece crosses it.
+    """
+
+    def __init__(self, coding, limit=None):
+        self.coding = coding
+        self.limit  = limit
+        self.size   = 0
+        if coding in ("gzip", "x-gzip"):
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif coding == "deflate":
+            self._zlib = zlib.decompressobj()
+        elif coding == "zstd" and zstandard is not None:
+            self._zlib = None
+            self._zstd = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise UnsupportedMediaType(f"Unsupported Content-Encoding: {coding}")
+
+    def decode(self, data):
+        for piece in self._pieces(data):
+            self.size += len(piece)
+            if self.limit is not None and self.size > self.limit:
+                raise RequestEntityTooLarge()
+            yield piece
+
+    def _pieces(self, data):
+        try:
+            if self._zlib is None:
+                # zstd has no max_length: feeding a few bytes at a time bounds the
+                # output of each call instead (a block needs >= 4 input bytes and
+                # decodes to <= 128 KiB)
+                for start in range(0, len(data), ZSTD_SLICE):
+                    out = self._zstd.decompress(data[start:start + ZSTD_SLICE])
+                    for offset in range(0, len(out), READ_CHUNK):
+                        yield out[offset:offset + READ_CHUNK]
+                return
+            # max_length keeps every piece small however well the input compresses
+            while data and not self._zlib.eof:
+                piece = self._zlib.decompress(data, READ_CHUNK)
+                data = self._zlib.unconsumed_tail
+                if piece:
+                    yield piece
+        except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)) as e:
+            raise BadRequest(f"Malformed {self.coding} body: {e}")
+
+    def finish(self):
+        """Called at the end of the input: a cut-off stream is an error, not a short file."""
+        if not (self._zstd if self._zlib is None else self._zlib).eof:
+            raise BadRequest(f"Truncated {self.coding} body")
+
+
+class DecodedInput(io.RawIOBase):
+    def __init__(self, raw, coding):
+        self.raw     = raw
+        self.decoder = Decoder(coding)
+        self.pieces  = iter(())
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            self.pending = next(self.pieces, b"")
+            if self.pending:
+                break
+            data = self.raw.read(READ_CHUNK)
+            if not data:
+                self.decoder.finish()
+                return 0
+            self.pieces = self.decoder.decode(data)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+class DecodeRequestBody:
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        coding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if coding and coding != "identity":
+            try:
+                decoded = DecodedInput(get_input_stream(environ, safe_fallback=True,
+                                                        max_content_length=None), coding)
+            except UnsupportedMediaType as e:
+                return e(environ, start_response)
+            environ["wsgi.input"] = io.BufferedReader(decoded, READ_CHUNK)
+            environ[DECODER_KEY] = decoded.decoder
+            environ["wsgi.input_terminated"] = True
+            environ.pop("CONTENT_LENGTH", None)
+            del environ["HTTP_CONTENT_ENCODING"]
+        return self.app(environ, start_response)
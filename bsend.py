@@ -1,21 +1,117 @@
-from flask import Flask, render_template_string, request, jsonify
-import pyperclip
+from flask import Flask, Response, request, jsonify
+from assets import Asset, page_response, register_assets
+from body_encoding import DecodeRequestBody
+from clipboard_backend import ClipboardWorker, ClipboardError, backend_from_argv
+from clipboard_state import ClipboardHistory, ClipboardState, SharedStore
+from limits import (MAX_FILE_BYTES, MAX_IMAGE_BYTES, MAX_JSON_FILE_BYTES,
+                    body_limit, configure as configure_limits, spool_body)
+from metrics import file_written, instrument
+from profiling import install as install_profiling
+from serving import serve, stream_slots
+from werkzeug.exceptions import HTTPException
+import json
+import log
 import os
-import pathlib
-import subprocess
+import shutil
 import sys
 import traceback
 
 app = Flask(__name__)
+configure_limits(app)               # 413 for oversized bodies, see limits.py
+app.wsgi_app = DecodeRequestBody(app.wsgi_app)      # Content-Encoding: gzip/deflate/zstd uploads
+install_profiling(app)              # X-Profile: cpu,mem, see profiling.py
+instrument(app)                     # GET /metrics, see metrics.py
+clipboard = ClipboardWorker()
+state_store = SharedStore()         # last_text + clipboard snapshot, shared by all workers
+clipboard_history = ClipboardHistory(store=state_store)     # per process: off with --workers > 1
+clipboard_state = ClipboardState(clipboard, clipboard_history, state_store)
 
-# Используем raw string (r""") чтобы Python не интерпретировал \r и \n в JavaScript коде
+# Only this shell is rendered per request; the CSS and JS below are served
+# from /assets/<name>.<hash>.<ext>, precompressed and cached by the browser
 HTML_TEMPLATE = r"""
 <!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <title>Clipboard Server</title>
-    <style>
+    <link rel="stylesheet" href="{{ css_url }}">
+</head>
+<body>
+    <h1>Clipboard Server</h1>
+    <div class="container">
+
+        <!-- Left: Send to Clipboard -->
+        <div class="section">
+            <h2>📋 Send to Clipboard</h2>
+            <form id="clip-form" method="POST" enctype="multipart/form-data">
+                <textarea id="clip-text" name="text" placeholder="Enter text..." autofocus></textarea>
+
+                <!-- CRLF→LF toggle -->
+                <div class="unix-row">
+                    <input type="checkbox" id="unix-convert" checked>
+                    <label for="unix-convert">
+                        <span class="unix-badge">CRLF→LF</span>
+                        Конвертировать переносы строк (Windows → Linux)
+                    </label>
+                </div>
+
+                <button type="submit" name="action" value="text">📋 Copy Text</button>
+            </form>
+
+            <p style="margin-top:18px; margin-bottom:4px;">Paste image here (Ctrl+V):</p>
+            <div id="paste_area" contenteditable="true"></div>
+        </div>
+
+        <!-- Right: Server Clipboard -->
+        <div class="section">
+            <h2>🖥️ Server Clipboard Content</h2>
+            <button id="refresh">🔄 Refresh</button>
+            <div id="clipboard_content">{{ last_text | e }}</div>
+            <button id="copy_clipboard">📋 Copy to Local Clipboard</button>
+            <button id="history_toggle">🕘 History</button>
+            <div id="history" style="display:none">
+                <div id="history_list"></div>
+                <button id="history_more">⬇️ More</button>
+            </div>
+        </div>
+
+        <!-- Send to files -->
+        <div class="section">
+            <h2>📤 Send to Files</h2>
+
+            <label style="font-size:13px; color:#555;">Target path on server:</label>
+            <div class="path-row">
+                <input type="text" id="target-path" value="/var/www/html/wordpress/files/" spellcheck="false">
+                <button onclick="resetPath()">↩️</button>
+            </div>
+
+            <div id="drop-zone">
+                <div class="icon">📥</div>
+                <div class="label"><strong>Drop files or folder here</strong></div>
+                <div class="sub">or click to select files</div>
+            </div>
+            <input type="file" id="file-input" multiple webkitdirectory>
+
+            <!-- Incremental sync toggle -->
+            <div class="unix-row">
+                <input type="checkbox" id="sync-mode">
+                <label for="sync-mode">
+                    <span class="unix-badge">SYNC</span>
+                    Пропускать неизменённые файлы
+                </label>
+            </div>
+
+            <div id="send-status">Status: Ready</div>
+        </div>
+
+    </div>
+
+    <script src="{{ js_url }}"></script>
+</body>
+</html>
+"""
+
+PAGE_CSS = """
         body { font-family: Arial, sans-serif; margin: 20px; background: #f4f4f4; }
         h1 { text-align: center; }
         .container { display: flex; gap: 20px; flex-wrap: wrap; justify-content: center; }
@@ -37,6 +133,14 @@ HTML_TEMPLATE = r"""
         #clipboard_content { white-space: pre-wrap; background: #f8f8f8; padding: 10px; border-radius: 5px; height: 200px; overflow-y: auto; border: 1px solid #eee; }
         #copy_clipboard { margin-top: 10px; }
 
+        /* --- Clipboard history --- */
+        #history { margin-top: 10px; max-height: 260px; overflow-y: auto; border: 1px solid #eee; border-radius: 5px; }
+        .history-item { display: flex; gap: 8px; align-items: center; padding: 5px 8px; border-bottom: 1px solid #f0f0f0; font-size: 13px; }
+        .history-item .preview { flex: 1; font-family: monospace; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; cursor: pointer; }
+        .history-item .meta { color: #888; font-size: 11px; white-space: nowrap; }
+        .history-item button { margin-top: 0; font-size: 13px; padding: 2px 8px; }
+        #history_more { font-size: 13px; padding: 4px 10px; margin: 6px 8px; }
+
         /* --- Send to files block --- */
         .path-row { display: flex; gap: 8px; align-items: center; margin-top: 10px; }
         .path-row input {
@@ -113,65 +217,38 @@ HTML_TEMPLATE = r"""
             border-radius: 4px;
             letter-spacing: 0.5px;
         }
-    </style>
-</head>
-<body>
-    <h1>Clipboard Server</h1>
-    <div class="container">
-
-        <!-- Left: Send to Clipboard -->
-        <div class="section">
-            <h2>📋 Send to Clipboard</h2>
-            <form id="clip-form" method="POST" enctype="multipart/form-data">
-                <textarea id="clip-text" name="text" placeholder="Enter text..." autofocus></textarea>
-
-                <!-- CRLF→LF toggle -->
-                <div class="unix-row">
-                    <input type="checkbox" id="unix-convert" checked>
-                    <label for="unix-convert">
-                        <span class="unix-badge">CRLF→LF</span>
-                        Конвертировать переносы строк (Windows → Linux)
-                    </label>
-                </div>
-
-                <button type="submit" name="action" value="text">📋 Copy Text</button>
-            </form>
-
-            <p style="margin-top:18px; margin-bottom:4px;">Paste image here (Ctrl+V):</p>
-            <div id="paste_area" contenteditable="true"></div>
-        </div>
-
-        <!-- Right: Server Clipboard -->
-        <div class="section">
-            <h2>🖥️ Server Clipboard Content</h2>
-            <button id="refresh">🔄 Refresh</button>
-            <div id="clipboard_content">{{ last_text | e }}</div>
-            <button id="copy_clipboard">📋 Copy to Local Clipboard</button>
-        </div>
-
-        <!-- Send to files -->
-        <div class="section">
-            <h2>📤 Send to Files</h2>
-
-            <label style="font-size:13px; color:#555;">Target path on server:</label>
-            <div class="path-row">
-                <input type="text" id="target-path" value="/var/www/html/wordpress/files/" spellcheck="false">
-                <button onclick="resetPath()">↩️</button>
-            </div>
+"""
 
-            <div id="drop-zone">
-                <div class="icon">📥</div>
-                <div class="label"><strong>Drop files or folder here</strong></div>
-                <div class="sub">or click to select files</div>
-            </div>
-            <input type="file" id="file-input" multiple webkitdirectory>
+# Используем raw string (r""") чтобы Python не интерпретировал \r и \n в JavaScript коде
+PAGE_JS = r"""
+    // ===== Compressed uploads =====
+    // Text and compressible files are gzipped in the browser (CompressionStream)
+    // and sent with Content-Encoding: gzip; the server inflates them while it
+    // reads. Without CompressionStream, or when gzip does not pay off, the data
+    // goes as is.
+    const COMPRESS_MIN  = 1024;
+    const canCompress   = typeof CompressionStream === 'function';
+    const PRECOMPRESSED = /\.(png|jpe?g|gif|webp|avif|heic|mp[34]|m4[av]|mkv|mov|webm|ogg|opus|flac|zip|gz|tgz|bz2|xz|zst|7z|rar|jar|apk|docx|xlsx|pptx|odt|pdf|woff2?)$/i;
 
-            <div id="send-status">Status: Ready</div>
-        </div>
+    function isCompressible(name, size) {
+        return canCompress && size >= COMPRESS_MIN && !PRECOMPRESSED.test(name);
+    }
 
-    </div>
+    // fetch() options {body, headers} for blob: gzipped if that saves at least 10%
+    async function compressedBody(blob, name, headers = {}) {
+        if (isCompressible(name, blob.size)) {
+            try {
+                const gz = await new Response(blob.stream().pipeThrough(new CompressionStream('gzip'))).blob();
+                if (gz.size < blob.size * 0.9) {
+                    return { body: gz, headers: { ...headers, 'Content-Encoding': 'gzip' } };
+                }
+            } catch (err) {
+                console.warn('Compression failed, sending uncompressed:', err);
+            }
+        }
+        return { body: blob, headers };
+    }
 
-    <script>
     // ===== CRLF→LF + отправка через fetch (не перезагружая страницу) =====
     document.getElementById('clip-form').addEventListener('submit', function(e) {
         e.preventDefault();  // останавливаем стандартную отправку формы
@@ -190,7 +267,11 @@ HTML_TEMPLATE = r"""
         fd.append('action', 'text');
         fd.append('text', text);
 
-        fetch('/', { method: 'POST', body: fd })
+        // Serialize the form to a multipart Blob so that it can be gzipped
+        const form = new Response(fd);
+        form.blob()
+            .then(blob => compressedBody(blob, 'text', { 'Content-Type': form.headers.get('Content-Type') }))
+            .then(req => fetch('/', { method: 'POST', ...req }))
             .then(r => {
                 console.log('Response received:', r.status);
                 return r.text();
@@ -242,16 +323,23 @@ HTML_TEMPLATE = r"""
     });
 
     // ===== Clipboard: refresh & copy =====
+    let clipVersion = -1;   // version shown in the panel; lets the server answer "unchanged"
+
     document.getElementById('refresh').addEventListener('click', () => {
         console.log('Refresh button clicked');
-        fetch('/get_clipboard')
+        fetch('/get_clipboard?since=' + clipVersion)
             .then(r => {
                 console.log('Clipboard fetch response:', r.status);
                 return r.json();
             })
             .then(data => { 
+                if (data.changed === false) {
+                    console.log('Clipboard unchanged');
+                    return;
+                }
                 console.log('Clipboard content received:', data.text.substring(0, 50) + '...');
                 document.getElementById('clipboard_content').textContent = data.text; 
+                if (data.version !== undefined) clipVersion = data.version;
             })
             .catch(err => {
                 console.error('Failed to fetch clipboard:', err);
@@ -259,6 +347,44 @@ HTML_TEMPLATE = r"""
             });
     });
 
+    // ===== Clipboard: live updates pushed by the server =====
+    // Each open stream holds a server thread, so a hidden tab closes its
+    // stream, and a stream the server refuses (503: too many open) is tried
+    // again later rather than given up.
+    const EVENTS_RETRY_MS = 30000;
+    let events = null, eventsRetry = null;
+
+    function openEvents() {
+        if (events || document.hidden) return;
+        events = new EventSource('/events?since=' + clipVersion);
+        events.addEventListener('clipboard', ev => {
+            const data = JSON.parse(ev.data);
+            console.log(`Clipboard changed (version ${data.version})`);
+            clipVersion = data.version;
+            document.getElementById('clipboard_content').textContent = data.text;
+        });
+        events.onerror = () => {
+            if (events.readyState !== EventSource.CLOSED) {
+                console.warn('Clipboard event stream lost, browser will reconnect');
+                return;
+            }
+            console.warn(`Clipboard event stream refused, retrying in ${EVENTS_RETRY_MS / 1000} s`);
+            closeEvents();
+            eventsRetry = setTimeout(openEvents, EVENTS_RETRY_MS);
+        };
+    }
+
+    function closeEvents() {
+        clearTimeout(eventsRetry);
+        if (events) events.close();
+        events = null;
+    }
+
+    if (window.EventSource) {
+        document.addEventListener('visibilitychange', () => document.hidden ? closeEvents() : openEvents());
+        openEvents();
+    }
+
     document.getElementById('copy_clipboard').addEventListener('click', () => {
         console.log('Copy to local clipboard button clicked');
         const text = document.getElementById('clipboard_content').textContent;
@@ -274,6 +400,92 @@ HTML_TEMPLATE = r"""
         }
     });
 
+    // ===== Clipboard history =====
+    const historyBox  = document.getElementById('history');
+    const historyList = document.getElementById('history_list');
+    const historyMore = document.getElementById('history_more');
+    let historyOffset = 0;
+
+    function formatSize(n) {
+        if (n < 1024) return n + ' B';
+        if (n < 1024 * 1024) return (n / 1024).toFixed(1) + ' KB';
+        return (n / 1024 / 1024).toFixed(1) + ' MB';
+    }
+
+    async function showHistoryEntry(e) {
+        const panel = document.getElementById('clipboard_content');
+        if (e.kind === 'text') {
+            const data = await (await fetch('/history/' + e.id)).json();
+            panel.textContent = data.text;
+        } else {
+            const img = document.createElement('img');
+            img.src = '/history/' + e.id;
+            img.style.maxWidth = '100%';
+            panel.replaceChildren(img);
+        }
+    }
+
+    function applyHistoryEntry(e) {
+        fetch(`/history/${e.id}/apply`, { method: 'POST' })
+            .then(r => r.json())
+            .then(data => {
+                if (data.error) alert('Failed to apply: ' + data.error);
+                else console.log(`History entry ${e.id} copied to server clipboard`);
+            })
+            .catch(err => alert('Failed to apply: ' + err));
+    }
+
+    function historyRow(e) {
+        const row = document.createElement('div');
+        row.className = 'history-item';
+
+        const preview = document.createElement('span');
+        preview.className = 'preview';
+        preview.textContent = e.kind === 'text' ? e.preview : `🖼️ ${e.mime}`;
+        preview.title = 'Show in panel';
+        preview.addEventListener('click', () => showHistoryEntry(e));
+
+        const meta = document.createElement('span');
+        meta.className = 'meta';
+        meta.textContent = `${new Date(e.created * 1000).toLocaleTimeString()} · ${formatSize(e.size)}`;
+
+        const apply = document.createElement('button');
+        apply.textContent = '📋';
+        apply.title = 'Copy to server clipboard again';
+        apply.addEventListener('click', () => applyHistoryEntry(e));
+
+        row.append(preview, meta, apply);
+        return row;
+    }
+
+    async function loadHistory(reset) {
+        if (reset) {
+            historyOffset = 0;
+            historyList.replaceChildren();
+        }
+        try {
+            const res  = await fetch(`/history?offset=${historyOffset}&limit=20`);
+            const data = await res.json();
+            if (!res.ok) {
+                historyList.textContent = data.error;
+                historyMore.style.display = 'none';
+                return;
+            }
+            for (const e of data.entries) historyList.appendChild(historyRow(e));
+            historyOffset += data.entries.length;
+            historyMore.style.display = historyOffset < data.total ? '' : 'none';
+        } catch (err) {
+            console.error('Failed to load history:', err);
+        }
+    }
+
+    document.getElementById('history_toggle').addEventListener('click', () => {
+        const hidden = historyBox.style.display === 'none';
+        historyBox.style.display = hidden ? '' : 'none';
+        if (hidden) loadHistory(true);
+    });
+    historyMore.addEventListener('click', () => loadHistory(false));
+
     function fallbackCopy(text) {
         console.log('Using fallback copy method');
         const ta = document.createElement('textarea');
@@ -325,19 +537,16 @@ HTML_TEMPLATE = r"""
         const items = e.dataTransfer.items;
         if (!items) return;
 
-        setStatus('⏳ Reading files...');
-        const allFiles = [];
+        // Uploads start while the folder is still being walked; add() waits
+        // whenever UPLOAD_CONCURRENCY requests are in flight
+        const pipeline = uploadPipeline();
 
         async function traverse(entry) {
             if (entry.isFile) {
+                // Keep the File handle only — its bytes are streamed by fetch()
                 const file = await new Promise(res => entry.file(res));
-                const buf  = await new Promise(res => {
-                    const r = new FileReader();
-                    r.onload = ev => res(ev.target.result);
-                    r.readAsDataURL(file);           // base64 — handles binary too
-                });
                 let p = entry.fullPath.startsWith('/') ? entry.fullPath.substring(1) : entry.fullPath;
-                allFiles.push({ path: p, data: buf });
+                await pipeline.add({ path: p, file: file });
             } else if (entry.isDirectory) {
                 const reader = entry.createReader();
                 let batch;
@@ -348,79 +557,371 @@ HTML_TEMPLATE = r"""
             }
         }
 
-        const tasks = [];
+        // Collect the entries first: the DataTransfer is emptied once this handler yields
+        const entries = [];
         for (let i = 0; i < items.length; i++) {
             const entry = items[i].webkitGetAsEntry();
-            if (entry) tasks.push(traverse(entry));
+            if (entry) entries.push(entry);
         }
-        await Promise.all(tasks);
-
-        console.log(`Found ${allFiles.length} files`);
-        await uploadFiles(allFiles);
+        await Promise.all(entries.map(traverse));
+        await pipeline.finish();
     });
 
     fileInput.addEventListener('change', async () => {
         const files = fileInput.files;
         if (!files.length) return;
         console.log(`Selected ${files.length} files`);
-        setStatus('⏳ Reading files...');
-        const allFiles = [];
+        const pipeline = uploadPipeline();
         for (const file of files) {
-            const buf = await new Promise(res => {
-                const r = new FileReader();
-                r.onload = ev => res(ev.target.result);
-                r.readAsDataURL(file);
-            });
-            allFiles.push({ path: file.webkitRelativePath || file.name, data: buf });
+            await pipeline.add({ path: file.webkitRelativePath || file.name, file: file });
         }
-        await uploadFiles(allFiles);
         fileInput.value = '';   // reset so same folder can be dropped again
+        await pipeline.finish();
     });
 
-    async function uploadFiles(allFiles) {
-        const basePath = pathInput.value.replace(/\/?$/, '/');
-        setStatus(`🚀 Uploading ${allFiles.length} file(s) to ${basePath}...\n`);
-        console.log(`Uploading ${allFiles.length} files to ${basePath}`);
+    // "dir/my file.txt" -> "dir/my%20file.txt" (keep the slashes)
+    function encodePath(p) {
+        return p.split('/').map(encodeURIComponent).join('/');
+    }
+
+    // ===== Batch upload: many small files -> one tar stream =====
+    // Small files are packed into a tar (ustar + PAX for long names) built from
+    // Blob parts, so nothing is read into memory; big files go one by one.
+    const BATCH_FILE_MAX  = 4 * 1024 * 1024;    // files above this are sent alone
+    const BATCH_MAX_FILES = 250;                // kept small enough that batches run in parallel
+    const BATCH_MAX_BYTES = 16 * 1024 * 1024;
+    const te = new TextEncoder();
+
+    function tarHeader(name, size, type, mtime) {
+        const h = new Uint8Array(512);
+        const put = (str, off, len) => h.set(te.encode(str).subarray(0, len), off);
+        const oct = (n, off, len) => put(n.toString(8).padStart(len - 1, '0'), off, len - 1);
+        put(name, 0, 100);
+        oct(0o644, 100, 8);                     // mode
+        oct(0, 108, 8);                         // uid
+        oct(0, 116, 8);                         // gid
+        oct(Math.min(size, 0o77777777777), 124, 12);
+        oct(Math.floor((mtime || Date.now()) / 1000), 136, 12);
+        h.fill(32, 148, 156);                   // checksum is computed with spaces here
+        put(type, 156, 1);
+        put('ustar', 257, 6);
+        put('00', 263, 2);
+        let sum = 0;
+        for (const b of h) sum += b;
+        put(sum.toString(8).padStart(6, '0') + '\0 ', 148, 8);
+        return h;
+    }
+
+    function tarPad(size) {
+        return new Uint8Array((512 - size % 512) % 512);
+    }
 
+    // PAX record "<len> key=value\n", where <len> counts itself too
+    function paxRecord(key, value) {
+        const body = ` ${key}=${value}\n`;
+        const len = te.encode(body).length;
+        let n = len + String(len).length;
+        while (n !== len + String(n).length) n = len + String(n).length;
+        return n + body;
+    }
+
+    function tarEntry(path, file, sha256) {
+        const parts = [];
+        let pax = '';
+        if (te.encode(path).length > 100) pax += paxRecord('path', path);
+        if (file.size > 0o77777777777) pax += paxRecord('size', String(file.size));
+        if (sha256) pax += paxRecord('CLIPBOARD.sha256', sha256);     // verified by the server
+        if (pax) {
+            const pb = te.encode(pax);
+            parts.push(tarHeader('PaxHeader', pb.length, 'x'), pb, tarPad(pb.length));
+        }
+        parts.push(tarHeader(path, file.size, '0', file.lastModified), file, tarPad(file.size));
+        return parts;
+    }
+
+    function buildTar(files) {
+        const parts = [];
+        for (const f of files) parts.push(...tarEntry(f.path, f.file, f.sha256));
+        parts.push(new Uint8Array(1024));       // end-of-archive marker
+        return new Blob(parts, { type: 'application/x-tar' });
+    }
+
+    async function uploadBatch(batch, basePath) {
         let ok = 0, fail = 0;
-        for (const f of allFiles) {
+        try {
+            // Gzip the tar only if most of it is compressible
+            const tar = buildTar(batch);
+            const compressible = batch.reduce((n, f) => n + (PRECOMPRESSED.test(f.path) ? 0 : f.file.size), 0);
+            const headers = { 'Content-Type': 'application/x-tar' };
+            const req = compressible * 2 >= tar.size ? await compressedBody(tar, 'batch.tar', headers)
+                                                     : { body: tar, headers };
+            const res = await fetch('/send_batch?base_path=' + encodeURIComponent(basePath), {
+                method: 'POST',
+                ...req
+            });
+            const json = await res.json();
+            for (const r of (json.results || [])) {
+                if (r.saved) { ok++; statusBox.innerText += `  ✅ ${r.saved}\n`; }
+                else         { fail++; statusBox.innerText += `  ❌ ${r.path} — ${r.error}\n`; }
+            }
+            if (!res.ok) {
+                const missing = batch.length - ok - fail;
+                fail += missing;
+                statusBox.innerText += `  ❌ batch of ${batch.length} — ${json.error}\n`;
+            }
+            console.log(`Batch uploaded: ${ok} saved, ${fail} failed`);
+        } catch (err) {
+            fail = batch.length - ok;
+            statusBox.innerText += `  ❌ batch of ${batch.length} — ${err}\n`;
+            console.error('Batch upload failed:', err);
+        }
+        return { ok, fail };
+    }
+
+    async function uploadSingle(f, basePath) {
+        try {
+            if (f.file.size >= RESUMABLE_MIN) {
+                const json = await uploadResumable(f, basePath);
+                statusBox.innerText += `  ✅ ${json.saved}\n`;
+                console.log(`Uploaded: ${json.saved}`);
+                return true;
+            }
+            // Raw body (gzipped if compressible): no base64, no JSON
+            const headers = { 'Content-Type': 'application/octet-stream' };
+            if (f.sha256) headers['X-Checksum-SHA256'] = f.sha256;
+            const req = await compressedBody(f.file, f.path, headers);
+            const res = await fetch('/files/' + encodePath(f.path) + '?base_path=' + encodeURIComponent(basePath)
+                                    + '&mtime=' + f.file.lastModified / 1000, {
+                method: 'PUT',
+                ...req
+            });
+            const json = await res.json();
+            if (res.ok) {
+                statusBox.innerText += `  ✅ ${json.saved}\n`;
+                console.log(`Uploaded: ${json.saved}`);
+                return true;
+            }
+            statusBox.innerText += `  ❌ ${f.path} — ${json.error}\n`;
+            console.error(`Failed to upload ${f.path}:`, json.error);
+        } catch (err) {
+            statusBox.innerText += `  ❌ ${f.path} — ${err}\n`;
+            console.error(`Error uploading ${f.path}:`, err);
+        }
+        return false;
+    }
+
+    // ===== Resumable upload for big files =====
+    // The upload id is remembered in localStorage, so a failed transfer (or a
+    // page reload) continues from the server's offset instead of from zero.
+    const RESUMABLE_MIN     = 16 * 1024 * 1024;
+    const RESUMABLE_CHUNK   = 8 * 1024 * 1024;
+    const RESUMABLE_RETRIES = 6;
+    const sleep = ms => new Promise(res => setTimeout(res, ms));
+
+    function resumeKey(f, basePath) {
+        return `upload:${basePath}${f.path}:${f.file.size}:${f.file.lastModified}`;
+    }
+
+    async function serverOffset(id) {
+        const res = await fetch('/uploads/' + id);
+        if (!res.ok) return null;
+        return (await res.json()).offset;
+    }
+
+    async function uploadResumable(f, basePath) {
+        const key  = resumeKey(f, basePath);
+        const size = f.file.size;
+        let id = localStorage.getItem(key);
+        let offset = id ? await serverOffset(id) : null;
+
+        if (offset === null) {
+            const res = await fetch('/uploads', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ base_path: basePath, rel_path: f.path, size: size,
+                                       mtime: f.file.lastModified / 1000, sha256: f.sha256 })
+            });
+            const json = await res.json();
+            if (!res.ok) throw new Error(json.error);
+            if (json.saved) return json;
+            id = json.upload_id;
+            offset = 0;
+            localStorage.setItem(key, id);
+        } else {
+            console.log(`Resuming ${f.path} at ${offset} of ${size} bytes`);
+        }
+
+        let retries = 0;
+        while (true) {
+            const end = Math.min(offset + RESUMABLE_CHUNK, size);
             try {
-                const res = await fetch('/send_to_files', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ base_path: basePath, rel_path: f.path, data: f.data })
-                });
+                // Content-Range counts uncompressed bytes; the chunk itself may be gzipped
+                const req = await compressedBody(f.file.slice(offset, end), f.path,
+                                                 { 'Content-Range': `bytes ${offset}-${end - 1}/${size}` });
+                const res = await fetch('/uploads/' + id, { method: 'PUT', ...req });
                 const json = await res.json();
-                if (res.ok) {
-                    ok++;
-                    statusBox.innerText += `  ✅ ${json.saved}\n`;
-                    console.log(`Uploaded: ${json.saved}`);
-                } else {
-                    fail++;
-                    statusBox.innerText += `  ❌ ${f.path} — ${json.error}\n`;
-                    console.error(`Failed to upload ${f.path}:`, json.error);
+                if (res.status === 409 && json.offset !== undefined) {
+                    offset = json.offset;       // server is ahead/behind us: follow it
+                    continue;
+                }
+                if (!res.ok) throw new Error(json.error);
+                retries = 0;
+                if (json.saved) {
+                    localStorage.removeItem(key);
+                    return json;
                 }
+                offset = json.offset;
+                console.log(`${f.path}: ${Math.floor(offset * 100 / size)}%`);
             } catch (err) {
-                fail++;
-                statusBox.innerText += `  ❌ ${f.path} — ${err}\n`;
-                console.error(`Error uploading ${f.path}:`, err);
+                if (++retries > RESUMABLE_RETRIES) throw err;
+                console.warn(`Chunk of ${f.path} failed (${err}), retry ${retries}...`);
+                await sleep(500 * 2 ** retries);
+                const o = await serverOffset(id).catch(() => undefined);
+                if (o === null) { localStorage.removeItem(key); throw new Error('upload expired on server'); }
+                if (o !== undefined) offset = o;
             }
         }
-        statusBox.innerText += `\n✨ Done: ${ok} saved, ${fail} failed.`;
-        console.log(`Upload complete: ${ok} saved, ${fail} failed`);
+    }
+
+    // ===== Sync: send only files that differ from the server copy =====
+    const SYNC_HASH_MAX = 32 * 1024 * 1024;     // hash in the browser only below this
+
+    async function sha256Hex(file) {
+        const buf = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(buf), b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function filterUnchanged(allFiles, basePath) {
+        // crypto.subtle exists only on https/localhost; size+mtime is enough otherwise
+        const canHash = !!(window.crypto && crypto.subtle);
+        const manifest = [];
+        for (const f of allFiles) {
+            const e = { path: f.path, size: f.file.size, mtime: f.file.lastModified / 1000 };
+            // The hash also goes with the upload, so the server verifies what it wrote
+            if (canHash && f.file.size <= SYNC_HASH_MAX) e.sha256 = f.sha256 = await sha256Hex(f.file);
+            manifest.push(e);
+        }
+        const body = new Blob([JSON.stringify({ base_path: basePath, files: manifest })]);
+        const req  = await compressedBody(body, 'manifest.json', { 'Content-Type': 'application/json' });
+        const res  = await fetch('/sync_manifest', { method: 'POST', ...req });
+        const json = await res.json();
+        if (!res.ok) throw new Error(json.error);
+        for (const e of json.errors) statusBox.innerText += `  ❌ ${e.path} — ${e.error}\n`;
+        const needed = new Set(json.needed);
+        return { files: allFiles.filter(f => needed.has(f.path)), failed: json.errors.length,
+                 unchanged: json.unchanged };
+    }
+
+    // ===== Upload pipeline: bounded concurrency, fed while files are found =====
+    // Small files are grouped into tar batches, big ones go alone; each batch
+    // or file is dispatched as soon as it is complete, with at most
+    // UPLOAD_CONCURRENCY requests in flight. Browsers allow ~6 connections per
+    // host over HTTP/1.1 and one of them is the clipboard event stream.
+    const UPLOAD_CONCURRENCY = 4;
+
+    function uploadPipeline() {
+        const basePath = pathInput.value.replace(/\/?$/, '/');
+        const sync     = document.getElementById('sync-mode').checked;
+        const running  = new Set();
+        let group = [], groupBytes = 0, seen = 0;
+        let ok = 0, fail = 0, unchanged = 0;
+        setStatus(`🚀 Uploading to ${basePath}...\n`);
+
+        async function send(files, single) {
+            if (sync) {
+                try {
+                    const r = await filterUnchanged(files, basePath);
+                    files = r.files;
+                    fail += r.failed;
+                    unchanged += r.unchanged;
+                } catch (err) {
+                    statusBox.innerText += `  ⚠️ sync manifest failed (${err}), sending everything\n`;
+                    console.error('Sync manifest failed:', err);
+                }
+            }
+            if (!files.length) return;
+            if (single) {
+                if (await uploadSingle(files[0], basePath)) ok++; else fail++;
+            } else {
+                const r = await uploadBatch(files, basePath);
+                ok += r.ok;
+                fail += r.fail;
+            }
+        }
+
+        async function dispatch(files, single) {
+            while (running.size >= UPLOAD_CONCURRENCY) await Promise.race(running);
+            const task = send(files, single)
+                .catch(err => { fail += files.length; console.error('Upload failed:', err); })
+                .finally(() => running.delete(task));
+            running.add(task);
+        }
+
+        async function flushGroup() {
+            if (!group.length) return;
+            const files = group;
+            group = []; groupBytes = 0;
+            await dispatch(files, false);
+        }
+
+        return {
+            async add(f) {
+                seen++;
+                if (f.file.size > BATCH_FILE_MAX) return dispatch([f], true);
+                if (group.length >= BATCH_MAX_FILES || groupBytes + f.file.size > BATCH_MAX_BYTES) {
+                    await flushGroup();
+                }
+                group.push(f);
+                groupBytes += f.file.size;
+            },
+            async finish() {
+                await flushGroup();
+                await Promise.all(running);
+                if (unchanged) statusBox.innerText += `  ⏭️ ${unchanged} unchanged file(s) skipped\n`;
+                statusBox.innerText += `\n✨ Done: ${seen} file(s), ${ok} saved, ${fail} failed.`;
+                console.log(`Upload complete: ${ok} saved, ${fail} failed`);
+            }
+        };
     }
 
     console.log('Clipboard server initialized');
-    </script>
-</body>
-</html>
 """
 
-last_text = ""
+css_asset = Asset("bsend.css", PAGE_CSS, "text/css")
+js_asset  = Asset("bsend.js", PAGE_JS, "text/javascript")
+register_assets(app, css_asset, js_asset)
+page_template = app.jinja_env.from_string(HTML_TEMPLATE)     # compiled once
+
+
+def render_page():
+    return page_template.render(last_text=state_store.get("last_text", ""),
+                                css_url=css_asset.url, js_url=js_asset.url)
+
+
+# set_text/set_image return False when a newer write replaced this one before
+# it reached the clipboard (see ClipboardWorker): the newer caller publishes
+def copy_text(text):
+    if clipboard.set_text(text):
+        state_store.set("last_text", text)
+        clipboard_state.publish(text)       # also records it in clipboard_history
+
+
+def copy_image(data, mime="image/png"):
+    """data is bytes or a spooled temp file (see limits.spool_body)."""
+    if clipboard.set_image(data, mime):
+        clipboard_state.publish("", force=True)     # no text on the clipboard now
+        if not isinstance(data, bytes):
+            # Too big for the history budget: do not pull it into memory at all
+            if os.fstat(data.fileno()).st_size > clipboard_history.max_bytes:
+                return
+            data.seek(0)
+            data = data.read()
+        clipboard_history.add(data, mime)
+
 
 @app.route("/", methods=["GET", "POST"])
+@body_limit(MAX_IMAGE_BYTES)
 def index():
-    global last_text
     try:
         if request.method == "POST":
             if request.form.get("action") == "text":
@@ -428,70 +929,417 @@ def index():
                 if text:
                     # Конвертируем CRLF→LF на сервере (надёжнее чем в JS)
                     text = text.replace('\r\n', '\n').replace('\r', '\n')
-                    pyperclip.copy(text)
-                    last_text = text
-                    print(f"[INFO] Text copied to clipboard: {len(text)} characters")
+                    copy_text(text)
+                    log.info("text_copied", chars=len(text))
             else:
-                if request.data:
-                    filepath = '/tmp/uploaded_image.png'
-                    with open(filepath, 'wb') as f:
-                        f.write(request.data)
-
-                    display = os.environ.get('DISPLAY', ':0')
-                    xauth = pathlib.Path.home() / '.Xauthority'
-                    env = os.environ.copy()
-                    env['DISPLAY'] = display
-                    env['XAUTHORITY'] = str(xauth)
-
-                    if subprocess.run(['which', 'xclip'], capture_output=True).returncode != 0:
-                        print("[ERROR] xclip not installed")
-                        return "xclip not installed", 500
-
-                    result = subprocess.run(
-                        ['xclip', '-selection', 'clipboard', '-t', 'image/png', '-i', filepath],
-                        env=env, capture_output=True, text=True
-                    )
-                    if result.returncode != 0:
-                        print(f"[ERROR] Failed to copy image: {result.stderr}")
-                        return f"Failed to copy image to clipboard:\n{result.stderr}", 500
-
-                    print("[INFO] Image uploaded and copied to clipboard")
+                data, size = spool_body(request.stream)
+                if size:
+                    try:
+                        copy_image(data)
+                    except ClipboardError as e:
+                        log.error("image_copy_failed", error=str(e))
+                        return f"Failed to copy image to clipboard:\n{e}", 500
+                    finally:
+                        if not isinstance(data, bytes):
+                            data.close()
+
+                    log.info("image_copied", size=size)
                     return "Image uploaded and copied to clipboard!", 200
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"[ERROR] Server error: {traceback.format_exc()}")
+        log.error("server_error", exc=e)
         return f"Server error:\n{traceback.format_exc()}", 500
 
-    return render_template_string(HTML_TEMPLATE, last_text=last_text)
+    return page_response(render_page())
 
 
+# Served from clipboard_state: the clipboard itself is read at most once per
+# poll interval. ETag is the content hash, so unchanged polls get a bare 304;
+# ?since=<version> does the same for clients that track versions instead.
 @app.route("/get_clipboard", methods=["GET"])
 def get_clipboard():
     try:
-        text = pyperclip.paste()
-        print(f"[INFO] Clipboard content requested: {len(text)} characters")
-        return jsonify({"text": text})
+        snap = clipboard_state.fresh()
+
+        if request.if_none_match.contains(snap.digest):
+            return Response(status=304, headers={"ETag": f'"{snap.digest}"', "Cache-Control": "no-cache"})
+        if request.args.get("since", type=int) == snap.version:
+            return jsonify({"version": snap.version, "changed": False})
+
+        log.info("clipboard_read", chars=len(snap.text))
+        resp = jsonify({**snapshot_json(snap), "changed": True})
+        resp.set_etag(snap.digest)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
     except Exception as e:
-        print(f"[ERROR] Failed to get clipboard: {str(e)}")
+        log.error("clipboard_read_failed", error=str(e))
         return jsonify({"text": f"Error: {str(e)}"})
 
 
+# ─── Push: clipboard change notifications ────────────────────────────────────
+#   GET /events                           Server-Sent Events, one "clipboard" event per change
+#   GET /wait_clipboard?since=<v>&timeout=<s>   long-poll fallback
+# Both are fed from clipboard_state, so N clients cost one clipboard read per
+# poll interval rather than N.
+SSE_KEEPALIVE     = 15      # seconds between ": keepalive" comments
+LONG_POLL_TIMEOUT = 30      # upper bound for ?timeout=
+
+
+def snapshot_json(snap):
+    return {"version": snap.version, "hash": snap.digest, "text": snap.text}
+
+
+def streams_full(route):
+    # Every open stream holds a server thread: past the cap, refuse rather
+    # than leave no thread for ordinary requests
+    log.warn("stream_refused", route=route, limit=stream_slots.limit)
+    return jsonify({"error": "Too many open event streams"}), 503, {"Retry-After": "30"}
+
+
+@app.route("/events", methods=["GET"])
+def clipboard_events():
+    if not stream_slots.acquire():
+        return streams_full("/events")
+    # A reconnecting EventSource sends the last id it saw; it is newer than
+    # the ?since= the stream was first opened with
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", type=int)
+
+    def stream():
+        version = -1 if since is None else since
+        with clipboard_state.subscribe():
+            while True:
+                snap = clipboard_state.wait(version, SSE_KEEPALIVE)
+                if snap.version == version:
+                    yield ": keepalive\n\n"
+                    continue
+                version = snap.version
+                yield f"id: {version}\nevent: clipboard\ndata: {json.dumps(snapshot_json(snap))}\n\n"
+
+    log.info("event_stream_opened")
+    rv = Response(stream(), mimetype="text/event-stream",
+                  headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    rv.call_on_close(stream_slots.release)      # the server closes it when the client goes
+    return rv
+
+
+@app.route("/wait_clipboard", methods=["GET"])
+def wait_clipboard():
+    since   = request.args.get("since", -1, type=int)
+    timeout = min(request.args.get("timeout", LONG_POLL_TIMEOUT, type=float), LONG_POLL_TIMEOUT)
+    if not stream_slots.acquire():
+        return streams_full("/wait_clipboard")
+    try:
+        with clipboard_state.subscribe():
+            snap = clipboard_state.wait(since, timeout)
+    finally:
+        stream_slots.release()
+    if snap.version == since:
+        return jsonify({"version": since, "changed": False})
+    return jsonify({**snapshot_json(snap), "changed": True})
+
+
+# ─── Clipboard history ───────────────────────────────────────────────────────
+#   GET  /history?offset=&limit=     newest (most recently used) first
+#   GET  /history/<id>               text as JSON, images as raw bytes
+#   POST /history/<id>/apply         put the entry back on the clipboard
+# The history is kept in this process only: with several workers the routes
+# answer 501 instead of showing a different list (and ids) per worker.
+HISTORY_PAGE_MAX = 100
+
+
+@app.before_request
+def history_available():
+    if request.path.startswith("/history") and not clipboard_history.enabled:
+        return jsonify({"error": "History is not available with several workers"}), 501
+
+
+@app.route("/history", methods=["GET"])
+def history_list():
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit  = min(max(request.args.get("limit", 20, type=int), 1), HISTORY_PAGE_MAX)
+    entries, total = clipboard_history.page(offset, limit)
+    return jsonify({"entries": entries, "total": total, "offset": offset,
+                    "bytes": clipboard_history.bytes})
+
+
+@app.route("/history/<int:entry_id>", methods=["GET"])
+def history_entry(entry_id):
+    entry = clipboard_history.get(entry_id)
+    if entry is None:
+        return jsonify({"error": "unknown history entry"}), 404
+    if entry.mime.startswith("text/"):
+        return jsonify({**entry.meta(), "text": entry.content().decode("utf-8", "surrogatepass")})
+    return Response(entry.content(), mimetype=entry.mime)
+
+
+@app.route("/history/<int:entry_id>/apply", methods=["POST"])
+def history_apply(entry_id):
+    entry = clipboard_history.use(entry_id)
+    if entry is None:
+        return jsonify({"error": "unknown history entry"}), 404
+    try:
+        if entry.mime.startswith("text/"):
+            copy_text(entry.content().decode("utf-8", "surrogatepass"))
+        else:
+            copy_image(entry.content(), entry.mime)
+    except ClipboardError as e:
+        log.error("history_apply_failed", entry=entry_id, error=str(e))
+        return jsonify({"error": str(e)}), 500
+    log.info("history_applied", entry=entry_id)
+    return jsonify({"applied": entry_id}), 200
+
+
+# Write scheduler counters: writes requested, sent to the backend, coalesced
+# into a newer write, or skipped because the clipboard already held the content
+@app.route("/clipboard_stats", methods=["GET"])
+def clipboard_stats():
+    return jsonify(clipboard.stats)
+
+
 # ─── New endpoint: save file to disk ─────────────────────────────────────────
-import base64, mimetypes
+import base64, hashlib, mimetypes, uuid
+
+DEFAULT_BASE_PATH = "/var/www/html/wordpress/files/"
+UPLOAD_CHUNK_SIZE = 1024 * 1024     # 1 MiB per read from the request stream
+
+# What a saved file survives (CLIPBOARD_DURABILITY):
+#   none   renamed into place, written out whenever the kernel likes (fastest;
+#          after a power loss recent files may be missing or empty)
+#   file   fsync each file before its rename and its directory after it
+#   batch  as "file" for single uploads; a /send_batch request fsyncs its files
+#          back to back at the end, renames them, then fsyncs each directory once
+DURABILITY = os.environ.get("CLIPBOARD_DURABILITY", "batch")
+if DURABILITY not in ("none", "file", "batch"):
+    sys.exit(f"[ERROR] CLIPBOARD_DURABILITY must be none, file or batch, not {DURABILITY!r}")
+
+# Saved files are hashed while they are written (CLIPBOARD_CHECKSUM: sha256,
+# blake2b or none) and the hex digest is returned next to "saved". A client
+# may send the digest it expects — an X-Checksum-SHA256 / X-Checksum-BLAKE2b
+# header or ?sha256= for PUT /files, a "sha256" / "blake2b" field in the JSON
+# of /send_to_files and POST /uploads, a CLIPBOARD.sha256 PAX record in a
+# /send_batch tar — and a file that does not match is discarded (422).
+CHECKSUM_ALGORITHMS = ("sha256", "blake2b")
+CHECKSUM = os.environ.get("CLIPBOARD_CHECKSUM", "sha256")
+if CHECKSUM not in CHECKSUM_ALGORITHMS + ("none",):
+    sys.exit(f"[ERROR] CLIPBOARD_CHECKSUM must be sha256, blake2b or none, not {CHECKSUM!r}")
+
+
+class ChecksumMismatch(Exception):
+    def __init__(self, checksum):
+        super().__init__(f"{checksum.algorithm} mismatch")
+        self.checksum = checksum
+
+    def json(self):
+        return {"error": "Checksum mismatch", "expected": self.checksum.expected,
+                **self.checksum.fields()}
+
+
+class Checksum:
+    """Running digest of a file being written; algorithm None computes nothing."""
+
+    def __init__(self, algorithm=None, expected=None):
+        self.algorithm = algorithm
+        self.expected  = expected
+        self.hash      = hashlib.new(algorithm) if algorithm else None
+
+    @classmethod
+    def requested(cls, get):
+        """Checksum for the digest a client sent; get(algorithm) looks it up (header, field...)."""
+        for algorithm in CHECKSUM_ALGORITHMS:
+            value = get(algorithm)
+            if value:
+                return cls(algorithm, str(value).strip().lower())
+        return cls.default()
+
+    @classmethod
+    def default(cls):
+        return cls(None if CHECKSUM == "none" else CHECKSUM)
+
+    def update(self, data):
+        if self.hash is not None:
+            self.hash.update(data)
+
+    def verify(self):
+        if self.expected and self.hash.hexdigest() != self.expected:
+            raise ChecksumMismatch(self)
+
+    def fields(self):
+        """{"sha256": "<hex>"} for the JSON response, or {} if nothing was computed."""
+        return {self.algorithm: self.hash.hexdigest()} if self.hash is not None else {}
+
+
+def resolve_target(base_path, rel_path):
+    """Join rel_path onto base_path; return None if the result escapes base_path."""
+    # Build full path safely (strip leading / from rel_path)
+    rel_path  = rel_path.lstrip("/")
+    base      = os.path.normpath(base_path)
+    full_path = os.path.normpath(os.path.join(base, rel_path))
+
+    # Security: make sure the resolved path is still inside base_path
+    if full_path == base or not full_path.startswith(base.rstrip(os.sep) + os.sep):
+        return None
+    return full_path
+
+
+def apply_mtime(full_path, mtime):
+    """Give the saved file the client's mtime so later syncs can compare it."""
+    if mtime is not None:
+        os.utime(full_path, (mtime, mtime))
+
+
+def sync_dir(path):
+    """fsync a directory, making the renames done in it durable."""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ReplacingFile:
+    """A new version of full_path, written under a unique temp name beside it.
+
+    commit() renames it into place, discard() deletes it. The page uploads
+    several files at once (and two clients may send the same path), so
+    writers never share a file: each fills its own temp file and the last
+    complete one wins. A failed upload leaves the previous file untouched,
+    and readers (WordPress) never see a half-written one.
+    As a context manager it yields the open file and commits on success.
+
+    mtime, if given, is set before the rename. A DeferredCommits batch
+    creates each directory once; with DURABILITY "batch" commit() only
+    closes the file, and the batch does the fsync and rename later. Data
+    passes through write(), which feeds the checksum; commit() raises
+    ChecksumMismatch (and discards) if it is wrong.
+    """
+
+    def __init__(self, full_path, mtime=None, batch=None, checksum=None):
+        head, tail = os.path.split(full_path)
+        if batch is None or head not in batch.made_dirs:
+            os.makedirs(head, exist_ok=True)    # safe if a concurrent upload creates it first
+            if batch is not None:
+                batch.made_dirs.add(head)
+        self.full_path = full_path
+        self.mtime     = mtime
+        self.batch     = batch if DURABILITY == "batch" else None
+        self.checksum  = checksum or Checksum.default()
+        self.tmp_path  = os.path.join(head, f".{tail}.{uuid.uuid4().hex[:12]}.part")
+        self.file      = open(self.tmp_path, "xb")
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self.file.write(data)
+
+    def commit(self):
+        try:
+            self.checksum.verify()
+        except ChecksumMismatch:
+            self.discard()
+            raise
+        if DURABILITY != "none" and self.batch is None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        apply_mtime(self.tmp_path, self.mtime)
+        if self.batch is not None:
+            self.batch.files.append(self)
+            return
+        os.replace(self.tmp_path, self.full_path)
+        if DURABILITY != "none":
+            sync_dir(os.path.dirname(self.full_path))
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+class DeferredCommits:
+    """Files of one /send_batch request, made durable together (DURABILITY "batch").
+
+    By the time finish() runs the kernel has been writing the files back for a
+    while, so fsyncing them in a row is far cheaper than one fsync per file
+    as it is written; each directory is then fsynced once, not once per file.
+    """
+
+    def __init__(self):
+        self.files     = []
+        self.made_dirs = set()      # directories already created, whatever DURABILITY is
+        self.unsynced  = {}         # directory -> error: its renames may not survive a crash
+
+    def finish(self):
+        """fsync, rename and fsync directories; return {full_path: error} for files that failed.
+
+        The files are in place by the time directories are synced, so a failed
+        directory fsync is recorded in self.unsynced instead of failing them.
+        """
+        failed, dirs = {}, set()
+        for target in self.files:
+            try:
+                fd = os.open(target.tmp_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(target.tmp_path, target.full_path)
+                dirs.add(os.path.dirname(target.full_path))
+            except OSError as e:
+                failed[target.full_path] = str(e)
+                target.discard()
+        for path in dirs:
+            try:
+                sync_dir(path)
+            except OSError as e:
+                log.error("dir_sync_failed", path=path, error=str(e))
+                self.unsynced[path] = str(e)
+        self.files = []
+        return failed
+
+
+def save_stream(stream, full_path, mtime=None, checksum=None):
+    """Copy a file-like stream to full_path in fixed-size chunks; return (bytes written, checksum)."""
+    written = 0
+    with ReplacingFile(full_path, mtime, checksum=checksum) as f:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            written += len(chunk)
+    return written, f.checksum
+
+
+# The whole JSON body is parsed in memory: capped at MAX_JSON_FILE_BYTES,
+# bigger files go through PUT /files or /uploads, which stream to disk
 @app.route("/send_to_files", methods=["POST"])
+@body_limit(MAX_JSON_FILE_BYTES)
 def send_to_files():
     try:
         payload   = request.get_json(force=True)
-        base_path = payload.get("base_path", "/var/www/html/wordpress/files/")
+        base_path = payload.get("base_path", DEFAULT_BASE_PATH)
         rel_path  = payload.get("rel_path", "")
         data_uri  = payload.get("data", "")
 
         if not rel_path:
-            print("[ERROR] rel_path is empty")
+            log.warn("bad_request", route="/send_to_files", error="rel_path is empty")
             return jsonify({"error": "rel_path is empty"}), 400
         if not data_uri:
-            print("[ERROR] no data")
+            log.warn("bad_request", route="/send_to_files", error="no data")
             return jsonify({"error": "no data"}), 400
 
         # Decode base64 data-URI  →  raw bytes
@@ -503,32 +1351,876 @@ def send_to_files():
 
         raw_bytes = base64.b64decode(b64)
 
-        # Build full path safely (strip leading / from rel_path)
-        rel_path  = rel_path.lstrip("/")
-        full_path = os.path.join(base_path, rel_path)
-        full_path = os.path.normpath(full_path)
-
-        # Security: make sure the resolved path is still inside base_path
-        if not full_path.startswith(os.path.normpath(base_path)):
-            print(f"[SECURITY] Path traversal blocked: {full_path}")
+        full_path = resolve_target(base_path, rel_path)
+        if full_path is None:
+            log.security("path_traversal_blocked", path=rel_path)
             return jsonify({"error": "Path traversal blocked"}), 403
 
-        # Create directories and write
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        with open(full_path, "wb") as f:
+        # Written beside the target and renamed into place: never seen half-written
+        with ReplacingFile(full_path, checksum=Checksum.requested(payload.get)) as f:
             f.write(raw_bytes)
+        file_written("/send_to_files", len(raw_bytes))
+
+        log.info("file_saved", path=full_path, size=len(raw_bytes))
+        return jsonify({"saved": full_path, **f.checksum.fields()}), 200
+
+    except ChecksumMismatch as e:
+        log.warn("checksum_mismatch", path=rel_path, **e.json())
+        return jsonify(e.json()), 422
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.error("file_save_failed", exc=e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ─── Raw upload: PUT /files/<rel_path>?base_path=... ──────────────────────────
+# The body is the file itself (no base64, no JSON) and is streamed to disk.
+@app.route("/files/<path:rel_path>", methods=["PUT"])
+@body_limit(MAX_FILE_BYTES)
+def put_file(rel_path):
+    try:
+        base_path = request.args.get("base_path", DEFAULT_BASE_PATH)
+
+        full_path = resolve_target(base_path, rel_path)
+        if full_path is None:
+            log.security("path_traversal_blocked", path=rel_path)
+            return jsonify({"error": "Path traversal blocked"}), 403
+
+        # A body that is too large or badly encoded raises here; the partial
+        # temp file is dropped and full_path keeps its previous content
+        checksum = Checksum.requested(lambda algorithm: request.headers.get(f"X-Checksum-{algorithm}")
+                                      or request.args.get(algorithm))
+        written, checksum = save_stream(request.stream, full_path,
+                                        request.args.get("mtime", type=float), checksum)
+        file_written("/files/<path:rel_path>", written)
 
-        print(f"[INFO] File saved: {full_path} ({len(raw_bytes)} bytes)")
-        return jsonify({"saved": full_path}), 200
+        log.info("file_saved", path=full_path, size=written)
+        return jsonify({"saved": full_path, "size": written, **checksum.fields()}), 200
 
+    except ChecksumMismatch as e:
+        log.warn("checksum_mismatch", path=rel_path, **e.json())
+        return jsonify(e.json()), 422
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"[ERROR] Failed to save file: {traceback.format_exc()}")
+        log.error("file_save_failed", exc=e)
         return jsonify({"error": str(e)}), 500
 
 
+# ─── Batch upload: POST /send_batch?base_path=... (body = tar stream) ────────
+# Many files in one request. The tar is unpacked while it is still arriving
+# (stream mode "r|"); with DURABILITY "batch" the files are fsynced and renamed
+# into place together once the stream ends (also when it ends in an error).
+import tarfile
+
+
+def settle_batch(batch, results):
+    """Commit a DeferredCommits batch; turn results whose commit failed into errors, return their number."""
+    failed = batch.finish()
+    lost = 0
+    for r in results:
+        if r.get("saved") in failed:
+            r["error"] = failed[r.pop("saved")]
+            lost += 1
+    return lost
+
+
+@app.route("/send_batch", methods=["POST"])
+@body_limit(MAX_FILE_BYTES)
+def send_batch():
+    base_path = request.args.get("base_path", DEFAULT_BASE_PATH)
+    results   = []
+    ok = fail = 0
+    batch     = DeferredCommits()
+
+    try:
+        try:
+            with tarfile.open(fileobj=request.stream, mode="r|") as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+
+                    full_path = resolve_target(base_path, member.name)
+                    if full_path is None:
+                        log.security("path_traversal_blocked", path=member.name)
+                        results.append({"path": member.name, "error": "Path traversal blocked"})
+                        fail += 1
+                        continue
+
+                    checksum = Checksum.requested(
+                        lambda algorithm: member.pax_headers.get(f"CLIPBOARD.{algorithm}"))
+                    try:
+                        with ReplacingFile(full_path, member.mtime, batch, checksum) as f:
+                            shutil.copyfileobj(tar.extractfile(member), f, UPLOAD_CHUNK_SIZE)
+                    except ChecksumMismatch as e:
+                        log.warn("checksum_mismatch", path=member.name, **e.json())
+                        results.append({"path": member.name, **e.json()})
+                        fail += 1
+                        continue
+                    except OSError as e:
+                        log.error("file_save_failed", path=full_path, error=str(e))
+                        results.append({"path": member.name, "error": str(e)})
+                        fail += 1
+                        continue
+
+                    file_written("/send_batch", member.size)
+                    results.append({"path": member.name, "saved": full_path, **checksum.fields()})
+                    ok += 1
+        finally:
+            lost = settle_batch(batch, results)
+            ok, fail = ok - lost, fail + lost
+    except tarfile.TarError as e:
+        log.warn("broken_tar_stream", error=str(e))
+        return jsonify({"error": f"Broken tar stream: {e}", "results": results}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.error("batch_save_failed", exc=e)
+        return jsonify({"error": str(e), "results": results}), 500
+
+    log.info("batch_saved", base_path=base_path, ok=ok, failed=fail)
+    body = {"results": results, "ok": ok, "failed": fail}
+    if batch.unsynced:
+        body["unsynced"] = batch.unsynced       # saved, but not yet durable
+    return jsonify(body), 200
+
+
+# ─── Resumable uploads ───────────────────────────────────────────────────────
+#   POST   /uploads        {"base_path", "rel_path", "size"}  -> {"upload_id", "offset": 0}
+#   GET    /uploads/<id>                                      -> {"offset", "size"}
+#   PUT    /uploads/<id>   Content-Range: bytes <start>-<end>/<size>
+#   DELETE /uploads/<id>
+# Partial data lives in UPLOAD_STAGING_DIR and is renamed into base_path once
+# the last byte arrives. The staging dir must not be web-served: the .json
+# metadata holds full server paths, and nginx/apache would hand out .part data.
+# The default sits under /var/lib, on the same filesystem as /var/www on most
+# hosts, and is created with mode 0700. An upload to another filesystem is
+# copied instead of renamed, with a warning.
+# Uploads whose .part has not grown for STALE_UPLOAD_SECONDS are removed.
+import errno, fcntl, re, time
+
+UPLOAD_STAGING_DIR   = os.environ.get("CLIPBOARD_STAGING_DIR", "/var/lib/clipboard-server/uploads")
+STALE_UPLOAD_SECONDS = 24 * 3600
+UPLOAD_ID_RE         = re.compile(r"^[0-9a-f]{32}$")
+CONTENT_RANGE_RE     = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+def staged_path(upload_id, ext):
+    return os.path.join(UPLOAD_STAGING_DIR, upload_id + ext)
+
+
+def expire_stale_uploads():
+    """Drop uploads idle for STALE_UPLOAD_SECONDS: .part, .json and running checksum together."""
+    cutoff = time.time() - STALE_UPLOAD_SECONDS
+    try:
+        names = os.listdir(UPLOAD_STAGING_DIR)
+    except FileNotFoundError:
+        return
+    upload_ids = {name.split(".", 1)[0] for name in names}
+    for upload_id in filter(UPLOAD_ID_RE.match, upload_ids):
+        # Every chunk touches the .part; the .json is written once at the start
+        for ext in (".part", ".json"):
+            try:
+                last_active = os.stat(staged_path(upload_id, ext)).st_mtime
+                break
+            except FileNotFoundError:
+                last_active = None
+        if last_active is not None and last_active < cutoff:
+            drop_upload(upload_id)
+            log.info("upload_expired", upload=upload_id)
+
+
+_warned_devices = set()
+
+
+def warn_if_cross_device(full_path):
+    """Log once per filesystem when finished uploads there will be copied, not renamed."""
+    head = os.path.dirname(full_path)
+    while not os.path.exists(head):
+        head = os.path.dirname(head)
+    device = os.stat(head).st_dev
+    if device != os.stat(UPLOAD_STAGING_DIR).st_dev and device not in _warned_devices:
+        _warned_devices.add(device)
+        log.warn("staging_cross_device", staging=UPLOAD_STAGING_DIR, target=head,
+                 hint="set CLIPBOARD_STAGING_DIR to a directory on the target's filesystem")
+
+
+def move_into_place(src, dst):
+    """Atomically rename src (already fsynced if DURABILITY asks for it) to dst.
+
+    Across filesystems src is copied next to dst first, then renamed.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Copy next to dst, then rename — readers never see a half-written file
+        tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+        try:
+            shutil.copyfile(src, tmp)
+            if DURABILITY != "none":
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        os.unlink(src)
+    if DURABILITY != "none":
+        sync_dir(os.path.dirname(dst))
+
+
+# The digest of a resumable upload is fed chunk by chunk while every chunk so
+# far reached this process; after a restart, or with chunks spread over
+# several workers, the staged file is hashed once when it is complete.
+_upload_checksums = {}      # upload_id -> (offset, Checksum)
+
+
+class HashingWriter:
+    """Writes to f and feeds checksum (None: plain writes)."""
+
+    def __init__(self, f, checksum):
+        self.f, self.checksum = f, checksum
+
+    def write(self, data):
+        if self.checksum is not None:
+            self.checksum.update(data)
+        return self.f.write(data)
+
+
+def upload_checksum(upload_id, meta, start):
+    """The running Checksum for a chunk starting at start, or None if this process missed data."""
+    saved = _upload_checksums.pop(upload_id, None)
+    if start == 0:
+        algorithm, expected = meta.get("checksum") or (Checksum.default().algorithm, None)
+        return Checksum(algorithm, expected)
+    if saved is not None and saved[0] == start:
+        return saved[1]
+    return None
+
+
+def keep_checksum(upload_id, offset, checksum):
+    """Remember the running digest for the chunk that will start at offset."""
+    if checksum is not None:
+        _upload_checksums[upload_id] = (offset, checksum)
+
+
+def finish_checksum(meta, checksum, part_path):
+    """Verified Checksum of a complete upload; raises ChecksumMismatch."""
+    if checksum is None:
+        algorithm, expected = meta.get("checksum") or (Checksum.default().algorithm, None)
+        checksum = Checksum(algorithm, expected)
+        if checksum.hash is not None:
+            with open(part_path, "rb") as f:
+                while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                    checksum.update(chunk)
+    checksum.verify()
+    return checksum
+
+
+def drop_upload(upload_id):
+    _upload_checksums.pop(upload_id, None)
+    for ext in (".part", ".json"):
+        try:
+            os.unlink(staged_path(upload_id, ext))
+        except FileNotFoundError:
+            pass
+
+
+def load_upload(upload_id):
+    if not UPLOAD_ID_RE.match(upload_id):
+        return None
+    try:
+        with open(staged_path(upload_id, ".json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    try:
+        payload   = request.get_json(force=True)
+        base_path = payload.get("base_path", DEFAULT_BASE_PATH)
+        rel_path  = payload.get("rel_path", "")
+        size      = payload.get("size")
+        mtime     = payload.get("mtime")
+
+        if not rel_path:
+            return jsonify({"error": "rel_path is empty"}), 400
+        if not isinstance(size, int) or size < 0:
+            return jsonify({"error": "size must be a non-negative integer"}), 400
+        if mtime is not None and not isinstance(mtime, (int, float)):
+            return jsonify({"error": "mtime must be a number"}), 400
+        if MAX_FILE_BYTES is not None and size > MAX_FILE_BYTES:
+            return jsonify({"error": "File too large", "limit": MAX_FILE_BYTES}), 413
+
+        full_path = resolve_target(base_path, rel_path)
+        if full_path is None:
+            log.security("path_traversal_blocked", path=rel_path)
+            return jsonify({"error": "Path traversal blocked"}), 403
+
+        checksum = Checksum.requested(payload.get)
+        if size == 0:
+            # Nothing to resume — just create the empty file
+            try:
+                with ReplacingFile(full_path, mtime, checksum=checksum):
+                    pass
+            except ChecksumMismatch as e:
+                return jsonify(e.json()), 422
+            return jsonify({"saved": full_path, "size": 0, **checksum.fields()}), 200
+
+        os.makedirs(UPLOAD_STAGING_DIR, mode=0o700, exist_ok=True)
+        expire_stale_uploads()
+        warn_if_cross_device(full_path)
+
+        upload_id = uuid.uuid4().hex
+        with open(staged_path(upload_id, ".json"), "w") as f:
+            json.dump({"full_path": full_path, "size": size, "mtime": mtime,
+                       "checksum": [checksum.algorithm, checksum.expected]}, f)
+        open(staged_path(upload_id, ".part"), "wb").close()
+
+        log.info("upload_started", upload=upload_id, path=full_path, size=size)
+        return jsonify({"upload_id": upload_id, "offset": 0, "size": size}), 201
+
+    except Exception as e:
+        log.error("upload_start_failed", exc=e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    meta = load_upload(upload_id)
+    if meta is None:
+        return jsonify({"error": "unknown upload"}), 404
+    try:
+        offset = os.path.getsize(staged_path(upload_id, ".part"))
+    except FileNotFoundError:
+        return jsonify({"error": "unknown upload"}), 404
+    return jsonify({"upload_id": upload_id, "offset": offset, "size": meta["size"]})
+
+
+@app.route("/uploads/<upload_id>", methods=["PUT"])
+@body_limit(MAX_FILE_BYTES)
+def upload_chunk(upload_id):
+    try:
+        meta = load_upload(upload_id)
+        if meta is None:
+            return jsonify({"error": "unknown upload"}), 404
+
+        m = CONTENT_RANGE_RE.match(request.headers.get("Content-Range", ""))
+        if not m:
+            return jsonify({"error": "Content-Range: bytes <start>-<end>/<size> required"}), 400
+        start, end, total = (int(g) for g in m.groups())
+        if total != meta["size"] or end < start or end >= total:
+            return jsonify({"error": "Content-Range does not match upload"}), 416
+
+        part_path = staged_path(upload_id, ".part")
+        try:
+            f = open(part_path, "r+b")
+        except FileNotFoundError:
+            return jsonify({"error": "unknown upload"}), 404
+
+        with f:
+            # One writer per upload, also across server processes
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return jsonify({"error": "upload busy"}), 409
+
+            offset = f.seek(0, os.SEEK_END)
+            if start != offset:
+                return jsonify({"error": "offset mismatch", "offset": offset}), 409
+
+            checksum  = upload_checksum(upload_id, meta, start)
+            out       = HashingWriter(f, checksum)
+            remaining = end - start + 1
+            while remaining:
+                chunk = request.stream.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                out.write(chunk)
+                remaining -= len(chunk)
+            offset = f.tell()
+
+            if offset == total:
+                f.flush()
+                try:
+                    checksum = finish_checksum(meta, checksum, part_path)
+                except ChecksumMismatch as e:
+                    drop_upload(upload_id)
+                    log.warn("checksum_mismatch", path=meta["full_path"], upload=upload_id, **e.json())
+                    return jsonify(e.json()), 422
+                if DURABILITY != "none":
+                    os.fsync(f.fileno())
+                move_into_place(part_path, meta["full_path"])
+                apply_mtime(meta["full_path"], meta.get("mtime"))
+                os.unlink(staged_path(upload_id, ".json"))
+                file_written("/uploads/<upload_id>", total)
+                log.info("file_saved", path=meta["full_path"], size=total, upload=upload_id)
+                return jsonify({"saved": meta["full_path"], "size": total, **checksum.fields()}), 200
+
+            keep_checksum(upload_id, offset, checksum)
+        return jsonify({"upload_id": upload_id, "offset": offset, "size": total}), 200
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.error("chunk_save_failed", exc=e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/uploads/<upload_id>", methods=["DELETE"])
+def abort_upload(upload_id):
+    if load_upload(upload_id) is None:
+        return jsonify({"error": "unknown upload"}), 404
+    drop_upload(upload_id)
+    log.info("upload_aborted", upload=upload_id)
+    return jsonify({"aborted": upload_id}), 200
+
+
+# ─── Incremental sync: POST /sync_manifest ───────────────────────────────────
+# The client posts {"base_path", "files": [{"path", "size", "mtime", "sha256"?}]}
+# and gets back only the paths that differ from what is already on disk.
+# Server-side digests are cached by (size, mtime, inode), so a repeated sync of
+# an unchanged tree costs one stat() per file.
+import threading
+
+_digest_cache      = {}     # full_path -> ((size, mtime_ns, ino), sha256 hex)
+_digest_cache_lock = threading.Lock()
+
+
+def file_sha256(full_path, st):
+    key = (st.st_size, st.st_mtime_ns, st.st_ino)
+    cached = _digest_cache.get(full_path)
+    if cached and cached[0] == key:
+        return cached[1]
+    with open(full_path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    with _digest_cache_lock:
+        _digest_cache[full_path] = (key, digest)
+    return digest
+
+
+def needs_upload(full_path, entry):
+    try:
+        st = os.stat(full_path)
+    except FileNotFoundError:
+        return True
+    if st.st_size != entry.get("size"):
+        return True
+    if entry.get("sha256"):
+        return file_sha256(full_path, st) != entry["sha256"].lower()
+    if entry.get("mtime") is not None:
+        return abs(st.st_mtime - entry["mtime"]) >= 1
+    return True
+
+
+def manifest_error(entry):
+    """What is wrong with a manifest entry, or None."""
+    if not isinstance(entry, dict):
+        return "entry must be an object"
+    path = entry.get("path")
+    if not isinstance(path, str) or not path:
+        return "missing path" if path in (None, "") else "path must be a string"
+    size = entry.get("size")
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return "size must be a non-negative integer"
+    mtime = entry.get("mtime")
+    if mtime is not None and (not isinstance(mtime, (int, float)) or isinstance(mtime, bool)):
+        return "mtime must be a number"
+    if entry.get("sha256") is not None and not isinstance(entry["sha256"], str):
+        return "sha256 must be a string"
+    return None
+
+
+@app.route("/sync_manifest", methods=["POST"])
+def sync_manifest():
+    try:
+        payload   = request.get_json(force=True)
+        if not isinstance(payload, dict):
+            return jsonify({"error": "manifest must be a JSON object"}), 400
+        base_path = payload.get("base_path", DEFAULT_BASE_PATH)
+        files     = payload.get("files", [])
+        if not isinstance(files, list):
+            return jsonify({"error": "files must be a list"}), 400
+        for index, entry in enumerate(files):
+            error = manifest_error(entry)
+            if error is not None:
+                path = entry.get("path") if isinstance(entry, dict) else None
+                return jsonify({"error": f"files[{index}]: {error}", "index": index, "path": path}), 400
+
+        needed, errors = [], []
+        unchanged = 0
+        for entry in files:
+            rel_path  = entry["path"]
+            full_path = resolve_target(base_path, rel_path)
+            if full_path is None:
+                log.security("path_traversal_blocked", path=rel_path)
+                errors.append({"path": rel_path, "error": "Path traversal blocked"})
+            elif needs_upload(full_path, entry):
+                needed.append(rel_path)
+            else:
+                unchanged += 1
+
+        log.info("sync_manifest", base_path=base_path, needed=len(needed), unchanged=unchanged)
+        return jsonify({"needed": needed, "unchanged": unchanged, "errors": errors}), 200
+
+    except Exception as e:
+        log.error("sync_manifest_failed", exc=e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ─── Downloads: GET /files/<rel_path>?base_path=... ──────────────────────────
+# A file goes out as the server's wsgi.file_wrapper: waitress and gunicorn
+# send it with sendfile() (or straight from the file), never through Python.
+# werkzeug answers If-None-Match / If-Modified-Since (304) and Range (206).
+# A directory answers with a JSON listing. Listings are cached per directory
+# while its mtime (bumped by every upload's rename) is unchanged, for at most
+# LISTING_MAX_AGE seconds, which catches files edited in place by others.
+# The .part temp files and the staging dir of uploads in progress are never
+# listed or served.
+# Reads are confined to READ_ROOTS (CLIPBOARD_READ_ROOTS, os.pathsep-separated,
+# default DEFAULT_BASE_PATH): a base_path outside them gets 403, since the
+# server listens on every interface and would otherwise hand out any file.
+from collections import OrderedDict
+from flask import send_file
+from werkzeug.wsgi import wrap_file
+
+LISTING_CACHE_MAX = 256     # directories kept in the listing cache
+LISTING_MAX_AGE   = 30      # seconds a cached listing is trusted
+PART_FILE_RE      = re.compile(r"^\..+\.[0-9a-f]{12}\.part$")     # ReplacingFile temp names
+READ_ROOTS        = [os.path.realpath(p) for p in
+                     os.environ.get("CLIPBOARD_READ_ROOTS", DEFAULT_BASE_PATH).split(os.pathsep) if p]
+
+_listing_cache      = OrderedDict()     # dir full_path -> ((mtime_ns, ino), cached at, entries, etag)
+_listing_cache_lock = threading.Lock()
+
+
+def read_base(base_path):
+    """realpath of base_path if it is one of READ_ROOTS or inside one, else None."""
+    base = os.path.realpath(base_path)
+    for root in READ_ROOTS:
+        if base == root or base.startswith(root.rstrip(os.sep) + os.sep):
+            return base
+    return None
+
+
+def base_not_readable(base_path):
+    log.security("read_root_blocked", base_path=base_path)
+    return jsonify({"error": "base_path is not readable"}), 403
+
+
+def is_hidden(full_path):
+    """An upload in progress: a ReplacingFile temp file or anything in the staging dir."""
+    staging = os.path.realpath(UPLOAD_STAGING_DIR)
+    return (PART_FILE_RE.match(os.path.basename(full_path)) is not None
+            or full_path == staging or full_path.startswith(staging + os.sep))
+
+
+def resolve_existing(base_path, rel_path):
+    """Like resolve_target, but base_path itself is allowed and symlinks may not lead out of it."""
+    base      = os.path.realpath(base_path)
+    full_path = os.path.realpath(os.path.join(base, rel_path.lstrip("/")))
+    if full_path != base and not full_path.startswith(base.rstrip(os.sep) + os.sep):
+        return None
+    return full_path
+
+
+def scan_dir(full_path):
+    entries = []
+    with os.scandir(full_path) as it:
+        for entry in it:
+            if is_hidden(entry.path):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue                    # dangling symlink, or deleted meanwhile
+            if entry.is_dir():
+                entries.append({"name": entry.name, "type": "dir", "mtime": st.st_mtime})
+            else:
+                entries.append({"name": entry.name, "type": "file", "size": st.st_size,
+                                "mtime": st.st_mtime})
+    entries.sort(key=lambda e: (e["type"] != "dir", e["name"]))
+    return entries
+
+
+def list_dir(full_path):
+    """(entries, etag) of a directory, from the cache while it is unchanged."""
+    st  = os.stat(full_path)
+    key = (st.st_mtime_ns, st.st_ino)
+    now = time.monotonic()
+    with _listing_cache_lock:
+        cached = _listing_cache.get(full_path)
+        if cached and cached[0] == key and now - cached[1] < LISTING_MAX_AGE:
+            _listing_cache.move_to_end(full_path)
+            return cached[2], cached[3]
+
+    entries = scan_dir(full_path)
+    etag    = hashlib.sha256(json.dumps(entries).encode()).hexdigest()[:32]
+    with _listing_cache_lock:
+        _listing_cache[full_path] = (key, now, entries, etag)
+        _listing_cache.move_to_end(full_path)
+        while len(_listing_cache) > LISTING_CACHE_MAX:
+            _listing_cache.popitem(last=False)
+    return entries, etag
+
+
+def file_response(full_path, as_attachment):
+    f = open(full_path, "rb")
+    try:
+        st   = os.fstat(f.fileno())
+        name = os.path.basename(full_path)
+        rv   = send_file(f, mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream",
+                         as_attachment=as_attachment, download_name=name,
+                         etag=f"{st.st_mtime_ns:x}-{st.st_size:x}-{st.st_ino:x}",
+                         last_modified=st.st_mtime, conditional=False)
+        rv.content_length = st.st_size
+        rv = rv.make_conditional(request.environ, accept_ranges=True, complete_length=st.st_size)
+    except BaseException:
+        f.close()
+        raise
+    if rv.status_code == 206 and "wsgi.file_wrapper" in request.environ:
+        # werkzeug cuts a range out of the file in Python; a server's
+        # file_wrapper sends Content-Length bytes from the current offset
+        f.seek(rv.content_range.start)
+        rv.response = wrap_file(request.environ, f)
+    return rv
+
+
+@app.route("/files/", defaults={"rel_path": ""}, methods=["GET"])
+@app.route("/files/<path:rel_path>", methods=["GET"])
+def get_file(rel_path):
+    base_path = request.args.get("base_path", DEFAULT_BASE_PATH)
+    base      = read_base(base_path)
+    if base is None:
+        return base_not_readable(base_path)
+    full_path = resolve_existing(base, rel_path)
+    if full_path is None:
+        log.security("path_traversal_blocked", path=rel_path)
+        return jsonify({"error": "Path traversal blocked"}), 403
+
+    try:
+        if is_hidden(full_path):
+            raise FileNotFoundError(full_path)
+        if os.path.isdir(full_path):
+            entries, etag = list_dir(full_path)
+            rv = jsonify({"path": rel_path.strip("/"), "entries": entries})
+            rv.set_etag(etag)
+            return rv.make_conditional(request)
+        return file_response(full_path, as_attachment="download" in request.args)
+
+    except FileNotFoundError:
+        return jsonify({"error": "Not found"}), 404
+    except PermissionError:
+        return jsonify({"error": "Permission denied"}), 403
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.error("file_read_failed", path=full_path, exc=e)
+        return jsonify({"error": str(e)}), 500
+
+
+# ─── Export: GET /export/<rel_path>?base_path=...&format=tar.gz ──────────────
+# Streams a directory as one archive while walking it: tar, tar.gz, tar.zst
+# or zip. Each file is read UPLOAD_CHUNK_SIZE at a time and its bytes go out
+# before the next read, so memory stays flat and nothing is staged on disk
+# however big the tree; the first bytes leave as soon as the walk starts.
+# Symlinked files are included only if they stay inside base_path (symlinked
+# directories are skipped), and so are .part temp files.
+from itertools import chain
+from urllib.parse import quote
+import stat, zipfile, zlib
+
+try:
+    import zstandard
+except ImportError:         # tar.zst is refused without it
+    zstandard = None
+
+EXPORT_FORMATS = {"tar": "application/x-tar", "tar.gz": "application/gzip",
+                  "tar.zst": "application/zstd", "zip": "application/zip"}
+EXPORT_GZIP_LEVEL = 6
+# Stored as is in zips, like the page's PRECOMPRESSED: deflating them again only costs CPU
+PRECOMPRESSED_RE = re.compile(r"\.(png|jpe?g|gif|webp|avif|heic|mp[34]|m4[av]|mkv|mov|webm|ogg"
+                              r"|opus|flac|zip|gz|tgz|bz2|xz|zst|7z|rar|jar|apk|docx|xlsx|pptx"
+                              r"|odt|pdf|woff2?)$", re.IGNORECASE)
+
+
+def walk_export(base, full_path, arcname):
+    """(archive name, full path, stat) of everything below full_path, depth first, by name."""
+    try:
+        with os.scandir(full_path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as e:
+        log.warn("export_dir_skipped", path=full_path, error=str(e))
+        return
+    for entry in entries:
+        if is_hidden(entry.path):
+            continue
+        name = f"{arcname}/{entry.name}"
+        path = entry.path
+        if entry.is_symlink():
+            path = resolve_existing(base, os.path.relpath(entry.path, base))
+            if path is None or os.path.isdir(path):
+                continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue                        # dangling symlink, or deleted meanwhile
+        if stat.S_ISDIR(st.st_mode):
+            yield name, path, st
+            yield from walk_export(base, path, name)
+        elif stat.S_ISREG(st.st_mode):
+            yield name, path, st
+
+
+def file_chunks(f, size, path):
+    """size bytes of f, UPLOAD_CHUNK_SIZE at a time; zero-filled if the file shrank meanwhile."""
+    remaining = size
+    while remaining:
+        chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+        if not chunk:
+            # The header with the old size is already out: keep the archive readable
+            log.warn("export_file_shrank", path=path, missing=remaining)
+            while remaining:
+                n = min(UPLOAD_CHUNK_SIZE, remaining)
+                remaining -= n
+                yield bytes(n)
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+
+def tar_stream(entries):
+    for name, path, st in entries:
+        info = tarfile.TarInfo(name)
+        info.mtime = st.st_mtime
+        info.mode  = stat.S_IMODE(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+            yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            continue
+        try:
+            f = open(path, "rb")
+        except OSError as e:
+            log.warn("export_file_skipped", path=path, error=str(e))
+            continue
+        with f:
+            info.size = os.fstat(f.fileno()).st_size
+            yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            yield from file_chunks(f, info.size, path)
+        if info.size % tarfile.BLOCKSIZE:
+            yield bytes(tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    yield bytes(2 * tarfile.BLOCKSIZE)      # end-of-archive marker
+
+
+class ZipSink:
+    """Write-only, unseekable file for zipfile; take() hands out what it wrote so far."""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+
+def zip_stream(entries):
+    # Unseekable output makes zipfile put sizes and CRCs in data descriptors
+    # after each file instead of going back to patch the local headers
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, path, st in entries:
+            try:
+                zinfo = zipfile.ZipInfo.from_file(path, name, strict_timestamps=False)
+            except OSError as e:                # vanished or unreadable since the walk
+                log.warn("export_file_skipped", path=path, error=str(e))
+                continue
+            if zinfo.is_dir():
+                zf.writestr(zinfo, b"")
+            else:
+                try:
+                    f = open(path, "rb")
+                except OSError as e:
+                    log.warn("export_file_skipped", path=path, error=str(e))
+                    continue
+                zinfo.file_size     = os.fstat(f.fileno()).st_size
+                zinfo.compress_type = (zipfile.ZIP_STORED if PRECOMPRESSED_RE.search(name)
+                                       else zipfile.ZIP_DEFLATED)
+                with f, zf.open(zinfo, "w") as out:
+                    for chunk in file_chunks(f, zinfo.file_size, path):
+                        out.write(chunk)
+                        if sink.buf:
+                            yield sink.take()
+            if sink.buf:
+                yield sink.take()
+    yield sink.take()                       # central directory
+
+
+def compressed(chunks, compressor):
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route("/export/", defaults={"rel_path": ""}, methods=["GET"])
+@app.route("/export/<path:rel_path>", methods=["GET"])
+def export_dir(rel_path):
+    base_path = request.args.get("base_path", DEFAULT_BASE_PATH)
+    fmt       = request.args.get("format", "tar")
+    base      = read_base(base_path)
+    if base is None:
+        return base_not_readable(base_path)
+    full_path = resolve_existing(base, rel_path)
+    if full_path is None:
+        log.security("path_traversal_blocked", path=rel_path)
+        return jsonify({"error": "Path traversal blocked"}), 403
+    if fmt not in EXPORT_FORMATS or (fmt == "tar.zst" and zstandard is None):
+        formats = [f for f in EXPORT_FORMATS if f != "tar.zst" or zstandard is not None]
+        return jsonify({"error": f"format must be one of: {', '.join(formats)}"}), 400
+    if not os.path.isdir(full_path):
+        return jsonify({"error": "Not a directory"}), 404
+
+    # Nothing is read until the server asks for the first chunk
+    name    = os.path.basename(full_path) or "export"
+    entries = chain([(name, full_path, os.stat(full_path))], walk_export(base, full_path, name))
+    if fmt == "zip":
+        body = zip_stream(entries)
+    else:
+        body = tar_stream(entries)
+        if fmt == "tar.gz":
+            body = compressed(body, zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31))
+        elif fmt == "tar.zst":
+            body = compressed(body, zstandard.ZstdCompressor().compressobj())
+
+    log.info("export_started", path=full_path, format=fmt)
+    archive = f"{name}.{fmt}"
+    fallback = archive.encode("ascii", "replace").decode().replace('"', "_")
+    return Response(body, mimetype=EXPORT_FORMATS[fmt], headers={
+        "Content-Disposition": f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(archive)}"})
+
 if __name__ == "__main__":
     port = 5555
     if '--port' in sys.argv:
         port = int(sys.argv[sys.argv.index('--port') + 1])
-    print(f"[INFO] Starting clipboard server on port {port}")
-    app.run(host="0.0.0.0", port=port)
+    log.info("server_starting", port=port)
+    serve(app, port, sys.argv, store=state_store,
+          on_worker_start=lambda: clipboard.start(backend_from_argv(sys.argv)))
@@ -0,0 +1,473 @@
+"""Asyncio (ASGI) serving mode for bsend.py — same routes, same page.
+
+    python3 bsend_asgi.py --port 5555 [--workers N] [--backend NAME]   (needs uvicorn)
+
+The slow paths are native coroutines: clipboard tools run as asyncio
+subprocesses, uploads are written chunk by chunk from worker threads, and
+SSE / long-poll clients wait on an asyncio.Event instead of a parked
+thread, so thousands of idle or slow clients cost a few KB each. Every
+other route (history, batch upload, sync, resumable bookkeeping, the JSON
+send_to_files) is served by bsend's Flask app through a WSGI bridge.
+"""
+import asyncio
+import fcntl
+import io
+import json
+import log
+import os
+import re
+import sys
+import tempfile
+from urllib.parse import parse_qs
+
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+
+import bsend
+from bsend import (app as flask_app, clipboard, clipboard_state, state_store,
+                   CONTENT_RANGE_RE, DEFAULT_BASE_PATH, DURABILITY, LONG_POLL_TIMEOUT,
+                   SSE_KEEPALIVE, UPLOAD_CHUNK_SIZE, Checksum, ChecksumMismatch, HashingWriter,
+                   ReplacingFile, apply_mtime, drop_upload, finish_checksum, keep_checksum,
+                   load_upload, move_into_place, resolve_target, snapshot_json, staged_path,
+                   upload_checksum)
+from assets import compress_page, page_etag
+from body_encoding import Decoder
+from clipboard_backend import ClipboardError, backend_from_argv
+from clipboard_state import SHARED_RECHECK_INTERVAL
+from limits import MAX_FILE_BYTES, MAX_IMAGE_BYTES, MAX_TEXT_BYTES, SPOOL_THRESHOLD
+from metrics import ASGIRequest, file_written
+from profiling import PROFILE_TOKEN
+from serving import serve_asgi
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    from uvicorn.middleware.wsgi import WSGIMiddleware
+
+wsgi_fallback = WSGIMiddleware(flask_app)
+
+UPLOAD_PATH_RE = re.compile(r"^/uploads/([0-9a-f]{32})$")
+
+
+# ─── Small ASGI helpers ──────────────────────────────────────────────────────
+
+class Request:
+    def __init__(self, scope, receive):
+        self.scope   = scope
+        self.receive = receive
+        self.method  = scope["method"]
+        self.path    = scope["path"]
+        self.args    = {k: v[-1] for k, v in parse_qs(scope["query_string"].decode()).items()}
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1")
+                        for k, v in scope["headers"]}
+        coding = self.headers.get("content-encoding", "").strip().lower()
+        self.coding  = None if coding in ("", "identity") else coding
+
+    def arg(self, name, default=None, type=str):
+        try:
+            return type(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+    async def chunks(self):
+        """Body chunks, decompressed if the client sent a Content-Encoding (see body_encoding.py)."""
+        decoder = Decoder(self.coding) if self.coding else None
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("client disconnected")
+            if message.get("body"):
+                if decoder is None:
+                    yield message["body"]
+                else:
+                    for piece in decoder.decode(message["body"]):
+                        yield piece
+            if not message.get("more_body"):
+                if decoder is not None:
+                    decoder.finish()
+                return
+
+    def check_length(self, limit):
+        """Raise RequestEntityTooLarge if Content-Length already exceeds limit."""
+        length = self.headers.get("content-length")
+        if self.coding:
+            return                      # compressed size says nothing about the decoded one
+        if limit is not None and length and length.isdigit() and int(length) > limit:
+            raise RequestEntityTooLarge()
+
+    async def spool(self, limit):
+        """Async limits.spool_body(): (bytes, size) if small, else (temp file at offset 0, size)."""
+        self.check_length(limit)
+        buf, f, size = bytearray(), None, 0
+        async for chunk in self.chunks():
+            size += len(chunk)
+            if limit is not None and size > limit:
+                if f is not None:
+                    f.close()
+                raise RequestEntityTooLarge()
+            if f is None:
+                buf += chunk
+                if len(buf) > SPOOL_THRESHOLD:
+                    f = await asyncio.to_thread(tempfile.TemporaryFile)
+                    await asyncio.to_thread(f.write, bytes(buf))
+                    buf = None
+            else:
+                await asyncio.to_thread(f.write, chunk)
+        if f is None:
+            return bytes(buf), size
+        f.seek(0)
+        return f, size
+
+
+async def respond(send, status, body=b"", content_type="text/plain; charset=utf-8", headers=()):
+    if isinstance(body, str):
+        body = body.encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode()),
+                            (b"content-length", str(len(body)).encode()),
+                            *((k.encode(), v.encode()) for k, v in headers)]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def respond_json(send, obj, status=200, headers=()):
+    await respond(send, status, json.dumps(obj), "application/json", headers)
+
+
+# ─── Clipboard ───────────────────────────────────────────────────────────────
+
+_changed   = None   # asyncio.Event, replaced after every clipboard change
+_read_lock = None   # asyncio.Lock: concurrent stale requests share one clipboard read
+
+
+def _on_change():
+    global _changed
+    _changed.set()
+    _changed = asyncio.Event()
+
+
+async def in_store(fn, *args):
+    """Run a clipboard_state call; off the loop when the SharedStore is file-backed (workers > 1)."""
+    if clipboard_state.store.directory is None:
+        return fn(*args)            # plain dict: cheaper than a thread hop
+    return await asyncio.to_thread(fn, *args)
+
+
+async def wait_change(since, timeout):
+    """Async twin of ClipboardState.wait(): no thread is parked while waiting."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        event = _changed               # take it before the snapshot, or a change could slip by
+        snap = await in_store(clipboard_state.snapshot)
+        remaining = deadline - loop.time()
+        if snap.version != since or remaining <= 0:
+            return snap
+        if clipboard_state.store.directory is not None:
+            remaining = min(remaining, SHARED_RECHECK_INTERVAL)
+        try:
+            await asyncio.wait_for(event.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def fresh_snapshot():
+    """Async twin of ClipboardState.fresh(): one clipboard read however many requests wait on it."""
+    if not clipboard_state.is_fresh():
+        async with _read_lock:
+            if not clipboard_state.is_fresh():
+                text = await clipboard.call_async("get_text")
+                await in_store(clipboard_state.publish, text)
+    return await in_store(clipboard_state.snapshot)
+
+
+async def index(req, send):
+    if req.method == "POST":
+        data, size = await req.spool(MAX_IMAGE_BYTES)
+        content_type = req.headers.get("content-type", "")
+        try:
+            if content_type.startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+                stream = io.BytesIO(data) if isinstance(data, bytes) else data
+                _, form, _ = parse_form_data({"REQUEST_METHOD": "POST", "CONTENT_TYPE": content_type,
+                                              "CONTENT_LENGTH": str(size), "wsgi.input": stream},
+                                             max_form_memory_size=MAX_TEXT_BYTES)
+                text = form.get("text") if form.get("action") == "text" else None
+                if text:
+                    text = text.replace('\r\n', '\n').replace('\r', '\n')
+                    if await clipboard.call_async("set_text", text):
+                        await in_store(state_store.set, "last_text", text)
+                        await in_store(clipboard_state.publish, text)
+                    log.info("text_copied", chars=len(text))
+            elif size:
+                # copy_image may read a spooled file back for the history: keep it off the loop
+                await asyncio.to_thread(bsend.copy_image, data)
+                log.info("image_copied", size=size)
+                return await respond(send, 200, "Image uploaded and copied to clipboard!")
+        except ClipboardError as e:
+            log.error("clipboard_write_failed", error=str(e))
+            return await respond(send, 500, f"Failed to copy to clipboard:\n{e}")
+        finally:
+            if not isinstance(data, bytes):
+                data.close()
+
+    body = bsend.render_page().encode()
+    etag = f'"{page_etag(body)}"'
+    headers = [("etag", etag), ("vary", "Accept-Encoding"), ("cache-control", "no-cache")]
+    if etag in req.headers.get("if-none-match", ""):
+        return await respond(send, 304, headers=headers)
+    body, coding = compress_page(body, req.headers.get("accept-encoding", ""))
+    if coding:
+        headers.append(("content-encoding", coding))
+    await respond(send, 200, body, "text/html; charset=utf-8", headers)
+
+
+async def get_clipboard(req, send):
+    try:
+        snap = await fresh_snapshot()
+    except Exception as e:
+        log.error("clipboard_read_failed", error=str(e))
+        return await respond_json(send, {"text": f"Error: {str(e)}"})
+
+    etag = f'"{snap.digest}"'
+    if etag in req.headers.get("if-none-match", ""):
+        return await respond(send, 304, headers=[("etag", etag), ("cache-control", "no-cache")])
+    if req.arg("since", type=int) == snap.version:
+        return await respond_json(send, {"version": snap.version, "changed": False})
+
+    log.info("clipboard_read", chars=len(snap.text))
+    await respond_json(send, {**snapshot_json(snap), "changed": True},
+                       headers=[("etag", etag), ("cache-control", "no-cache")])
+
+
+async def clipboard_events(req, send):
+    # A reconnecting EventSource sends the last id it saw; it is newer than
+    # the ?since= the stream was first opened with
+    try:
+        since = int(req.headers["last-event-id"])
+    except (KeyError, ValueError):
+        since = req.arg("since", type=int)
+    version = -1 if since is None else since
+
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/event-stream"),
+                            (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]})
+    log.info("event_stream_opened")
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await req.receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        with clipboard_state.subscribe():
+            while not disconnected.is_set():
+                snap = await wait_change(version, SSE_KEEPALIVE)
+                if snap.version == version:
+                    chunk = ": keepalive\n\n"
+                else:
+                    version = snap.version
+                    chunk = f"id: {version}\nevent: clipboard\ndata: {json.dumps(snapshot_json(snap))}\n\n"
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+    finally:
+        watcher.cancel()
+
+
+async def wait_clipboard(req, send):
+    since   = req.arg("since", -1, type=int)
+    timeout = min(req.arg("timeout", LONG_POLL_TIMEOUT, type=float), LONG_POLL_TIMEOUT)
+    with clipboard_state.subscribe():
+        snap = await wait_change(since, timeout)
+    if snap.version == since:
+        return await respond_json(send, {"version": since, "changed": False})
+    await respond_json(send, {**snapshot_json(snap), "changed": True})
+
+
+# ─── Uploads ─────────────────────────────────────────────────────────────────
+
+async def write_chunks(chunks, f, limit=None, max_bytes=None):
+    """Write an async stream of chunks to f from a worker thread, UPLOAD_CHUNK_SIZE at a time.
+
+    Stops quietly after limit bytes; raises RequestEntityTooLarge past max_bytes.
+    """
+    buf, written = bytearray(), 0
+    async for chunk in chunks:
+        if max_bytes is not None and written + len(buf) + len(chunk) > max_bytes:
+            raise RequestEntityTooLarge()
+        if limit is not None:
+            chunk = chunk[:limit - written - len(buf)]
+        buf += chunk
+        if len(buf) >= UPLOAD_CHUNK_SIZE:
+            await asyncio.to_thread(f.write, bytes(buf))
+            written += len(buf)
+            buf.clear()
+        if limit is not None and written + len(buf) >= limit:
+            break
+    if buf:
+        await asyncio.to_thread(f.write, bytes(buf))
+        written += len(buf)
+    return written
+
+
+async def put_file(req, send):
+    rel_path  = req.path[len("/files/"):]
+    base_path = req.arg("base_path", DEFAULT_BASE_PATH)
+
+    full_path = resolve_target(base_path, rel_path)
+    if full_path is None:
+        log.security("path_traversal_blocked", path=rel_path)
+        return await respond_json(send, {"error": "Path traversal blocked"}, 403)
+
+    req.check_length(MAX_FILE_BYTES)
+    checksum = Checksum.requested(lambda algorithm: req.headers.get(f"x-checksum-{algorithm}")
+                                  or req.arg(algorithm))
+    try:
+        target = await asyncio.to_thread(ReplacingFile, full_path, req.arg("mtime", type=float),
+                                         checksum=checksum)
+        try:
+            written = await write_chunks(req.chunks(), target, max_bytes=MAX_FILE_BYTES)
+        except BaseException:
+            # Too large, badly encoded or the client went away: keep the old file
+            await asyncio.to_thread(target.discard)
+            raise
+        await asyncio.to_thread(target.commit)
+    except ChecksumMismatch as e:
+        log.warn("checksum_mismatch", path=rel_path, **e.json())
+        return await respond_json(send, e.json(), 422)
+    except (HTTPException, ConnectionError):
+        raise
+    except Exception as e:
+        log.error("file_save_failed", path=full_path, exc=e)
+        return await respond_json(send, {"error": str(e)}, 500)
+
+    file_written("/files/<path:rel_path>", written)
+    log.info("file_saved", path=full_path, size=written)
+    await respond_json(send, {"saved": full_path, "size": written, **checksum.fields()})
+
+
+async def upload_chunk(req, send, upload_id):
+    meta = await asyncio.to_thread(load_upload, upload_id)
+    if meta is None:
+        return await respond_json(send, {"error": "unknown upload"}, 404)
+
+    m = CONTENT_RANGE_RE.match(req.headers.get("content-range", ""))
+    if not m:
+        return await respond_json(send, {"error": "Content-Range: bytes <start>-<end>/<size> required"}, 400)
+    start, end, total = (int(g) for g in m.groups())
+    if total != meta["size"] or end < start or end >= total:
+        return await respond_json(send, {"error": "Content-Range does not match upload"}, 416)
+
+    part_path = staged_path(upload_id, ".part")
+    try:
+        f = await asyncio.to_thread(open, part_path, "r+b")
+    except FileNotFoundError:
+        return await respond_json(send, {"error": "unknown upload"}, 404)
+
+    try:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return await respond_json(send, {"error": "upload busy"}, 409)
+
+        offset = f.seek(0, os.SEEK_END)
+        if start != offset:
+            return await respond_json(send, {"error": "offset mismatch", "offset": offset}, 409)
+
+        checksum = upload_checksum(upload_id, meta, start)
+        offset  += await write_chunks(req.chunks(), HashingWriter(f, checksum), limit=end - start + 1)
+        if offset == total:
+            await asyncio.to_thread(f.flush)
+            try:
+                checksum = await asyncio.to_thread(finish_checksum, meta, checksum, part_path)
+            except ChecksumMismatch as e:
+                await asyncio.to_thread(drop_upload, upload_id)
+                log.warn("checksum_mismatch", path=meta["full_path"], upload=upload_id, **e.json())
+                return await respond_json(send, e.json(), 422)
+            if DURABILITY != "none":
+                await asyncio.to_thread(os.fsync, f.fileno())
+            await asyncio.to_thread(move_into_place, part_path, meta["full_path"])
+            await asyncio.to_thread(os.unlink, staged_path(upload_id, ".json"))
+            await asyncio.to_thread(apply_mtime, meta["full_path"], meta.get("mtime"))
+            file_written("/uploads/<upload_id>", total)
+            log.info("file_saved", path=meta["full_path"], size=total, upload=upload_id)
+            return await respond_json(send, {"saved": meta["full_path"], "size": total,
+                                             **checksum.fields()})
+        keep_checksum(upload_id, offset, checksum)
+    finally:
+        await asyncio.to_thread(f.close)
+
+    await respond_json(send, {"upload_id": upload_id, "offset": offset, "size": total})
+
+
+# ─── Routing ─────────────────────────────────────────────────────────────────
+
+async def lifespan(receive, send):
+    global _changed, _read_lock
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            loop = asyncio.get_running_loop()
+            _changed   = asyncio.Event()
+            _read_lock = asyncio.Lock()
+            clipboard_state.add_listener(lambda: loop.call_soon_threadsafe(_on_change))
+            await asyncio.to_thread(clipboard.start, backend_from_argv(sys.argv))
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def native_route(method, path):
+    """(route as named in bsend's url rules, handler, extra args), or None for the Flask app."""
+    if path == "/" and method in ("GET", "POST"):
+        return "/", index, ()
+    if path == "/get_clipboard" and method == "GET":
+        return path, get_clipboard, ()
+    if path == "/events" and method == "GET":
+        return path, clipboard_events, ()
+    if path == "/wait_clipboard" and method == "GET":
+        return path, wait_clipboard, ()
+    if path.startswith("/files/") and method == "PUT":
+        return "/files/<path:rel_path>", put_file, ()
+    m = UPLOAD_PATH_RE.match(path)
+    if m and method == "PUT":
+        return "/uploads/<upload_id>", upload_chunk, (m.group(1),)
+    return None
+
+
+def wants_profile(scope):
+    return (b"profile" in scope["query_string"]
+            or any(name == b"x-profile" for name, _ in scope["headers"]))
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    native = native_route(scope["method"], scope["path"])
+    if native is None or (PROFILE_TOKEN and wants_profile(scope)):
+        # Counted by bsend's Flask metrics; profiles are taken there too,
+        # since cProfile on the event loop would mix in every other request
+        return await wsgi_fallback(scope, receive, send)
+
+    route, handler, args = native
+    counted = ASGIRequest(route, scope["method"], receive, send)
+    send = counted.send
+    try:
+        await handler(Request(scope, counted.receive), send, *args)
+    except ConnectionError:
+        pass
+    except HTTPException as e:
+        log.warn("request_rejected", path=scope["path"], status=e.code, error=e.description)
+        await respond_json(send, {"error": e.description}, e.code)
+    finally:
+        counted.done()
+
+
+if __name__ == "__main__":
+    port = 5555
+    if '--port' in sys.argv:
+        port = int(sys.argv[sys.argv.index('--port') + 1])
+    log.info("server_starting", port=port, mode="asgi")
+    serve_asgi(app, "bsend_asgi:app", port, sys.argv)
@@ -1,12 +1,24 @@
-from flask import Flask, render_template_string, request
-import pyperclip
-import os
-import pathlib
-import subprocess
+from flask import Flask, request
+from assets import page_response
+from body_encoding import DecodeRequestBody
+from clipboard_backend import ClipboardWorker, ClipboardError, backend_from_argv
+from clipboard_state import SharedStore
+from limits import MAX_IMAGE_BYTES, body_limit, configure as configure_limits, spool_body
+from metrics import instrument
+from profiling import install as install_profiling
+from serving import serve
+from werkzeug.exceptions import HTTPException
+import log
 import sys
 import traceback
 
 app = Flask(__name__)
+configure_limits(app)
+app.wsgi_app = DecodeRequestBody(app.wsgi_app)
+install_profiling(app)
+instrument(app)
+clipboard = ClipboardWorker()
+state_store = SharedStore()
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -71,11 +83,11 @@ HTML_TEMPLATE = """
 </html>
 """
 
-last_text = ""
+page_template = app.jinja_env.from_string(HTML_TEMPLATE)     # compiled once
 
 @app.route("/", methods=["GET", "POST"])
+@body_limit(MAX_IMAGE_BYTES)
 def index():
-    global last_text
     text_message = ""
     image_message = ""
 
@@ -84,46 +96,35 @@ def index():
             if request.form.get("action") == "text":
                 text = request.form.get("text")
                 if text:
-                    pyperclip.copy(text)
-                    last_text = text
+                    if clipboard.set_text(text):    # False: superseded by a newer write
+                        state_store.set("last_text", text)
                     text_message = f"Text copied to clipboard:\n{text}"
             else:
                 # Если данные приходят как raw image
-                if request.data:
-                    filepath = '/tmp/uploaded_image.png'
-                    with open(filepath, 'wb') as f:
-                        f.write(request.data)
-
-                    display = os.environ.get('DISPLAY', ':0')
-                    xauth = pathlib.Path.home() / '.Xauthority'
-                    env = os.environ.copy()
-                    env['DISPLAY'] = display
-                    env['XAUTHORITY'] = str(xauth)
-
-                    if subprocess.run(['which', 'xclip'], capture_output=True).returncode != 0:
-                        return "xclip not installed", 500
-
-                    result = subprocess.run(
-                        ['xclip', '-selection', 'clipboard', '-t', 'image/png', '-i', filepath],
-                        env=env,
-                        capture_output=True,
-                        text=True
-                    )
-
-                    if result.returncode != 0:
-                        return f"Failed to copy image to clipboard:\n{result.stderr}", 500
+                data, size = spool_body(request.stream)     # big images wait in a temp file
+                if size:
+                    try:
+                        clipboard.set_image(data)
+                    except ClipboardError as e:
+                        return f"Failed to copy image to clipboard:\n{e}", 500
+                    finally:
+                        if not isinstance(data, bytes):
+                            data.close()
 
                     image_message = "Image uploaded and copied to clipboard!"
 
+    except HTTPException:
+        raise
     except Exception as e:
         tb = traceback.format_exc()
-        print(tb)
+        log.error("server_error", exc=e)
         return f"Server error:\n{tb}", 500
 
-    return render_template_string(HTML_TEMPLATE, text_message=last_text, image_message=image_message)
+    return page_response(page_template.render(text_message=state_store.get("last_text", ""), image_message=image_message))
 
 if __name__ == "__main__":
     port = 5555
     if '--port' in sys.argv:
         port = int(sys.argv[sys.argv.index('--port') + 1])
-    app.run(host="0.0.0.0", port=port)
+    serve(app, port, sys.argv, store=state_store,
+          on_worker_start=lambda: clipboard.start(backend_from_argv(sys.argv)))
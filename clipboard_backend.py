@@ -0,0 +1,550 @@
+"""Clipboard backends and the long-lived worker shared by the server variants.
+
+Backends (chosen once at startup, see select_backend):
+
+    tk       — hidden Tk window owns the X CLIPBOARD selection in-process
+    wl-copy  — wl-copy / wl-paste (Wayland)
+    xclip    — xclip subprocess per call
+    xsel     — xsel subprocess per call (text only)
+    file     — text/image kept in files under CLIPBOARD_FILE
+    memory   — plain Python attributes; for headless tests and benchmarks
+
+A single background thread owns the selected backend. Request handlers talk
+to it over a queue, and a self-pipe wakes the thread (or Tk's event loop,
+which also answers paste requests from other X clients while the server owns
+the selection).
+
+The backend can be forced with CLIPBOARD_BACKEND=<name> or --backend <name>;
+otherwise every available one is probed with a read and the fastest wins.
+
+Writes are coalesced: a write that finds the worker idle is applied at once;
+while one is running, newer writes replace the pending one and only the last
+is sent to the backend after it. A write whose content matches what the
+clipboard was last seen holding (within FINGERPRINT_TTL) skips the backend
+entirely.
+"""
+import asyncio
+import hashlib
+import os
+import pathlib
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+
+import log
+import metrics
+
+
+class ClipboardError(Exception):
+    """The clipboard could not be read or written."""
+
+
+_x_env = None
+
+def x_env():
+    """DISPLAY/XAUTHORITY defaults, computed once for all backends."""
+    global _x_env
+    if _x_env is None:
+        env = os.environ.copy()
+        env.setdefault("DISPLAY", ":0")
+        env.setdefault("XAUTHORITY", str(pathlib.Path.home() / ".Xauthority"))
+        _x_env = env
+    return _x_env
+
+
+# ─── Backends ────────────────────────────────────────────────────────────────
+# All methods run on the worker thread only.
+
+class Backend:
+    name = None
+
+    def available(self):
+        return True
+
+    def open(self):
+        """Called once on the worker thread before the first operation."""
+
+    def serve(self, wake_fd, drain):
+        """Run the worker loop: call drain() whenever wake_fd becomes readable."""
+        while True:
+            os.read(wake_fd, 4096)
+            drain()
+
+    def set_text(self, text):
+        raise NotImplementedError
+
+    def get_text(self):
+        raise NotImplementedError
+
+    def set_image(self, data, mime):
+        """data is bytes or a binary file positioned at the start (a spooled upload)."""
+        raise ClipboardError(f"{self.name} backend cannot hold images")
+
+
+class TkBackend(Backend):
+    name = "tk"
+
+    def available(self):
+        try:
+            import tkinter  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def open(self):
+        import tkinter
+        os.environ.update({k: x_env()[k] for k in ("DISPLAY", "XAUTHORITY")})
+        self.tk = tkinter.Tk()
+        self.tk.withdraw()
+
+    def serve(self, wake_fd, drain):
+        import tkinter
+
+        def on_wake(*_):
+            os.read(wake_fd, 4096)
+            drain()
+
+        self.tk.tk.createfilehandler(wake_fd, tkinter.READABLE, on_wake)
+        self.tk.mainloop()
+
+    def set_text(self, text):
+        self.tk.clipboard_clear()
+        self.tk.clipboard_append(text)
+        self.tk.update_idletasks()
+
+    def get_text(self):
+        import tkinter
+        try:
+            return self.tk.clipboard_get()
+        except tkinter.TclError:
+            return ""           # clipboard empty or not text
+
+    def set_image(self, data, mime):
+        # Tk can only serve strings; hand images to xclip if it is there
+        xclip = XclipBackend()
+        if not xclip.available():
+            raise ClipboardError("xclip not installed")
+        xclip.set_image(data, mime)
+
+
+class CommandBackend(Backend):
+    """Backend driven by a pair of command-line tools."""
+    set_cmd = get_cmd = None
+    empty_markers = ()          # stderr snippets meaning "clipboard is empty"
+
+    def available(self):
+        return all(shutil.which(cmd[0]) for cmd in (self.set_cmd, self.get_cmd))
+
+    def run(self, cmd, input=None, output=False):
+        """Run cmd feeding input (bytes or a real file) to its stdin; return stdout if output is set.
+
+        xclip/wl-copy fork a child that keeps the selection and inherits our
+        pipes, so stderr goes to an in-memory file and stdout is only piped
+        when we need it — otherwise run() would wait for that child to exit.
+        """
+        with os.fdopen(os.memfd_create("clipboard-stderr"), "w+b") as err:
+            # A file goes straight to the tool's stdin, never through our memory
+            feed = {"input": input} if input is None or isinstance(input, bytes) else {"stdin": input}
+            metrics.subprocesses.inc((self.name, cmd[0]))
+            result = subprocess.run(cmd, env=x_env(), timeout=10,
+                                    stdout=subprocess.PIPE if output else subprocess.DEVNULL,
+                                    stderr=err, **feed)
+            if result.returncode != 0:
+                err.seek(0)
+                raise ClipboardError(err.read().decode(errors="replace").strip()
+                                     or f"{cmd[0]} exited with {result.returncode}")
+        return result.stdout
+
+    async def run_async(self, cmd, input=None, output=False):
+        """run() as an asyncio subprocess: the event loop is never blocked."""
+        metrics.subprocesses.inc((self.name, cmd[0]))
+        with os.fdopen(os.memfd_create("clipboard-stderr"), "w+b") as err:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, env=x_env(),
+                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE if output else subprocess.DEVNULL,
+                stderr=err)
+            try:
+                stdout, _ = await asyncio.wait_for(proc.communicate(input), 10)
+            except asyncio.TimeoutError:
+                proc.kill()
+                raise ClipboardError(f"{cmd[0]} timed out")
+            if proc.returncode != 0:
+                err.seek(0)
+                raise ClipboardError(err.read().decode(errors="replace").strip()
+                                     or f"{cmd[0]} exited with {proc.returncode}")
+        return stdout
+
+    def set_text(self, text):
+        self.run(self.set_cmd, input=text.encode())
+
+    def get_text(self):
+        try:
+            return self.run(self.get_cmd, output=True).decode(errors="replace")
+        except ClipboardError as e:
+            return self._empty_or_raise(e)
+
+    async def get_text_async(self):
+        try:
+            return (await self.run_async(self.get_cmd, output=True)).decode(errors="replace")
+        except ClipboardError as e:
+            return self._empty_or_raise(e)
+
+    def set_image(self, data, mime):
+        self.run(self.image_cmd(mime), input=data)
+
+    def image_cmd(self, mime):
+        raise ClipboardError(f"{self.name} backend cannot hold images")
+
+    def _empty_or_raise(self, e):
+        if any(marker in str(e).lower() for marker in self.empty_markers):
+            return ""
+        raise e
+
+
+class XclipBackend(CommandBackend):
+    name    = "xclip"
+    set_cmd = ["xclip", "-selection", "clipboard", "-i"]
+    get_cmd = ["xclip", "-selection", "clipboard", "-o"]
+    empty_markers = ("target string not available", "no suitable")
+
+    def image_cmd(self, mime):
+        return ["xclip", "-selection", "clipboard", "-t", mime, "-i"]
+
+
+class XselBackend(CommandBackend):
+    name    = "xsel"
+    set_cmd = ["xsel", "--clipboard", "--input"]
+    get_cmd = ["xsel", "--clipboard", "--output"]
+
+
+class WlCopyBackend(CommandBackend):
+    name    = "wl-copy"
+    set_cmd = ["wl-copy"]
+    get_cmd = ["wl-paste", "--no-newline"]
+    empty_markers = ("nothing is copied", "no selection")
+
+    def available(self):
+        return bool(os.environ.get("WAYLAND_DISPLAY")) and super().available()
+
+    def image_cmd(self, mime):
+        return ["wl-copy", "--type", mime]
+
+
+class FileBackend(Backend):
+    """Clipboard kept in a file — survives restarts, readable by other tools."""
+    name = "file"
+
+    def __init__(self, path=None):
+        self.path = pathlib.Path(path or os.environ.get(
+            "CLIPBOARD_FILE", pathlib.Path.home() / ".clipboard-server" / "clipboard.txt"))
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def set_text(self, text):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def get_text(self):
+        try:
+            return self.path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return ""
+
+    def set_image(self, data, mime):
+        tmp = self.path.with_suffix(".img.tmp")
+        if isinstance(data, bytes):
+            tmp.write_bytes(data)
+        else:
+            with open(tmp, "wb") as f:
+                shutil.copyfileobj(data, f)
+        os.replace(tmp, self.path.with_suffix(".img"))
+        self.path.unlink(missing_ok=True)       # the image replaces the text, as on a real clipboard
+
+
+class MemoryBackend(Backend):
+    name = "memory"
+
+    def __init__(self):
+        self.text  = ""
+        self.image = None           # (mime, bytes)
+
+    def set_text(self, text):
+        self.text = text
+
+    def get_text(self):
+        return self.text
+
+    def set_image(self, data, mime):
+        self.image = (mime, data if isinstance(data, bytes) else data.read())
+        self.text  = ""
+
+
+BACKENDS = {cls.name: cls for cls in
+            (TkBackend, WlCopyBackend, XclipBackend, XselBackend, FileBackend, MemoryBackend)}
+
+# Probed in this order when nothing is forced; file/memory are never guessed
+PROBE_ORDER = ("tk", "wl-copy", "xclip", "xsel")
+
+
+def select_backend(name=None):
+    """Open and return the backend to use. Must run on the worker thread."""
+    name = name or os.environ.get("CLIPBOARD_BACKEND")
+    if name:
+        if name not in BACKENDS:
+            raise ClipboardError(f"unknown clipboard backend {name!r} "
+                                 f"(choose from {', '.join(BACKENDS)})")
+        backend = BACKENDS[name]()
+        if not backend.available():
+            raise ClipboardError(f"clipboard backend {name!r} is not available")
+        backend.open()
+        log.info("clipboard_backend", backend=name, forced=True)
+        return backend
+
+    timings = []
+    for candidate in PROBE_ORDER:
+        backend = BACKENDS[candidate]()
+        if not backend.available():
+            continue
+        try:
+            backend.open()
+            t0 = time.perf_counter()
+            backend.get_text()
+            timings.append((time.perf_counter() - t0, backend))
+            log.info("clipboard_probe", backend=candidate, read_ms=round(timings[-1][0] * 1000, 2))
+        except Exception as e:
+            log.info("clipboard_probe", backend=candidate, error=str(e))
+
+    if not timings:
+        log.warn("clipboard_unavailable", backend="memory")
+        return MemoryBackend()
+
+    elapsed, backend = min(timings, key=lambda t: t[0])
+    log.info("clipboard_backend", backend=backend.name, read_ms=round(elapsed * 1000, 2))
+    return backend
+
+
+# ─── Worker ──────────────────────────────────────────────────────────────────
+
+# An outside program may change the clipboard without us noticing; trust the
+# fingerprint only this long after we last wrote or read it
+FINGERPRINT_TTL = float(os.environ.get("CLIPBOARD_FINGERPRINT_TTL", "2.0"))
+
+
+def content_fingerprint(kind, data):
+    """blake2b of str, bytes or a binary file (read in chunks, then rewound)."""
+    new = lambda: hashlib.blake2b(digest_size=16, person=kind.encode()[:16])
+    if isinstance(data, str):
+        data = data.encode("utf-8", "surrogatepass")
+    if isinstance(data, bytes):
+        h = new()
+        h.update(data)
+        return h.digest()
+    digest = hashlib.file_digest(data, new).digest()
+    data.seek(0)
+    return digest
+
+
+class ClipboardWorker:
+    def __init__(self, backend_name=None):
+        self.backend_name = backend_name
+        self._after_fork()
+        metrics.watch_worker(self)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The worker thread does not survive fork(), and the wake pipe must not
+        # be shared with sibling processes: every process starts its own
+        self.backend      = None
+        self._queue       = queue.Queue()
+        self._wake_r, self._wake_w = os.pipe()
+        self._start_lock  = threading.Lock()
+        self._started     = False
+        self._async_lock  = asyncio.Lock()
+        # Write scheduler: at most one pending write, flushed on the worker thread
+        self._write_lock  = threading.Lock()
+        self._pending     = None        # (fn, fingerprint, op, [futures]) of the newest write
+        self._flush_queued = False
+        self._fingerprint = None        # (fingerprint, monotonic time) of known clipboard content
+        self.stats        = {"writes": 0, "backend_writes": 0, "coalesced": 0, "skipped": 0}
+
+    def start(self, backend_name=None):
+        """Select the backend and start the worker thread (idempotent)."""
+        with self._start_lock:
+            if self._started:
+                return
+            if backend_name:
+                self.backend_name = backend_name
+            ready, error = threading.Event(), []
+            thread = threading.Thread(target=self._run, args=(ready, error),
+                                      name="clipboard-worker", daemon=True)
+            thread.start()
+            ready.wait()
+            if error:
+                raise error[0]
+            self._started = True
+
+    # ── public API (any thread) ──────────────────────────────────────────────
+    def set_text(self, text):
+        """Put text on the clipboard; False if a newer write superseded it before it was applied."""
+        return self.write_text(text).result()
+
+    def get_text(self):
+        return self._call(self._read_text)
+
+    def set_image(self, data, mime="image/png"):
+        """Put image bytes on the clipboard — piped to the tool, no temp file."""
+        return self.write_image(data, mime).result()
+
+    def write_text(self, text):
+        """Schedule a text write; the Future resolves like set_text() once it (or a newer write) is applied."""
+        return self._write(lambda: self.backend.set_text(text), content_fingerprint("text", text),
+                           "set_text")
+
+    def write_image(self, data, mime="image/png"):
+        return self._write(lambda: self.backend.set_image(data, mime), content_fingerprint(mime, data),
+                           "set_image")
+
+    async def call_async(self, method, *args):
+        """Await backend.<method>(*args) from asyncio code without parking a thread.
+
+        Writes go through the same coalescing scheduler as set_text/set_image.
+        Reads from command-line backends run as asyncio subprocesses (one at a
+        time); in-process backends (tk, file, memory) run on the worker thread.
+        """
+        if not self._started:
+            await asyncio.to_thread(self.start)
+        if method == "set_text":
+            return await asyncio.wrap_future(self.write_text(*args))
+        if method == "set_image":
+            return await asyncio.wrap_future(self.write_image(*args))
+        backend = self.backend
+        if isinstance(backend, CommandBackend) and method == "get_text":
+            await asyncio.wrap_future(self.submit(self._flush))
+            async with self._async_lock:
+                start = time.perf_counter()
+                text = await backend.get_text_async()
+                metrics.backend_duration.observe((backend.name, "get_text"), time.perf_counter() - start)
+            self._remember(content_fingerprint("text", text))
+            return text
+        if method == "get_text":
+            return await asyncio.wrap_future(self.submit(self._read_text))
+        return await asyncio.wrap_future(self.submit(lambda: getattr(backend, method)(*args)))
+
+    def submit(self, fn):
+        """Queue fn() for the worker thread; return a concurrent.futures.Future."""
+        if not self._started:
+            self.start()
+        fut = Future()
+        self._queue.put((fut, fn))
+        os.write(self._wake_w, b"\0")
+        return fut
+
+    def _call(self, fn):
+        return self.submit(fn).result()
+
+    # ── write scheduler ──────────────────────────────────────────────────────
+    def _write(self, fn, fingerprint, op):
+        fut = Future()
+        with self._write_lock:
+            self.stats["writes"] += 1
+            if self._pending is not None:
+                # Last writer wins: the pending write is dropped, its callers
+                # are answered together with ours
+                self.stats["coalesced"] += 1
+                futures = self._pending[3] + [fut]
+            elif self._is_current(fingerprint):
+                self.stats["skipped"] += 1
+                fut.set_result(True)
+                return fut
+            else:
+                futures = [fut]
+            self._pending = (fn, fingerprint, op, futures)
+            if not self._flush_queued:
+                self._flush_queued = True
+                self.submit(self._flush)
+        return fut
+
+    def _is_current(self, fingerprint):
+        known = self._fingerprint
+        return (known is not None and known[0] == fingerprint
+                and time.monotonic() - known[1] <= FINGERPRINT_TTL)
+
+    def _remember(self, fingerprint):
+        with self._write_lock:
+            self._fingerprint = (fingerprint, time.monotonic())
+
+    def _flush(self):
+        """Apply the pending write, if any (worker thread)."""
+        with self._write_lock:
+            pending, self._pending, self._flush_queued = self._pending, None, False
+            if pending is None:
+                return
+            fn, fingerprint, op, futures = pending
+            skip = self._is_current(fingerprint)
+            if skip:
+                self.stats["skipped"] += 1
+            else:
+                self.stats["backend_writes"] += 1
+                # The clipboard holds neither the old content nor ours until fn()
+                # returns: a write of the old content meanwhile must not be skipped
+                self._fingerprint = None
+        try:
+            if not skip:
+                start = time.perf_counter()
+                fn()
+                metrics.backend_duration.observe((self.backend.name, op), time.perf_counter() - start)
+                self._remember(fingerprint)
+        except BaseException as e:
+            with self._write_lock:
+                self._fingerprint = None
+            for fut in futures:
+                fut.set_exception(e)
+        else:
+            for fut in futures[:-1]:
+                fut.set_result(False)
+            futures[-1].set_result(True)
+
+    def _read_text(self):
+        self._flush()               # a read must see writes made before it
+        start = time.perf_counter()
+        text = self.backend.get_text()
+        metrics.backend_duration.observe((self.backend.name, "get_text"), time.perf_counter() - start)
+        self._remember(content_fingerprint("text", text))
+        return text
+
+    # ── worker thread ────────────────────────────────────────────────────────
+    def _run(self, ready, error):
+        try:
+            self.backend = select_backend(self.backend_name)
+        except BaseException as e:
+            error.append(e)
+            ready.set()
+            return
+        ready.set()
+        self.backend.serve(self._wake_r, self._drain)
+
+    def _drain(self):
+        while True:
+            try:
+                fut, fn = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(fn())
+            except BaseException as e:
+                fut.set_exception(e)
+
+
+def backend_from_argv(argv):
+    """Value of --backend on the command line, or None."""
+    if "--backend" in argv:
+        return argv[argv.index("--backend") + 1]
+    return None
@@ -0,0 +1,316 @@
+"""What the server knows about the clipboard, shared by all request threads.
+
+ClipboardState keeps the last seen text together with a version counter and
+a content hash. Writers publish() into it; readers take a fresh() snapshot
+(read from the clipboard only if the cached one is older than the poll
+interval) or block in wait() until the version moves past the one they
+already have.
+
+While at least one client is subscribed (an open /events stream or a pending
+long-poll), a watcher thread samples the clipboard once per poll interval to
+pick up changes made outside the server. However many clients are connected,
+that is one clipboard read per interval, and every change is fanned out from
+memory.
+
+The snapshot lives in a SharedStore: a plain dict under a lock in a single
+process, a directory of small JSON files once share() is called, so that
+multi-process deployments (serving.py --workers) agree on the version.
+
+ClipboardHistory keeps the last entries (text and images) under an entry
+count and byte budget, evicting the least recently used first. It lives in
+the memory of one process, so it switches itself off once its SharedStore is
+shared: with several workers each would answer with its own list and ids.
+"""
+import fcntl
+import hashlib
+import json
+import log
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+Snapshot = namedtuple("Snapshot", "version digest text")
+
+POLL_INTERVAL = float(os.environ.get("CLIPBOARD_POLL_INTERVAL", "1.0"))
+SHARED_RECHECK_INTERVAL = 0.25      # how often waiters poll a multi-process store
+
+
+def text_digest(text):
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+
+class SharedStore:
+    """Small JSON values seen by every thread — and, after share(), every worker process.
+
+    Within one process values live in a dict behind a lock. share(directory)
+    moves them to one file per key: writers hold an flock on <key>.lock and
+    replace the file atomically, readers stat() it and reuse their cached copy
+    while the inode is unchanged.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self._values   = {}
+        self._cache    = {}         # key -> ((inode, mtime_ns), value), shared mode only
+        self._lock     = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+        # Set by the serving layer for workers it spawns (rather than forks)
+        if os.environ.get("CLIPBOARD_STATE_DIR"):
+            self.share(os.environ["CLIPBOARD_STATE_DIR"])
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def share(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self.directory = directory
+            for key, value in self._values.items():
+                self._write(key, value)
+        log.info("shared_state", directory=directory)
+
+    def get(self, key, default=None):
+        if self.directory is None:
+            return self._values.get(key, default)
+        try:
+            f = open(self._path(key))
+        except FileNotFoundError:
+            return default
+        with f:
+            st = os.fstat(f.fileno())
+            stamp = (st.st_ino, st.st_mtime_ns)
+            cached = self._cache.get(key)
+            if cached and cached[0] == stamp:
+                return cached[1]
+            value = json.load(f)
+        self._cache[key] = (stamp, value)
+        return value
+
+    def update(self, key, fn, default=None):
+        """Atomically replace the value with fn(current value) and return the new one."""
+        if self.directory is None:
+            with self._lock:
+                value = self._values[key] = fn(self._values.get(key, default))
+                return value
+        with self._lock, open(self._path(key) + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            value = fn(self.get(key, default))
+            self._write(key, value)
+            return value
+
+    def set(self, key, value):
+        return self.update(key, lambda _: value)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _write(self, key, value):
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+
+
+EMPTY_SNAPSHOT = Snapshot(0, text_digest(""), "")
+
+
+class ClipboardState:
+    def __init__(self, clipboard, history=None, store=None, poll_interval=POLL_INTERVAL):
+        self.clipboard     = clipboard          # ClipboardWorker
+        self.history       = history            # ClipboardHistory, optional (per process)
+        self.store         = store or SharedStore()
+        self.poll_interval = poll_interval
+        self._listeners    = []                 # called (any thread) after every change
+        self._after_fork()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Threads do not survive fork(): start over with fresh locks and no watcher
+        self._cond         = threading.Condition()
+        self._sampled_at   = float("-inf")      # monotonic time of the last publish()
+        self._read_lock    = threading.Lock()
+        self._subscribers  = 0
+        self._watcher      = None
+
+    def snapshot(self):
+        return Snapshot(*self.store.get("snapshot", EMPTY_SNAPSHOT))
+
+    def is_fresh(self, max_age=None):
+        max_age = self.poll_interval if max_age is None else max_age
+        return time.monotonic() - self._sampled_at <= max_age
+
+    def fresh(self, max_age=None):
+        """Snapshot at most max_age seconds old; concurrent callers share one clipboard read."""
+        if self.is_fresh(max_age):
+            return self.snapshot()
+        with self._read_lock:
+            if not self.is_fresh(max_age):
+                self.publish(self.clipboard.get_text())
+        return self.snapshot()
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def publish(self, text, force=False):
+        """Record text as the current clipboard; return True if it changed.
+
+        force bumps the version even if the text did not change: an image
+        replaced the clipboard, and its text (empty) may already have been.
+        """
+        digest  = text_digest(text)
+        changed = False
+
+        def bump(current):
+            nonlocal changed
+            current = Snapshot(*current)
+            if current.digest == digest and not force:
+                return current
+            changed = True
+            return Snapshot(current.version + 1, digest, text)
+
+        self.store.update("snapshot", bump, EMPTY_SNAPSHOT)
+        with self._cond:
+            self._sampled_at = time.monotonic()
+            if changed:
+                self._cond.notify_all()
+        if changed and self.history is not None and text:
+            self.history.add(text.encode("utf-8", "surrogatepass"), "text/plain", digest)
+        if changed:
+            for fn in self._listeners:
+                fn()
+        return changed
+
+    def wait(self, since, timeout):
+        """Block until the version differs from since (or timeout); return the snapshot."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                snap = self.snapshot()
+                remaining = deadline - time.monotonic()
+                if snap.version != since or remaining <= 0:
+                    return snap
+                # Other worker processes cannot notify us: re-check the shared store
+                if self.store.directory is not None:
+                    remaining = min(remaining, SHARED_RECHECK_INTERVAL)
+                self._cond.wait(remaining)
+
+    @contextmanager
+    def subscribe(self):
+        """Keep the watcher sampling the clipboard while the caller is listening."""
+        with self._cond:
+            self._subscribers += 1
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="clipboard-watcher",
+                                                 daemon=True)
+                self._watcher.start()
+            self._cond.notify_all()
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+    def _watch(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._subscribers > 0)
+            try:
+                self.publish(self.clipboard.get_text())
+            except Exception as e:
+                log.error("clipboard_watcher_failed", error=str(e))
+            time.sleep(self.poll_interval)
+
+
+# ─── History ─────────────────────────────────────────────────────────────────
+
+HISTORY_MAX_ENTRIES = int(os.environ.get("CLIPBOARD_HISTORY_ENTRIES", "100"))
+HISTORY_MAX_BYTES   = int(os.environ.get("CLIPBOARD_HISTORY_BYTES", str(32 * 1024 * 1024)))
+COMPRESS_MIN_BYTES  = 1024      # smaller text is not worth a zlib call
+
+
+class HistoryEntry:
+    __slots__ = ("id", "mime", "size", "created", "digest", "preview", "data", "compressed")
+
+    def meta(self):
+        return {"id": self.id, "kind": "text" if self.mime.startswith("text/") else "image",
+                "mime": self.mime, "size": self.size, "created": self.created,
+                "preview": self.preview}
+
+    def content(self):
+        return zlib.decompress(self.data) if self.compressed else self.data
+
+
+class ClipboardHistory:
+    """Bounded LRU of clipboard contents, held as (optionally compressed) bytes."""
+
+    def __init__(self, max_entries=HISTORY_MAX_ENTRIES, max_bytes=HISTORY_MAX_BYTES, store=None):
+        self.store       = store            # SharedStore of the server; history is off once it is shared
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.bytes       = 0                # stored (possibly compressed) size of all entries
+        self._entries    = OrderedDict()    # id -> HistoryEntry, least recently used first
+        self._by_digest  = {}
+        self._next_id    = 1
+        self._lock       = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.store is None or self.store.directory is None
+
+    def add(self, data, mime, digest=None):
+        """Store data (bytes) and return its entry id; known content is just moved to the front."""
+        if not self.enabled:
+            return None
+        if digest is None:
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        with self._lock:
+            known = self._by_digest.get(digest)
+            if known is not None:
+                self._entries.move_to_end(known)
+                return known
+
+            entry = HistoryEntry()
+            entry.id, entry.mime, entry.size = self._next_id, mime, len(data)
+            entry.created, entry.digest = time.time(), digest
+            entry.preview = data[:200].decode("utf-8", "replace")[:80] if mime.startswith("text/") else ""
+            entry.data, entry.compressed = data, False
+            if mime.startswith("text/") and len(data) >= COMPRESS_MIN_BYTES:
+                packed = zlib.compress(data, 1)
+                if len(packed) < len(data):
+                    entry.data, entry.compressed = packed, True
+            self._next_id += 1
+
+            self._entries[entry.id] = entry
+            self._by_digest[digest] = entry.id
+            self.bytes += len(entry.data)
+            self._evict()
+            return entry.id if entry.id in self._entries else None
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, old = self._entries.popitem(last=False)
+            del self._by_digest[old.digest]
+            self.bytes -= len(old.data)
+
+    def get(self, entry_id):
+        """Entry by id, or None. Read-only: viewing does not reorder the list under a pager."""
+        with self._lock:
+            return self._entries.get(entry_id)
+
+    def use(self, entry_id):
+        """Entry by id, marked most recently used (it is going back on the clipboard), or None."""
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is not None:
+                self._entries.move_to_end(entry_id)
+            return entry
+
+    def page(self, offset=0, limit=20):
+        """Metadata of entries, most recently used first."""
+        with self._lock:
+            entries = list(reversed(self._entries.values()))
+        return [e.meta() for e in entries[offset:offset + limit]], len(entries)
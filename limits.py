@@ -0,0 +1,109 @@
+"""Request body limits and disk spooling, shared by the server variants.
+
+Every request is capped at MAX_BODY_BYTES (Flask's MAX_CONTENT_LENGTH);
+routes that need more (or stream to disk and need no cap) say so with
+@body_limit(n). A Content-Length above the limit is answered with 413 before
+the body is read; chunked bodies are cut off with 413 once they cross it.
+
+Bodies that must be handed on whole (a pasted image) are read by
+spool_body(): in memory up to SPOOL_THRESHOLD, in an unlinked temp file
+beyond it, so memory use does not grow with the size of the upload.
+
+Sizes come from the environment, in bytes:
+
+    CLIPBOARD_MAX_BODY        default cap for every route     (16 MiB)
+    CLIPBOARD_MAX_TEXT        text pasted through the form    (16 MiB)
+    CLIPBOARD_MAX_IMAGE       pasted / uploaded image         (256 MiB)
+    CLIPBOARD_MAX_JSON_FILE   base64 JSON of /send_to_files   (64 MiB)
+    CLIPBOARD_MAX_FILE        streamed file uploads           (unlimited)
+"""
+import os
+import sys
+import tempfile
+
+from flask import jsonify, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import log
+from body_encoding import DECODER_KEY
+
+MiB = 1024 * 1024
+
+
+def env_size(name, default):
+    """Byte size from the environment; empty or "0" means unlimited (None)."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return int(value) or None
+
+
+MAX_BODY_BYTES      = env_size("CLIPBOARD_MAX_BODY", 16 * MiB)
+MAX_TEXT_BYTES      = env_size("CLIPBOARD_MAX_TEXT", 16 * MiB)
+MAX_IMAGE_BYTES     = env_size("CLIPBOARD_MAX_IMAGE", 256 * MiB)
+MAX_JSON_FILE_BYTES = env_size("CLIPBOARD_MAX_JSON_FILE", 64 * MiB)
+MAX_FILE_BYTES      = env_size("CLIPBOARD_MAX_FILE", None)
+
+SPOOL_THRESHOLD = 1 * MiB       # bodies above this go to a temp file
+SPOOL_CHUNK     = 256 * 1024
+
+
+def configure(app):
+    """Apply the caps to app's routes and answer 413 with a short JSON error."""
+    app.config["MAX_CONTENT_LENGTH"]   = MAX_BODY_BYTES
+    app.config["MAX_FORM_MEMORY_SIZE"] = MAX_TEXT_BYTES
+
+    def route_limit():
+        return getattr(app.view_functions.get(request.endpoint), "body_limit", MAX_BODY_BYTES)
+
+    @app.before_request
+    def apply_body_limit():
+        limit = route_limit()
+        # None here would fall back to MAX_CONTENT_LENGTH, so "no cap" is spelled maxsize
+        request.max_content_length = sys.maxsize if limit is None else limit
+        decoder = request.environ.get(DECODER_KEY)
+        if decoder is not None:
+            # Werkzeug stops quietly at max_content_length and would hand the view a
+            # cut-off body; the decoder raises 413 once the decoded size passes limit
+            decoder.limit = limit
+            request.max_content_length = sys.maxsize
+        if limit is not None and (request.content_length or 0) > limit:
+            raise RequestEntityTooLarge()
+
+    @app.errorhandler(RequestEntityTooLarge)
+    def too_large(e):
+        limit = route_limit()
+        log.warn("body_too_large", path=request.path, size=request.content_length or "chunked",
+                 limit=limit)
+        return jsonify({"error": "Request body too large", "limit": limit}), 413
+
+
+def body_limit(max_bytes):
+    """Route decorator: allow bodies up to max_bytes (None: no cap) instead of MAX_BODY_BYTES."""
+    def decorator(view):
+        view.body_limit = max_bytes
+        return view
+    return decorator
+
+
+def spool_body(stream, threshold=SPOOL_THRESHOLD):
+    """Read a request body; return (bytes, size) if small, else (temp file at offset 0, size)."""
+    buf = bytearray()
+    while len(buf) <= threshold:
+        chunk = stream.read(SPOOL_CHUNK)
+        if not chunk:
+            return bytes(buf), len(buf)
+        buf += chunk
+
+    f = tempfile.TemporaryFile()
+    f.write(buf)
+    size = len(buf)
+    del buf
+    while True:
+        chunk = stream.read(SPOOL_CHUNK)
+        if not chunk:
+            break
+        f.write(chunk)
+        size += len(chunk)
+    f.seek(0)
+    return f, size
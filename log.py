@@ -0,0 +1,196 @@
+"""Non-blocking structured logging for the clipboard servers.
+
+    log.info("file_saved", path=full_path, size=written)
+    log.error("save_failed", exc=e, path=full_path)
+
+A call checks the level, puts one tuple on a queue and returns; it never
+formats, never writes and never waits. A daemon thread (one per process,
+started on first use) turns records into lines and writes them in batches.
+If the writer cannot keep up the queue is bounded: records are dropped and a
+"log_dropped" line says how many. Tracebacks (exc=) are formatted by the
+writer as well.
+
+info/debug events are rate-sampled per event name: the first LOG_BURST of
+each second are written, after that one in LOG_SAMPLE_EVERY, carrying
+"sampled": <how many events the line stands for>. A 10k-file upload thus
+logs a few hundred "file_saved" lines, not ten thousand. Warnings, errors
+and security events are never sampled.
+
+Environment:
+
+    CLIPBOARD_LOG_LEVEL    debug | info | warn | error            (info)
+    CLIPBOARD_LOG_FORMAT   json (one object per line) | text      (json, text on a terminal)
+    CLIPBOARD_LOG_FILE     append to this file instead of stdout
+    CLIPBOARD_LOG_BURST    unsampled info/debug lines per event per second   (10)
+    CLIPBOARD_LOG_SAMPLE   then keep one in N; 1 keeps everything            (100)
+"""
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+LEVELS = {"debug": 10, "info": 20, "warn": 30, "security": 35, "error": 40}
+
+LOG_LEVEL        = LEVELS[os.environ.get("CLIPBOARD_LOG_LEVEL", "info").lower()]
+LOG_FORMAT       = os.environ.get("CLIPBOARD_LOG_FORMAT") or ("text" if sys.stdout.isatty() else "json")
+LOG_FILE         = os.environ.get("CLIPBOARD_LOG_FILE")
+LOG_BURST        = int(os.environ.get("CLIPBOARD_LOG_BURST", 10))
+LOG_SAMPLE_EVERY = max(1, int(os.environ.get("CLIPBOARD_LOG_SAMPLE", 100)))
+QUEUE_SIZE       = 10000
+WRITE_BATCH      = 256          # records joined into one write()
+
+
+class _State:
+    def __init__(self):
+        self.queue   = queue.Queue(QUEUE_SIZE)
+        self.pid     = None         # process whose writer thread is running
+        self.lock    = threading.Lock()
+        self.dropped = 0
+        self.rates   = {}           # event -> [second, events this second, skipped since last line]
+
+
+_state = _State()
+
+
+def _after_fork():
+    # The writer thread stays behind in the parent; its queue and lock may
+    # have been in use at fork time, so the child starts from scratch
+    global _state
+    _state = _State()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _emit(level, event, fields):
+    state = _state
+    if state.pid != os.getpid():
+        _start(state)
+    try:
+        state.queue.put_nowait((time.time(), level, event, fields))
+    except queue.Full:
+        state.dropped += 1
+
+
+def _sample(event):
+    """None to skip this info/debug record, else how many events it stands for."""
+    if LOG_SAMPLE_EVERY == 1:
+        return 1
+    now  = int(time.monotonic())
+    rate = _state.rates.get(event)
+    if rate is None or rate[0] != now:
+        skipped = rate[2] if rate else 0
+        _state.rates[event] = [now, 1, 0]
+        return skipped + 1
+    rate[1] += 1
+    if rate[1] <= LOG_BURST:
+        return 1
+    rate[2] += 1
+    if rate[2] < LOG_SAMPLE_EVERY:
+        return None
+    rate[2] = 0
+    return LOG_SAMPLE_EVERY
+
+
+def debug(event, **fields):
+    if LOG_LEVEL <= 10:
+        n = _sample(event)
+        if n is not None:
+            _emit("debug", event, fields if n == 1 else {**fields, "sampled": n})
+
+
+def info(event, **fields):
+    if LOG_LEVEL <= 20:
+        n = _sample(event)
+        if n is not None:
+            _emit("info", event, fields if n == 1 else {**fields, "sampled": n})
+
+
+def warn(event, **fields):
+    if LOG_LEVEL <= 30:
+        _emit("warn", event, fields)
+
+
+def security(event, **fields):
+    if LOG_LEVEL <= 35:
+        _emit("security", event, fields)
+
+
+def error(event, **fields):
+    """Log an error; pass exc=<exception> to have its traceback written too."""
+    if LOG_LEVEL <= 40:
+        _emit("error", event, fields)
+
+
+# ─── Writer thread ───────────────────────────────────────────────────────────
+
+def _start(state):
+    with state.lock:
+        if state.pid == os.getpid():
+            return
+        threading.Thread(target=_write_loop, args=(state,), name="log-writer", daemon=True).start()
+        state.pid = os.getpid()
+
+
+def _format(ts, level, event, fields):
+    exc = fields.pop("exc", None)
+    tb  = "".join(traceback.format_exception(exc)).rstrip() if isinstance(exc, BaseException) else None
+    if LOG_FORMAT == "json":
+        record = {"ts": round(ts, 6), "level": level, "event": event, **fields}
+        if tb:
+            record["error"] = str(exc)
+            record["traceback"] = tb
+        return json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    clock = time.strftime("%H:%M:%S", time.localtime(ts))
+    line  = f"{clock} [{level.upper()}] {event}"
+    line += "".join(f" {k}={v}" for k, v in fields.items())
+    return line + ("\n" + tb if tb else "") + "\n"
+
+
+def _write_loop(state):
+    out = open(LOG_FILE, "a", encoding="utf-8", buffering=1) if LOG_FILE else None
+    while True:
+        batch = [state.queue.get()]
+        try:
+            while len(batch) < WRITE_BATCH:
+                batch.append(state.queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        lines, waiters = [], []
+        if state.dropped:
+            dropped, state.dropped = state.dropped, 0
+            lines.append(_format(time.time(), "warn", "log_dropped", {"count": dropped}))
+        for record in batch:
+            if isinstance(record, threading.Event):
+                waiters.append(record)
+            else:
+                lines.append(_format(*record))
+        try:
+            stream = out or sys.stdout
+            stream.write("".join(lines))
+            stream.flush()
+        except (OSError, ValueError):
+            pass                    # stdout closed or full disk: logging must not take the server down
+        for waiter in waiters:
+            waiter.set()
+
+
+def flush(timeout=1.0):
+    """Wait (up to timeout seconds) until everything logged so far is written."""
+    state = _state
+    if state.pid != os.getpid():
+        return
+    done = threading.Event()
+    try:
+        state.queue.put(done, timeout=timeout)
+    except queue.Full:
+        return
+    done.wait(timeout)
+
+
+atexit.register(flush)
@@ -0,0 +1,436 @@
+"""Prometheus-style metrics for the clipboard servers, exposed on GET /metrics.
+
+Recording is lock-free: every thread writes to its own shard (a dict reached
+through a threading.local), so inc()/observe() cost a dict update and, for
+histograms, a bisect. Shards are only summed when /metrics is scraped.
+
+With several worker processes (serving.py --workers, or CLIPBOARD_STATE_DIR
+set) each process also writes its totals to <state dir>/metrics/<pid>.json
+FLUSH_INTERVAL seconds after a request (one write per interval however busy
+the worker is); a scrape adds up the
+files of all live workers, so one worker answers for the whole server. A
+restarted worker starts from zero, like any restarted Prometheus target.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+FLUSH_INTERVAL  = 1.0           # seconds between per-worker snapshot files
+MAX_SHARDS      = 64            # beyond this, shards of finished threads are folded together
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name    = name
+        self.help    = help
+        self.labels  = labels
+        self._local  = threading.local()
+        self._shards = []           # (thread, shard) of every thread that recorded something
+        self._retired = {}          # totals of finished threads
+        self._lock   = threading.Lock()
+        REGISTRY.metrics.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                if len(self._shards) >= MAX_SHARDS:
+                    self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        # A thread-per-request server would otherwise leave one shard per request
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = live
+
+    def _merge(self, total, shard):
+        for key, value in list(shard.items()):
+            total[key] = self._add(total.get(key), value)
+
+    def collect(self):
+        """{label values: value} summed over all threads of this process."""
+        with self._lock:
+            total = dict(self._retired)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            self._merge(total, shard)
+        return total
+
+    @staticmethod
+    def _add(a, b):
+        return b if a is None else a + b
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels=(), value=1):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, labels=(), value=1):
+        self.inc(labels, -value)
+
+
+class Derived(Metric):
+    """Values kept elsewhere, read by fn() -> {label values: value} at scrape time."""
+
+    def __init__(self, name, help, labels, fn, type="counter"):
+        super().__init__(name, help, labels)
+        self.fn   = fn
+        self.type = type
+
+    def collect(self):
+        return self.fn()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # one slot per bucket, then +Inf, then the sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def _add(a, b):
+        return list(b) if a is None else [x + y for x, y in zip(a, b)]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics     = []
+        self.directory   = None
+        self._flush_scheduled = False
+        os.register_at_fork(after_in_child=self._after_fork)
+        # Set by the serving layer for workers it spawns (rather than forks)
+        if os.environ.get("CLIPBOARD_STATE_DIR"):
+            self.share(os.path.join(os.environ["CLIPBOARD_STATE_DIR"], "metrics"))
+
+    def share(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def snapshot(self):
+        return {m.name: [[list(k), v] for k, v in m.collect().items()] for m in self.metrics}
+
+    def _after_fork(self):
+        self._flush_scheduled = False       # the timer thread stayed in the parent
+
+    def maybe_flush(self):
+        """Schedule a snapshot write FLUSH_INTERVAL from now, unless one is already due."""
+        if self.directory is None or self._flush_scheduled:
+            return
+        self._flush_scheduled = True
+        timer = threading.Timer(FLUSH_INTERVAL, self._scheduled_flush)
+        timer.daemon = True
+        timer.start()
+
+    def _scheduled_flush(self):
+        self._flush_scheduled = False
+        self.flush()
+
+    def flush(self):
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp  = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def _merged(self):
+        if self.directory is None:
+            return {m.name: m.collect() for m in self.metrics}
+        self.flush()
+        merged = {}
+        for entry in os.scandir(self.directory):
+            pid, _, ext = entry.name.partition(".")
+            if ext != "json" or not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                os.unlink(entry.path)           # worker gone: drop its numbers
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(entry.path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric in self.metrics:
+                total = merged.setdefault(metric.name, {})
+                for key, value in snapshot.get(metric.name, ()):
+                    key = tuple(key)
+                    total[key] = metric._add(total.get(key), value)
+        return merged
+
+    def render(self):
+        """The Prometheus text exposition format (version 0.0.4)."""
+        merged = self._merged()
+        lines  = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for key, value in sorted(merged.get(metric.name, {}).items()):
+                labels = [f'{n}="{escape(v)}"' for n, v in zip(metric.labels, key)]
+                if metric.type != "histogram":
+                    lines.append(f"{metric.name}{braces(labels)} {number(value)}")
+                    continue
+                cumulative = 0
+                for le, count in zip((*map(number, metric.buckets), "+Inf"), value[:-1]):
+                    cumulative += count
+                    bucket = braces(labels + [f'le="{le}"'])
+                    lines.append(f"{metric.name}_bucket{bucket} {cumulative}")
+                lines.append(f"{metric.name}_sum{braces(labels)} {number(value[-1])}")
+                lines.append(f"{metric.name}_count{braces(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def braces(labels):
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+# ─── The server's metrics ────────────────────────────────────────────────────
+
+http_requests = Counter("clipboard_http_requests_total", "HTTP requests by route, method and status.",
+                        ("route", "method", "status"))
+http_duration = Histogram("clipboard_http_request_duration_seconds",
+                          "Time from request start to the last response byte.", ("route",))
+http_bytes_in  = Counter("clipboard_http_request_bytes_total", "Request body bytes read (as sent).",
+                         ("route",))
+http_bytes_out = Counter("clipboard_http_response_bytes_total", "Response body bytes sent.", ("route",))
+uploads_in_flight = Gauge("clipboard_uploads_in_flight", "Upload requests being received right now.",
+                          ("route",))
+files_written = Counter("clipboard_files_written_total", "Files saved to disk.", ("route",))
+file_bytes_written = Counter("clipboard_file_bytes_written_total", "Bytes of saved files.", ("route",))
+backend_duration = Histogram("clipboard_backend_call_duration_seconds",
+                             "Clipboard backend calls by backend and operation.", ("backend", "op"))
+subprocesses = Counter("clipboard_subprocesses_total", "Clipboard tool processes started.",
+                       ("backend", "tool"))
+
+# The write scheduler keeps its own counters (ClipboardWorker.stats); they are
+# read at scrape time rather than counted twice on the hot path
+_workers = []
+
+
+def watch_worker(worker):
+    _workers.append(worker)
+
+
+def _clipboard_writes():
+    total = {}
+    for worker in _workers:
+        for result, key in (("written", "backend_writes"), ("coalesced", "coalesced"),
+                            ("skipped", "skipped")):
+            total[(result,)] = total.get((result,), 0) + worker.stats[key]
+    return total
+
+
+clipboard_writes = Derived("clipboard_writes_total",
+                           "Clipboard writes by outcome: written, coalesced or skipped.",
+                           ("result",), _clipboard_writes)
+
+UPLOAD_ROUTES = {"/files/<path:rel_path>", "/send_to_files", "/send_batch", "/uploads/<upload_id>"}
+
+
+def file_written(route, size):
+    files_written.inc((route,))
+    file_bytes_written.inc((route,), size)
+
+
+def record_request(route, method, status, start_ns, bytes_in, bytes_out):
+    """Account for one finished request (start_ns from time.perf_counter_ns())."""
+    http_requests.inc((route, method, status))
+    http_duration.observe((route,), (time.perf_counter_ns() - start_ns) / 1e9)
+    http_bytes_in.inc((route,), bytes_in)
+    http_bytes_out.inc((route,), bytes_out)
+    REGISTRY.maybe_flush()
+
+
+# ─── WSGI / Flask instrumentation ────────────────────────────────────────────
+
+class CountingInput:
+    """wsgi.input wrapper that counts the bytes the app reads."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count  = 0
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.count += len(data)
+        return data
+
+    def __iter__(self):
+        for line in self.stream:
+            self.count += len(line)
+            yield line
+
+
+def on_file_close(body, environ, callback):
+    """Run callback after body.close() if body is the server's wsgi.file_wrapper.
+
+    waitress and gunicorn send such a body with sendfile() (or straight from
+    the file), but only if they get that very object back, so it cannot be
+    wrapped like other responses. Returns False for any other body.
+    """
+    file_wrapper = environ.get("wsgi.file_wrapper")
+    if not (isinstance(file_wrapper, type) and isinstance(body, file_wrapper)):
+        return False
+    close = getattr(body, "close", None)
+
+    def closed():
+        try:
+            if close is not None:
+                close()
+        finally:
+            callback()
+
+    body.close = closed
+    return True
+
+
+class InstrumentedResponse:
+    """Response iterable that records the request once the last byte is out."""
+
+    def __init__(self, body, environ, start, status, count_in):
+        self.body, self.environ, self.start = body, environ, start
+        self.status, self.count_in, self.sent = status, count_in, 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            record_request(self.environ.get("clipboard.route", "unmatched"),
+                           self.environ["REQUEST_METHOD"], self.status[0], self.start,
+                           self.count_in.count, self.sent)
+
+
+def instrument(app):
+    """Record request metrics for a Flask app and serve them on GET /metrics."""
+    from flask import Response, request
+
+    @app.before_request
+    def label_route():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        request.environ["clipboard.route"] = route
+        if route in UPLOAD_ROUTES and request.method in ("POST", "PUT"):
+            uploads_in_flight.inc((route,))
+            request.environ["clipboard.upload"] = route
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    wsgi_app = app.wsgi_app
+
+    def instrumented(environ, start_response):
+        start = time.perf_counter_ns()
+        environ["wsgi.input"] = count_in = CountingInput(environ["wsgi.input"])
+        status, length = [], [0]
+
+        def capture(status_line, headers, exc_info=None):
+            status[:] = [status_line.split(" ", 1)[0]]
+            length[:] = [int(v) for k, v in headers if k.lower() == "content-length"] or [0]
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = wsgi_app(environ, capture)
+        finally:
+            if "clipboard.upload" in environ:
+                uploads_in_flight.dec((environ["clipboard.upload"],))
+        if on_file_close(body, environ, lambda: record_request(
+                environ.get("clipboard.route", "unmatched"), environ["REQUEST_METHOD"],
+                (status or ["500"])[0], start, count_in.count, length[0])):
+            return body             # a file download: bytes out is its Content-Length
+        return InstrumentedResponse(body, environ, start, status or ["500"], count_in)
+
+    app.wsgi_app = instrumented
+
+
+# ─── ASGI instrumentation (bsend_asgi.py's native routes) ────────────────────
+
+class ASGIRequest:
+    """Wraps receive/send of one ASGI request to count it; call done() when it ends."""
+
+    def __init__(self, route, method, receive, send):
+        self.route, self.method = route, method
+        self._receive, self._send = receive, send
+        self.start  = time.perf_counter_ns()
+        self.status = "500"
+        self.bytes_in = self.bytes_out = 0
+        self.upload = route in UPLOAD_ROUTES and method in ("POST", "PUT")
+        if self.upload:
+            uploads_in_flight.inc((route,))
+
+    async def receive(self):
+        message = await self._receive()
+        self.bytes_in += len(message.get("body", b""))
+        return message
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.status = str(message["status"])
+        else:
+            self.bytes_out += len(message.get("body", b""))
+        await self._send(message)
+
+    def done(self):
+        if self.upload:
+            uploads_in_flight.dec((self.route,))
+        record_request(self.route, self.method, self.status, self.start, self.bytes_in, self.bytes_out)
+
@@ -0,0 +1,176 @@
+"""Opt-in profiling of single requests: cProfile and/or tracemalloc.
+
+Off unless CLIPBOARD_PROFILE_TOKEN is set — then install() adds no wrapper
+at all and requests pay nothing. With a token, a request asks for a profile
+with
+
+    X-Profile: cpu,mem          X-Profile-Token: <token>
+    ?profile=cpu,mem&profile_token=<token>
+
+and gets an X-Profile-Id header back. The files land in CLIPBOARD_PROFILE_DIR
+(default <tmp>/clipboard-server-profiles):
+
+    <id>.prof       cProfile stats    python3 -m pstats <id>.prof  (or snakeviz)
+    <id>.mem.txt    tracemalloc: top allocation sites while the request ran
+    <id>.json       method, path, status, duration and what was recorded
+
+The profile covers the whole request in this process: body decoding, the
+view, the clipboard call, template rendering and sending the response.
+cProfile sees only the request's own thread; tracemalloc is process-wide,
+so other requests running at the same time show up in the .mem.txt, and
+only one memory profile runs at a time.
+"""
+import cProfile
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from urllib.parse import parse_qs
+
+from metrics import on_file_close
+import log
+
+PROFILE_TOKEN = os.environ.get("CLIPBOARD_PROFILE_TOKEN")
+PROFILE_DIR   = os.environ.get("CLIPBOARD_PROFILE_DIR",
+                               os.path.join(tempfile.gettempdir(), "clipboard-server-profiles"))
+MEM_TOP       = 50              # allocation sites listed in <id>.mem.txt
+MODES         = {"cpu", "mem"}
+
+_mem_lock = threading.Lock()    # tracemalloc is global: one memory profile at a time
+
+
+def requested(headers, query_string):
+    """The set of profilers asked for by an authorised request, else None.
+
+    headers is a mapping with lower-case names (ASGI style); query_string is raw.
+    """
+    if PROFILE_TOKEN is None:
+        return None
+    modes, token = headers.get("x-profile"), headers.get("x-profile-token")
+    if modes is None and "profile" in query_string:
+        args  = parse_qs(query_string)
+        modes = args.get("profile", [None])[-1]
+        token = args.get("profile_token", [token])[-1]
+    if modes is None:
+        return None
+    if token is None or not hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode()):
+        log.security("profile_token_rejected")
+        return None
+    return {m.strip() for m in modes.split(",")} & MODES or {"cpu"}
+
+
+class Profile:
+    def __init__(self, modes):
+        self.id       = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+        self.modes    = set(modes)
+        self.cpu      = None
+        self.mem_base = None
+        self.skipped  = []
+
+    def start(self):
+        if "mem" in self.modes:
+            if _mem_lock.acquire(blocking=False):
+                tracemalloc.start(10)
+                self.mem_base = tracemalloc.take_snapshot()
+            else:
+                self.skipped.append("mem")
+        if "cpu" in self.modes:
+            self.cpu = cProfile.Profile()
+            try:
+                self.cpu.enable()
+            except ValueError:          # another profiler is active in this thread
+                self.cpu = None
+                self.skipped.append("cpu")
+        self.started = time.perf_counter()
+
+    def stop(self, method, path, status):
+        duration = time.perf_counter() - self.started
+        if self.cpu is not None:
+            self.cpu.disable()
+        mem_after = None
+        if self.mem_base is not None:
+            mem_after = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            _mem_lock.release()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.id)
+        if self.cpu is not None:
+            self.cpu.dump_stats(base + ".prof")
+        if mem_after is not None:
+            stats = mem_after.compare_to(self.mem_base, "lineno")
+            with open(base + ".mem.txt", "w") as f:
+                f.write(f"{method} {path}: {sum(s.size_diff for s in stats)} bytes net, "
+                        f"peak traced {peak} bytes\n\n")
+                for stat in stats[:MEM_TOP]:
+                    f.write(f"{stat}\n")
+        with open(base + ".json", "w") as f:
+            json.dump({"id": self.id, "method": method, "path": path, "status": status,
+                       "duration": round(duration, 6),
+                       "recorded": sorted(self.modes - set(self.skipped)),
+                       "skipped": self.skipped}, f)
+        log.info("profile_saved", id=self.id, path=path, duration=round(duration, 6))
+
+
+class ProfiledResponse:
+    """Keeps the profiler running until the response body has been sent."""
+
+    def __init__(self, body, profile, environ, status):
+        self.body, self.profile, self.environ, self.status = body, profile, environ, status
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.finish()
+
+    def finish(self):
+        try:
+            self.profile.stop(self.environ["REQUEST_METHOD"], self.environ.get("PATH_INFO", ""),
+                              self.status[0] if self.status else None)
+        except Exception as e:
+            log.error("profile_save_failed", id=self.profile.id, exc=e)
+
+
+def install(app):
+    """Wrap a Flask app so authorised requests can ask for a profile (no-op without a token)."""
+    if PROFILE_TOKEN is None:
+        return
+    wsgi_app = app.wsgi_app
+
+    def profiled(environ, start_response):
+        headers = {"x-profile": environ.get("HTTP_X_PROFILE"),
+                   "x-profile-token": environ.get("HTTP_X_PROFILE_TOKEN")}
+        modes = requested({k: v for k, v in headers.items() if v is not None},
+                          environ.get("QUERY_STRING", ""))
+        if modes is None:
+            return wsgi_app(environ, start_response)
+
+        profile, status = Profile(modes), []
+
+        def with_id(status_line, response_headers, exc_info=None):
+            status[:] = [int(status_line.split(" ", 1)[0])]
+            return start_response(status_line, response_headers + [("X-Profile-Id", profile.id)],
+                                  exc_info)
+
+        profile.start()
+        try:
+            body = wsgi_app(environ, with_id)
+        except BaseException:
+            profile.stop(environ["REQUEST_METHOD"], environ.get("PATH_INFO", ""), 500)
+            raise
+        response = ProfiledResponse(body, profile, environ, status)
+        if on_file_close(body, environ, response.finish):
+            return body             # keep sendfile(): the profile ends when the server closes it
+        return response
+
+    app.wsgi_app = profiled
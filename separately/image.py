@@ -1,41 +1,42 @@
 from flask import Flask, request
-import os
-import subprocess
 import pathlib
 import sys
 import traceback
 
+# clipboard_backend.py lives one level up
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from body_encoding import DecodeRequestBody
+from clipboard_backend import ClipboardWorker, ClipboardError, backend_from_argv
+from limits import MAX_IMAGE_BYTES, body_limit, configure as configure_limits, spool_body
+import log
+from metrics import instrument
+from profiling import install as install_profiling
+from serving import serve
+from werkzeug.exceptions import HTTPException
+
 app = Flask(__name__)
+configure_limits(app)
+app.wsgi_app = DecodeRequestBody(app.wsgi_app)
+install_profiling(app)
+instrument(app)
+clipboard = ClipboardWorker()
 
 @app.route('/', methods=['GET', 'POST'])
+@body_limit(MAX_IMAGE_BYTES)
 def upload_image():
     try:
         if request.method == 'POST':
-            if not request.data:
+            data, size = spool_body(request.stream)     # big images wait in a temp file
+            if not size:
                 return "No image data received", 400
 
-            filepath = '/tmp/uploaded_image.png'
-            with open(filepath, 'wb') as f:
-                f.write(request.data)
-
-            display = os.environ.get('DISPLAY', ':0')
-            xauth = pathlib.Path.home() / '.Xauthority'
-            env = os.environ.copy()
-            env['DISPLAY'] = display
-            env['XAUTHORITY'] = str(xauth)
-
-            if subprocess.run(['which', 'xclip'], capture_output=True).returncode != 0:
-                return "xclip not installed", 500
-
-            result = subprocess.run(
-                ['xclip', '-selection', 'clipboard', '-t', 'image/png', '-i', filepath],
-                env=env,
-                capture_output=True,
-                text=True
-            )
-
-            if result.returncode != 0:
-                return f"Failed to copy to clipboard:\\n{result.stderr}", 500
+            try:
+                clipboard.set_image(data)
+            except ClipboardError as e:
+                return f"Failed to copy to clipboard:\\n{e}", 500
+            finally:
+                if not isinstance(data, bytes):
+                    data.close()
 
             return "Image uploaded and copied to clipboard!", 200
 
@@ -73,13 +74,16 @@ def upload_image():
         </body>
         </html>
         '''
+    except HTTPException:
+        raise
     except Exception as e:
         tb = traceback.format_exc()
-        print(tb)
+        log.error("server_error", exc=e)
         return f"Server error:\\n{tb}", 500
 
 if __name__ == '__main__':
     port = 5000
     if '--port' in sys.argv:
         port = int(sys.argv[sys.argv.index('--port') + 1])
-    app.run(host='0.0.0.0', port=port, debug=True)
+    serve(app, port, sys.argv,
+          on_worker_start=lambda: clipboard.start(backend_from_argv(sys.argv)))
@@ -1,7 +1,25 @@
-from flask import Flask, render_template_string, request
-import pyperclip
+from flask import Flask, request
+import pathlib
+import sys
+
+# clipboard_backend.py lives one level up
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from assets import page_response
+from body_encoding import DecodeRequestBody
+from clipboard_backend import ClipboardWorker, backend_from_argv
+from clipboard_state import SharedStore
+from limits import configure as configure_limits
+from metrics import instrument
+from profiling import install as install_profiling
+from serving import serve
 
 app = Flask(__name__)
+configure_limits(app)
+app.wsgi_app = DecodeRequestBody(app.wsgi_app)
+install_profiling(app)
+instrument(app)
+clipboard = ClipboardWorker()
+state_store = SharedStore()
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -25,17 +43,20 @@ HTML_TEMPLATE = """
 </html>
 """
 
-last_text = ""
+page_template = app.jinja_env.from_string(HTML_TEMPLATE)     # compiled once
 
 @app.route("/", methods=["GET", "POST"])
 def index():
-    global last_text
     if request.method == "POST":
         text = request.form.get("text")
         if text:
-            pyperclip.copy(text)
-            last_text = text
-    return render_template_string(HTML_TEMPLATE, message=last_text)
+            if clipboard.set_text(text):    # False: superseded by a newer write
+                state_store.set("last_text", text)
+    return page_response(page_template.render(message=state_store.get("last_text", "")))
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5555)
+    port = 5555
+    if '--port' in sys.argv:
+        port = int(sys.argv[sys.argv.index('--port') + 1])
+    serve(app, port, sys.argv, store=state_store,
+          on_worker_start=lambda: clipboard.start(backend_from_argv(sys.argv)))
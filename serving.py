@@ -0,0 +1,141 @@
+"""Production serving for the clipboard server variants.
+
+Command line (next to the existing --port):
+
+    --workers N   worker processes; needs gunicorn (pip install gunicorn)
+    --threads N   request threads per worker (default 8)
+    --dev         Flask development server, as before
+
+Every request, including an open /events stream or a pending long-poll,
+holds one of a worker's threads for as long as it lasts. An SSE stream lasts
+as long as the browser tab, so stream_slots lets at most half of the
+threads (CLIPBOARD_MAX_STREAMS to override) wait like that; further streams
+get 503 and the page retries later, and the other threads stay free for
+ordinary requests.
+
+One worker is served by waitress when it is installed, otherwise by the
+threaded Werkzeug server with a warning. With several workers the app's
+SharedStore is moved to CLIPBOARD_STATE_DIR so every process sees the same
+state (and /metrics adds up all workers, see metrics.py), and on_worker_start (e.g. starting the clipboard worker) runs inside
+each process after it is forked.
+
+serve_asgi() is the asyncio counterpart, used by bsend_asgi.py (uvicorn).
+"""
+import os
+import sys
+import tempfile
+import threading
+
+import log
+import metrics
+
+DEFAULT_THREADS = 8
+MAX_STREAMS     = int(os.environ.get("CLIPBOARD_MAX_STREAMS", 0))      # 0: half of --threads
+
+
+class StreamSlots:
+    """Counts the requests of this process that hold a thread while they wait."""
+
+    def __init__(self, threads=DEFAULT_THREADS):
+        self.configure(threads)
+        self.used = 0
+        self._after_fork()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def configure(self, threads):
+        self.limit = MAX_STREAMS or max(1, threads // 2)
+
+    def acquire(self):
+        """Take a slot; False if all are in use (answer 503)."""
+        with self._lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.used -= 1
+
+
+stream_slots = StreamSlots()
+
+
+def int_option(argv, name, default):
+    if name in argv:
+        return int(argv[argv.index(name) + 1])
+    return default
+
+
+def state_dir(port):
+    return (os.environ.get("CLIPBOARD_STATE_DIR")
+            or os.path.join(tempfile.gettempdir(), f"clipboard-server-{port}"))
+
+
+def serve(app, port, argv, store=None, on_worker_start=None, host="0.0.0.0"):
+    workers = int_option(argv, "--workers", 1)
+    threads = int_option(argv, "--threads", DEFAULT_THREADS)
+    on_worker_start = on_worker_start or (lambda: None)
+    stream_slots.configure(threads)
+
+    if "--dev" in argv:
+        on_worker_start()
+        app.run(host=host, port=port, threaded=True)
+        return
+
+    if workers > 1:
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            sys.exit("[ERROR] --workers needs gunicorn: pip install gunicorn")
+
+        if store is not None:
+            store.share(state_dir(port))
+        metrics.REGISTRY.share(os.path.join(state_dir(port), "metrics"))
+
+        class GunicornApp(BaseApplication):
+            def load_config(self):
+                self.cfg.set("bind", f"{host}:{port}")
+                self.cfg.set("workers", workers)
+                self.cfg.set("threads", threads)
+                self.cfg.set("worker_class", "gthread")
+                self.cfg.set("timeout", 0)      # SSE streams and big uploads stay open
+                self.cfg.set("post_worker_init", lambda worker: on_worker_start())
+
+            def load(self):
+                return app
+
+        log.info("serving", server="gunicorn", workers=workers, threads=threads)
+        GunicornApp().run()
+        return
+
+    on_worker_start()
+    try:
+        import waitress
+    except ImportError:
+        log.warn("waitress_missing", hint="pip install waitress", server="werkzeug")
+        app.run(host=host, port=port, threaded=True)
+        return
+
+    log.info("serving", server="waitress", threads=threads)
+    waitress.serve(app, host=host, port=port, threads=threads)
+
+
+def serve_asgi(app, import_name, port, argv, host="0.0.0.0"):
+    """Run an ASGI app under uvicorn; import_name ("module:app") is used for --workers."""
+    workers = int_option(argv, "--workers", 1)
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("[ERROR] async mode needs uvicorn: pip install uvicorn")
+
+    log.info("serving", server="uvicorn", workers=workers)
+    if workers > 1:
+        # uvicorn spawns fresh interpreters; SharedStore picks this up on import
+        os.environ["CLIPBOARD_STATE_DIR"] = state_dir(port)
+        uvicorn.run(import_name, host=host, port=port, workers=workers, log_level="warning")
+    else:
+        uvicorn.run(app, host=host, port=port, log_level="warning")
@@ -0,0 +1,6 @@
+import pathlib
+import sys
+
+# The servers are flat modules at the repository root
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+sys.argv = sys.argv[:1]
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import threading
+import time
+
+import bsend
+import bsend_asgi
+
+
+async def call(scope, body=b""):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await bsend_asgi.app({"type": "http", "method": "GET", "query_string": b"", "headers": [],
+                          **scope}, receive, send)
+    return sent
+
+
+async def start():
+    """Run the lifespan startup; return a coroutine function that shuts it down."""
+    queue = asyncio.Queue()
+    await queue.put({"type": "lifespan.startup"})
+    started = asyncio.Event()
+
+    async def send(message):
+        started.set()
+
+    task = asyncio.create_task(bsend_asgi.lifespan(queue.get, send))
+    await started.wait()
+
+    async def stop():
+        await queue.put({"type": "lifespan.shutdown"})
+        await task
+    return stop
+
+
+def test_concurrent_stale_reads_share_one_clipboard_read(monkeypatch):
+    reads, lock = [], threading.Lock()
+
+    async def scenario():
+        stop = await start()
+        backend = bsend.clipboard.backend
+        backend.text = "shared"
+
+        def get_text():
+            with lock:
+                reads.append(1)
+            time.sleep(0.05)
+            return backend.text
+
+        monkeypatch.setattr(backend, "get_text", get_text)
+        bsend.clipboard_state._sampled_at = float("-inf")
+        try:
+            return await asyncio.gather(*(call({"path": "/get_clipboard"}) for _ in range(20)))
+        finally:
+            await stop()
+
+    monkeypatch.setattr(bsend_asgi.sys, "argv", ["bsend_asgi.py", "--backend", "memory"])
+    # The lifespan's listener points at this test's loop, which is closed afterwards
+    monkeypatch.setattr(bsend.clipboard_state, "_listeners", [])
+    responses = asyncio.run(scenario())
+    assert len(reads) == 1
+    assert {json.loads(sent[-1]["body"])["text"] for sent in responses} == {"shared"}
@@ -0,0 +1,34 @@
+import io
+import os
+import tarfile
+
+import bsend
+
+
+def tar_of(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def test_failed_directory_sync_is_reported_not_fatal(tmp_path, monkeypatch):
+    synced = []
+
+    def sync_dir(path):
+        if path.endswith("bad"):
+            raise OSError(5, "Input/output error")
+        synced.append(path)
+
+    monkeypatch.setattr(bsend, "sync_dir", sync_dir)
+    body = tar_of({"bad/a.txt": b"a", "good/b.txt": b"b"})
+    r = bsend.app.test_client().post(f"/send_batch?base_path={tmp_path}", data=body)
+
+    assert r.status_code == 200 and r.json["ok"] == 2 and r.json["failed"] == 0
+    assert list(r.json["unsynced"]) == [str(tmp_path / "bad")]
+    assert synced == [str(tmp_path / "good")]
+    assert (tmp_path / "bad" / "a.txt").read_bytes() == b"a"
+    assert not [name for name in os.listdir(tmp_path / "bad") if name.endswith(".part")]
@@ -0,0 +1,60 @@
+import gzip
+import json
+import tracemalloc
+
+import pytest
+import zstandard
+from werkzeug.exceptions import BadRequest
+
+import bsend
+from body_encoding import Decoder
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def client():
+    return bsend.app.test_client()
+
+
+@pytest.mark.parametrize("coding, compress", [
+    ("gzip", gzip.compress),
+    ("zstd", zstandard.ZstdCompressor().compress),
+])
+def test_truncated_body_is_rejected(client, tmp_path, coding, compress):
+    body = compress(bytes(range(256)) * 4096)
+    r = client.put(f"/files/out.bin?base_path={tmp_path}", data=body[:len(body) // 2],
+                   headers={"Content-Encoding": coding})
+    assert r.status_code == 400
+    assert not (tmp_path / "out.bin").exists()
+    with pytest.raises(BadRequest):
+        decoder = Decoder(coding)
+        list(decoder.decode(body[:-8]))
+        decoder.finish()
+
+
+def test_zstd_bomb_is_decoded_in_bounded_pieces(client, monkeypatch):
+    monkeypatch.setattr(bsend.send_to_files, "body_limit", 1 * MiB)
+    bomb = zstandard.ZstdCompressor(level=19).compress(b"\0" * (200 * MiB))
+    tracemalloc.start()
+    try:
+        r = client.post("/send_to_files", data=bomb,
+                        headers={"Content-Encoding": "zstd", "Content-Type": "application/json"})
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert r.status_code == 413
+    assert peak < 16 * MiB
+
+
+@pytest.mark.parametrize("coding, compress", [
+    ("gzip", gzip.compress),
+    ("zstd", zstandard.ZstdCompressor().compress),
+])
+def test_compressed_json_over_the_limit_is_413(client, tmp_path, monkeypatch, coding, compress):
+    monkeypatch.setattr(bsend.send_to_files, "body_limit", 64 * 1024)
+    body = json.dumps({"base_path": str(tmp_path), "rel_path": "x", "data": "A" * 200000})
+    r = client.post("/send_to_files", data=compress(body.encode()),
+                    headers={"Content-Encoding": coding, "Content-Type": "application/json"})
+    assert r.status_code == 413
+    assert not (tmp_path / "x").exists()
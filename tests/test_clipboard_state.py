@@ -0,0 +1,28 @@
+import pytest
+
+import bsend
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(64)
+
+
+@pytest.fixture
+def client():
+    bsend.clipboard.start("memory")
+    return bsend.app.test_client()
+
+
+def test_pasted_image_is_published(client):
+    client.post("/", data={"action": "text", "text": "before"})
+    r = client.get("/get_clipboard")
+    assert r.json["text"] == "before"
+    etag, version = r.headers["ETag"], r.json["version"]
+
+    assert client.post("/", data=PNG, content_type="image/png").status_code == 200
+    r = client.get("/get_clipboard", headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.json["text"] == "" and r.json["version"] == version + 1
+    r = client.get(f"/wait_clipboard?since={version}&timeout=0")
+    assert r.json["changed"] and r.json["version"] == version + 1
+
+    # A second image leaves the text empty but is still a change
+    client.post("/", data=PNG[::-1], content_type="image/png")
+    assert client.get("/get_clipboard").json["version"] == version + 2
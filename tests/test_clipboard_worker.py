@@ -0,0 +1,38 @@
+import threading
+import time
+
+import pytest
+
+from clipboard_backend import ClipboardWorker
+
+
+@pytest.fixture
+def worker():
+    worker = ClipboardWorker("memory")
+    worker.start()
+    return worker
+
+
+def test_write_of_old_content_during_a_write_is_not_lost(worker):
+    worker.set_text("A")
+    running, release = threading.Event(), threading.Event()
+    set_text = worker.backend.set_text
+    worker.backend.set_text = lambda text: (running.set(), release.wait(5), set_text(text))
+
+    in_flight = worker.write_text("B")
+    assert running.wait(5)              # B is now running on the worker thread
+    again = worker.write_text("A")
+    release.set()
+
+    assert in_flight.result(5) and again.result(5)
+    assert worker.get_text() == "A"
+    assert worker.stats["skipped"] == 0
+
+
+def test_sequential_writes_are_not_delayed(worker):
+    start = time.monotonic()
+    for i in range(20):
+        assert worker.set_text(str(i))
+    assert time.monotonic() - start < 0.5
+    assert worker.get_text() == "19"
+    assert worker.stats["backend_writes"] == 20
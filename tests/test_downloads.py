@@ -0,0 +1,52 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+import bsend
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "a.txt").write_bytes(b"0123456789")
+    monkeypatch.setattr(bsend, "READ_ROOTS", [os.path.realpath(tmp_path)])
+    return bsend.app.test_client(), tmp_path
+
+
+def test_reads_inside_read_roots(client):
+    c, root = client
+    r = c.get(f"/files/docs/a.txt?base_path={root}")
+    assert r.status_code == 200 and r.data == b"0123456789"
+    r.close()
+    r = c.get(f"/files/a.txt?base_path={root}/docs", headers={"Range": "bytes=2-4"})
+    assert r.status_code == 206 and r.data == b"234"
+    r.close()
+    assert [e["name"] for e in c.get(f"/files/docs?base_path={root}").json["entries"]] == ["a.txt"]
+
+
+@pytest.mark.parametrize("url", [
+    "/files/passwd?base_path=/etc/",
+    "/files/?base_path=/etc/",
+    "/export/?base_path=/etc/",
+    "/files/docs/a.txt?base_path=/",
+])
+def test_base_path_outside_read_roots_is_refused(client, url):
+    assert client[0].get(url).status_code == 403
+
+
+def test_traversal_out_of_base_path_is_refused(client):
+    c, root = client
+    assert c.get(f"/files/../../etc/passwd?base_path={root}/docs").status_code == 403
+    os.symlink("/etc/passwd", root / "docs" / "evil")
+    assert c.get(f"/files/docs/evil?base_path={root}").status_code == 403
+
+
+def test_zip_export_skips_entries_that_vanish(tmp_path):
+    for name in ("a", "b", "c"):
+        (tmp_path / name).write_bytes(name.encode() * 10)
+    entries = [(name, str(tmp_path / name), os.stat(tmp_path / name)) for name in ("a", "b", "c")]
+    (tmp_path / "b").unlink()
+    zf = zipfile.ZipFile(io.BytesIO(b"".join(bsend.zip_stream(entries))))
+    assert zf.namelist() == ["a", "c"] and zf.testzip() is None
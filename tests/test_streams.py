@@ -0,0 +1,37 @@
+import http.client
+import threading
+
+import pytest
+
+waitress = pytest.importorskip("waitress")
+
+import bsend
+from serving import stream_slots
+
+THREADS = 4
+
+
+@pytest.fixture
+def server():
+    bsend.clipboard.start("memory")
+    stream_slots.configure(THREADS)
+    srv = waitress.create_server(bsend.app, host="127.0.0.1", port=0, threads=THREADS)
+    threading.Thread(target=srv.run, daemon=True).start()   # left running: a daemon thread
+    return srv.effective_port
+
+
+def test_plain_request_succeeds_while_streams_are_open(server):
+    streams = []
+    for _ in range(THREADS):
+        conn = http.client.HTTPConnection("127.0.0.1", server, timeout=5)
+        conn.request("GET", "/events")
+        streams.append((conn, conn.getresponse()))
+    statuses = sorted(r.status for _, r in streams)
+    assert statuses == [200] * (THREADS // 2) + [503] * (THREADS - THREADS // 2)
+
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=5)
+    conn.request("GET", "/clipboard_stats")
+    assert conn.getresponse().status == 200
+
+    for conn, _ in streams:
+        conn.close()
@@ -0,0 +1,28 @@
+import pytest
+
+import bsend
+
+
+@pytest.fixture
+def client():
+    return bsend.app.test_client()
+
+
+@pytest.mark.parametrize("entry, error", [
+    ({"size": 1}, "files[0]: missing path"),
+    ({"path": "", "size": 1}, "files[0]: missing path"),
+    ({"path": 5, "size": 1}, "files[0]: path must be a string"),
+    ({"path": "a", "size": -1}, "files[0]: size must be a non-negative integer"),
+])
+def test_malformed_entry_is_400(client, tmp_path, entry, error):
+    r = client.post("/sync_manifest", json={"base_path": str(tmp_path), "files": [entry]})
+    assert r.status_code == 400 and r.json["error"] == error
+
+
+def test_traversal_is_reported_per_entry(client, tmp_path):
+    r = client.post("/sync_manifest", json={"base_path": str(tmp_path),
+                                            "files": [{"path": "../x", "size": 1},
+                                                      {"path": "a", "size": 1}]})
+    assert r.status_code == 200
+    assert r.json["errors"] == [{"path": "../x", "error": "Path traversal blocked"}]
+    assert r.json["needed"] == ["a"]